@@ -0,0 +1,426 @@
+"""In-process fleet of fake SC4MP servers on localhost, for benchmarking the
+scanner without touching the real network.
+
+Each server listens on an ephemeral port and speaks either the message
+protocol (through `BaseRequestHandler`) or the v0.8 legacy protocol. Every
+server lists every other server in the fleet, so a scanner seeded with a few
+of them discovers the rest the way it would in production."""
+
+import hashlib
+import json
+import random
+import struct
+import time
+from datetime import datetime
+from functools import lru_cache
+from socket import SHUT_RDWR
+from threading import Lock, Thread
+
+from core.networking import \
+	BaseRequestHandler, ServerSocket, COMMAND_PLUGINS_TABLE, COMMAND_REGIONS_TABLE, \
+	send_json, recv_json
+
+
+FLEET_HOST = "127.0.0.1"
+
+FLEET_BEHAVIOURS = ["ok", "timeout", "failure"]
+
+FLEET_THREAD_NAME = "FakeServer"
+
+
+def bitmap(width, height):
+	"""Returns the header of a BMP image, which is all the scanner reads."""
+	data = bytearray(54)
+	data[0:2] = b"BM"
+	struct.pack_into("<ii", data, 18, width, height)
+	return bytes(data)
+
+
+@lru_cache(maxsize=None)
+def zeros(size):
+	"""Returns `size` zero bytes, shared by every file of that size."""
+	return bytes(size)
+
+
+@lru_cache(maxsize=None)
+def checksum(data):
+	return hashlib.md5(data).hexdigest()
+
+
+class Payload():
+	"""File contents and file table for one target (plugins or regions)."""
+
+
+	def __init__(self, files):
+
+		self.files = files
+		self.table = [
+			[checksum(data), len(data), path]
+			for path, data in files.items()
+		]
+
+
+	def send(self, s, file_table):
+
+		for checksum, size, path in file_table:
+			s.sendall(self.files[path])
+
+
+class FakeServer():
+	"""One fake server.
+
+	`behaviour` is one of `FLEET_BEHAVIOURS`: "timeout" servers accept
+	connections and never answer, "failure" servers close them immediately."""
+
+
+	def __init__(self, index, legacy=False, keep_alive=True, behaviour="ok", latency=0,
+			jitter=0, regions=2, region_size=8, city_size=1 << 16, plugins=4,
+			plugin_size=1 << 20, private=False, rng=None):
+
+		self.rng = rng or random.Random(index)
+
+		self.server_id = f"fake{index:05d}"
+		self.legacy = legacy
+		self.keep_alive = keep_alive
+		self.behaviour = behaviour
+		self.latency = latency
+		self.jitter = jitter
+		self.private = private
+		self.peers = []
+
+		self.socket = ServerSocket((FLEET_HOST, 0))
+		self.address = self.socket.getsockname()
+		self.socket.listen(128)
+
+		self.regions = Payload(self.region_files(regions, region_size, city_size))
+		self.plugins = Payload({
+			f"plugin{index}.dat": zeros(plugin_size) for index in range(plugins)
+		})
+
+		# Connections held open by "timeout" servers
+		self.held = []
+
+		self.requests = 0
+		self.bytes_sent = 0
+		self.lock = Lock()
+
+		self.end = False
+		self.thread = Thread(target=self.run, name=FLEET_THREAD_NAME, daemon=True)
+
+
+	def region_files(self, regions, region_size, city_size):
+
+		now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+		files = dict()
+		for region in range(regions):
+			database = dict()
+			for x in range(region_size):
+				for y in range(region_size):
+					if self.rng.random() < .5:
+						database[f"{x}_{y}"] = {
+							"owner": f"user{self.rng.randrange(16)}",
+							"size": 1,
+							"modified": now
+						}
+						files[f"Region{region}/City {x}-{y}.sc4"] = zeros(city_size)
+					else:
+						database[f"{x}_{y}"] = None
+			files[f"Region{region}/config.bmp"] = bitmap(region_size, region_size)
+			files[f"Region{region}/_Database/region.json"] = json.dumps(database).encode()
+		return files
+
+
+	def info(self):
+
+		return {
+			"server_id": self.server_id,
+			"server_name": f"Fake server {self.server_id}",
+			"server_description": "Benchmark server",
+			"server_url": "",
+			"server_version": "0.8.0" if self.legacy else "0.9.0",
+			"private": self.private,
+			"password_enabled": False,
+			"user_plugins_enabled": False
+		}
+
+
+	def server_list(self):
+
+		return [list(peer) for peer in self.peers]
+
+
+	def time(self):
+
+		return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+	def delay(self):
+		"""Simulates the round trip to a remote server."""
+
+		latency = self.latency + self.rng.uniform(0, self.jitter)
+		if latency > 0:
+			time.sleep(latency)
+
+
+	def sent(self, size):
+
+		with self.lock:
+			self.bytes_sent += size
+
+
+	def start(self):
+
+		self.thread.start()
+
+
+	def run(self):
+
+		while not self.end:
+
+			try:
+				c, address = self.socket.accept()
+			except OSError:
+				return
+
+			with self.lock:
+				self.requests += 1
+
+			if self.behaviour == "timeout":
+				self.held.append(c)
+			elif self.behaviour == "failure":
+				c.close()
+			elif self.legacy:
+				Thread(target=self.handle_legacy, args=(c,), name=FLEET_THREAD_NAME, daemon=True).start()
+			else:
+				FakeRequestHandler(c, self).start()
+
+
+	def handle_legacy(self, c):
+
+		try:
+
+			request = c.recv(4096).decode()
+
+			self.delay()
+
+			if request == "server_id":
+				c.send(self.server_id.encode())
+			elif request == "server_version":
+				c.send(self.info()["server_version"].encode())
+			elif request == "server_list":
+				send_json(c, self.server_list())
+			elif request == "info":
+				send_json(c, self.info())
+			elif request == "time":
+				c.send(self.time().encode())
+			elif request in ["plugins", "regions"]:
+				payload = self.plugins if request == "plugins" else self.regions
+				send_json(c, payload.table)
+				file_table = recv_json(c)
+				payload.send(c, file_table)
+				self.sent(sum(entry[1] for entry in file_table))
+
+		except Exception:
+
+			pass
+
+		finally:
+
+			c.close()
+
+
+	def close(self):
+
+		self.end = True
+		try:
+			self.socket.shutdown(SHUT_RDWR)
+		except OSError:
+			pass
+		self.socket.close()
+		for c in self.held:
+			c.close()
+
+
+class FakeRequestHandler(BaseRequestHandler):
+	"""Answers the commands the scanner sends over the message protocol."""
+
+
+	def __init__(self, c, server):
+
+		super().__init__(c, private=False, keep_alive=server.keep_alive)
+
+		self.name = FLEET_THREAD_NAME
+		self.daemon = True
+
+		self.server = server
+
+
+	def run(self):
+
+		try:
+			self.handle_request()
+		except Exception:
+			pass
+		finally:
+			self.c.close()
+
+
+	def handle_request(self):
+
+		result = super().handle_request()
+
+		# Servers without keep-alive still answer the data command that
+		# follows a file table on the same connection
+		if not self.keep_alive and self.command in [COMMAND_PLUGINS_TABLE, COMMAND_REGIONS_TABLE]:
+			self.command = None
+			result = super().handle_request()
+
+		return result
+
+
+	def respond(self, **headers):
+
+		self.server.delay()
+
+		return super().respond(**headers)
+
+
+	def res_info(self):
+
+		self.respond(**self.server.info())
+
+
+	def res_private(self):
+
+		self.respond(private=self.server.private)
+
+
+	def res_server_list(self):
+
+		self.respond()
+		self.c.send_json(self.server.server_list())
+
+
+	def res_time(self):
+
+		self.respond(time=self.server.time())
+
+
+	def res_plugins_table(self):
+
+		self.respond()
+		self.c.send_json(self.server.plugins.table)
+
+
+	def res_plugins_data(self):
+
+		self.send_data(self.server.plugins)
+
+
+	def res_regions_table(self):
+
+		self.respond()
+		self.c.send_json(self.server.regions.table)
+
+
+	def res_regions_data(self):
+
+		self.send_data(self.server.regions)
+
+
+	def send_data(self, payload):
+
+		self.respond()
+		file_table = self.c.recv_json()
+		payload.send(self.c, file_table)
+		self.server.sent(sum(entry[1] for entry in file_table))
+
+
+class FakeFleet():
+	"""A fleet of `size` fake servers that all list each other.
+
+	The rates are the fractions of servers that speak the legacy protocol,
+	keep connections alive, never answer, or refuse every connection. The same
+	`seed` always builds the same fleet."""
+
+
+	def __init__(self, size, legacy_rate=0, keep_alive_rate=1, timeout_rate=0,
+			failure_rate=0, seed=0, **options):
+
+		rng = random.Random(seed)
+
+		self.servers = []
+		for index in range(size):
+			roll = rng.random()
+			if roll < timeout_rate:
+				behaviour = "timeout"
+			elif roll < timeout_rate + failure_rate:
+				behaviour = "failure"
+			else:
+				behaviour = "ok"
+			self.servers.append(FakeServer(
+				index,
+				legacy=rng.random() < legacy_rate,
+				keep_alive=rng.random() < keep_alive_rate,
+				behaviour=behaviour,
+				rng=random.Random(rng.random()),
+				**options
+			))
+
+		# Every port is bound before any server starts, so the lists are complete
+		addresses = [server.address for server in self.servers]
+		for server in self.servers:
+			server.peers = addresses
+
+
+	def __enter__(self):
+
+		self.start()
+
+		return self
+
+
+	def __exit__(self, *args):
+
+		self.close()
+
+
+	def __len__(self):
+
+		return len(self.servers)
+
+
+	@property
+	def addresses(self):
+
+		return [server.address for server in self.servers]
+
+
+	def seeds(self, count=1):
+		"""Returns the addresses a scanner should start from."""
+
+		return self.addresses[:count]
+
+
+	def expected(self):
+		"""Returns the IDs of the servers a sweep should publish."""
+
+		return set(server.server_id for server in self.servers if server.behaviour == "ok")
+
+
+	def bytes_sent(self):
+
+		return sum(server.bytes_sent for server in self.servers)
+
+
+	def start(self):
+
+		for server in self.servers:
+			server.start()
+
+
+	def close(self):
+
+		for server in self.servers:
+			server.close()
@@ -0,0 +1,229 @@
+"""Micro-benchmarks for the receive paths in `core.networking`.
+
+Each case sends a realistic payload over `socket.socketpair()` from a
+background thread while the benchmarked function receives it. Run from the
+repository root, for example:
+
+	python -m benchmarks.networking --output before.json
+	python -m benchmarks.networking --compare before.json
+
+Reported per case: MB/s, calls/s, and the peak memory traced by
+`tracemalloc` during one call, which shows how many times the payload is
+copied on its way in."""
+
+import hashlib
+import json
+import platform
+import socket
+import struct
+import subprocess
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+
+from core import networking
+from core.networking import encode_message, recv_exact, recv_files, recv_json, recv_message
+
+
+def file_table(entries):
+	"""Returns a file table like a server with many regions sends."""
+	return [
+		["0123456789abcdef0123456789abcdef", 1 << 16, f"Region{index // 256}/City {index % 16}-{index // 16 % 16}.sc4"]
+		for index in range(entries)
+	]
+
+
+def json_frame(data):
+	data = json.dumps(data).encode()
+	return struct.pack("I", len(data)) + data
+
+
+class Case():
+	"""One benchmark: `payload` is sent `calls` times while `receive(s)`
+	reads it back once per call."""
+
+
+	def __init__(self, name, payload, receive, calls):
+
+		self.name = name
+		self.payload = payload
+		self.receive = receive
+		self.calls = calls
+
+
+	def sender(self, s, calls):
+
+		def send():
+			try:
+				for _ in range(calls):
+					s.sendall(self.payload)
+			except OSError:
+				pass
+
+		thread = threading.Thread(target=send, name="Sender", daemon=True)
+		thread.start()
+
+		return thread
+
+
+	def run(self):
+
+		a, b = socket.socketpair()
+
+		try:
+
+			# Throughput
+			sender = self.sender(a, self.calls)
+			start = time.perf_counter()
+			for _ in range(self.calls):
+				self.receive(b)
+			elapsed = time.perf_counter() - start
+			sender.join()
+
+			# Peak memory for one call, with the payload already buffered or
+			# in flight so only the receiving side is measured
+			sender = self.sender(a, 1)
+			tracemalloc.start()
+			try:
+				self.receive(b)
+				peak = tracemalloc.get_traced_memory()[1]
+			finally:
+				tracemalloc.stop()
+			sender.join()
+
+		finally:
+
+			a.close()
+			b.close()
+
+		size = len(self.payload)
+
+		return {
+			"name": self.name,
+			"payload_bytes": size,
+			"calls": self.calls,
+			"seconds": elapsed,
+			"calls_per_second": self.calls / elapsed,
+			"mb_per_second": size * self.calls / elapsed / 1e6,
+			"peak_bytes_per_call": peak,
+			"peak_per_payload_byte": peak / size
+		}
+
+
+def cases(scale=1):
+	"""Returns the benchmark cases, with call counts multiplied by `scale`."""
+
+	def calls(count):
+		return max(1, int(count * scale))
+
+	# JSON framing
+	table = file_table(10000)
+	servers = [["127.0.0.1", 7240 + index] for index in range(200)]
+
+	# Message framing
+	info = encode_message(False, networking.COMMAND_INFO, {
+		"server_id": "0123456789abcdef", "server_name": "Server", "server_version": "0.9.0",
+		"private": False, "password_enabled": False, "keep_alive": True
+	})
+	ping = encode_message(True, networking.COMMAND_PING, {})
+
+	# File transfer
+	region = bytes(8 << 20)
+	regions_table = [[hashlib.md5(region).hexdigest(), len(region), "Region/City.sc4"]]
+	small = bytes(4096)
+	small_table = [[hashlib.md5(small).hexdigest(), len(small), f"Region/{index}.sc4"] for index in range(1000)]
+
+	def receive_files(table):
+		def receive(s):
+			for checksum, size, path, chunks in recv_files(s, table):
+				for chunk in chunks:
+					pass
+		return receive
+
+	return [
+		Case("recv_json file table (10k entries)", json_frame(table), recv_json, calls(20)),
+		Case("recv_json server list (200 entries)", json_frame(servers), recv_json, calls(2000)),
+		Case("recv_message response", info, recv_message, calls(20000)),
+		Case("recv_message ping", ping, recv_message, calls(20000)),
+		Case("recv_exact region file (8 MiB)", region, lambda s: recv_exact(s, len(region)), calls(20)),
+		Case("recv_files region file (8 MiB)", region, receive_files(regions_table), calls(20)),
+		Case("recv_files small files (1000 x 4 KiB)", small * len(small_table), receive_files(small_table), calls(20))
+	]
+
+
+def revision():
+	"""Returns the git commit being measured, if known."""
+
+	try:
+		return subprocess.run(
+			["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+		).stdout.strip()
+	except Exception:
+		return None
+
+
+def compare(results, baseline):
+	"""Prints the change in throughput and memory against a previous run."""
+
+	previous = {result["name"]: result for result in baseline["results"]}
+
+	print(f"\nCompared with {baseline.get('revision')} ({baseline.get('time')}):")
+
+	for result in results:
+		old = previous.get(result["name"])
+		if old is None:
+			continue
+		speed = result["mb_per_second"] / old["mb_per_second"] - 1
+		memory = result["peak_bytes_per_call"] / max(old["peak_bytes_per_call"], 1) - 1
+		print(f"  {result['name']:<40} {speed:+8.1%} MB/s {memory:+8.1%} peak")
+
+
+def parse_args():
+
+	parser = ArgumentParser(description=__doc__.splitlines()[0])
+
+	parser.add_argument("--scale", type=float, default=1, help="multiply the number of calls per case")
+	parser.add_argument("--filter", default=None, help="only run cases whose name contains this")
+	parser.add_argument("--output", default=None, help="write the results to this JSON file")
+	parser.add_argument("--compare", default=None, help="compare with results written earlier")
+
+	return parser.parse_args()
+
+
+def main():
+
+	args = parse_args()
+
+	print(f"{'case':<40} {'MB/s':>10} {'calls/s':>12} {'peak/call':>12}")
+
+	results = []
+	for case in cases(args.scale):
+		if args.filter and args.filter not in case.name:
+			continue
+		result = case.run()
+		results.append(result)
+		print(
+			f"{result['name']:<40} {result['mb_per_second']:>10.1f} "
+			f"{result['calls_per_second']:>12.0f} {result['peak_bytes_per_call']:>12}"
+		)
+
+	if args.compare:
+		with open(args.compare) as file:
+			compare(results, json.load(file))
+
+	if args.output:
+		with open(args.output, "w") as file:
+			json.dump({
+				"revision": revision(),
+				"time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+				"python": platform.python_version(),
+				"platform": platform.platform(),
+				"results": results
+			}, file, indent=4)
+		print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+	main()
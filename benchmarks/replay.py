@@ -0,0 +1,345 @@
+"""Replays transcripts of real server conversations to the scanner.
+
+Record a transcript by running the scanner with `--record`, for example for
+one sweep:
+
+	python sc4mpapi.py --role scanner --state-file "" --record network.transcript
+
+Then sweep the recorded network offline, as often as needed:
+
+	python -m benchmarks.replay network.transcript --engine threads --speed 0
+
+Every recorded address gets a local `ServerSocket`, and
+`core.networking.resolver` sends the scanner's connections to it. Each
+connection is answered from a recorded conversation that began with the
+same bytes, sending the recorded responses byte for byte after the recorded
+delays, divided by `--speed` (0 answers at once)."""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from socket import SHUT_RDWR
+
+from core import networking
+from core.networking import ServerSocket, Transcript
+
+from benchmarks.fleet import FLEET_HOST, FLEET_THREAD_NAME
+from benchmarks.scanner_throughput import load_api, peak_rss, sweep
+
+
+class Conversation():
+	"""The events of one recorded connection after it was opened, as
+	`(kind, seconds, payload)` tuples."""
+
+
+	def __init__(self, address):
+
+		self.address = address
+		self.events = []
+		self.replays = 0
+
+
+	def request(self):
+		"""Returns the first bytes the client sent."""
+
+		for kind, seconds, data in self.events:
+			if kind == Transcript.SENT:
+				return data
+
+		return b""
+
+
+class ReplayServer():
+	"""Answers connections to one recorded address from its conversations."""
+
+
+	def __init__(self, address, conversations, speed=1, timeout=5):
+
+		self.address = address
+		self.conversations = conversations
+		self.speed = speed
+		self.timeout = timeout
+
+		self.socket = ServerSocket((FLEET_HOST, 0))
+		self.local_address = self.socket.getsockname()
+		self.socket.listen(128)
+
+		self.connections = 0
+		self.diverged = 0
+		self.lock = threading.Lock()
+
+		self.end = False
+		self.thread = threading.Thread(target=self.run, name=FLEET_THREAD_NAME, daemon=True)
+
+
+	def start(self):
+
+		self.thread.start()
+
+
+	def run(self):
+
+		while not self.end:
+
+			try:
+				c, address = self.socket.accept()
+			except OSError:
+				return
+
+			threading.Thread(target=self.handle, args=(c,), name=FLEET_THREAD_NAME, daemon=True).start()
+
+
+	def find(self, request):
+		"""Returns the least replayed conversation that began with `request`."""
+
+		with self.lock:
+
+			matches = [
+				conversation for conversation in self.conversations
+				if conversation.request()[:len(request)] == request[:len(conversation.request())]
+			]
+
+			if len(matches) == 0:
+				return None
+
+			conversation = min(matches, key=lambda conversation: conversation.replays)
+			conversation.replays += 1
+			self.connections += 1
+
+			return conversation
+
+
+	def handle(self, c):
+
+		try:
+
+			c.settimeout(self.timeout)
+
+			received = c.recv(65536)
+			arrived = time.perf_counter()
+
+			conversation = self.find(received)
+
+			if conversation is not None:
+				self.replay(c, conversation, received, arrived)
+
+		except OSError:
+
+			pass
+
+		finally:
+
+			c.close()
+
+
+	def replay(self, c, conversation, received, arrived):
+
+		sent_at = 0
+
+		for kind, seconds, data in conversation.events:
+
+			if kind == Transcript.SENT:
+
+				# Take the same number of bytes from the client
+				try:
+					while len(received) < len(data):
+						chunk = c.recv(65536)
+						if not chunk:
+							return
+						received += chunk
+						arrived = time.perf_counter()
+				except OSError:
+					pass
+
+				if received[:len(data)] != data:
+					with self.lock:
+						self.diverged += 1
+
+				received = received[len(data):]
+				sent_at = seconds
+
+			elif kind == Transcript.RECEIVED:
+
+				if self.speed > 0:
+					delay = (seconds - sent_at) / self.speed - (time.perf_counter() - arrived)
+					if delay > 0:
+						time.sleep(delay)
+
+				# The server closed the connection here
+				if not data:
+					return
+
+				c.sendall(data)
+
+			elif kind == Transcript.CLOSE:
+
+				return
+
+
+	def close(self):
+
+		self.end = True
+		try:
+			self.socket.shutdown(SHUT_RDWR)
+		except OSError:
+			pass
+		self.socket.close()
+
+
+class ReplayFleet():
+	"""A `ReplayServer` for every address in a transcript.
+
+	Addresses missing from the transcript resolve to a closed local port, so
+	the scanner never reaches the real network."""
+
+
+	def __init__(self, path, speed=1, seeds=None):
+
+		conversations = dict()
+		for kind, connection, seconds, data in Transcript.read(path):
+			if kind == Transcript.OPEN:
+				conversations[connection] = Conversation(tuple(json.loads(data)))
+			elif connection in conversations:
+				conversations[connection].events.append((kind, seconds, data))
+
+		by_address = dict()
+		for conversation in conversations.values():
+			by_address.setdefault(conversation.address, []).append(conversation)
+
+		self.conversations = len(conversations)
+		self.bytes = sum(
+			len(data) for conversation in conversations.values()
+			for kind, seconds, data in conversation.events if kind == Transcript.RECEIVED
+		)
+
+		self.servers = {
+			address: ReplayServer(address, recorded, speed)
+			for address, recorded in by_address.items()
+		}
+
+		# The recorded addresses the scanner started from
+		self._seeds = [address for address in (seeds or []) if address in self.servers]
+		if len(self._seeds) == 0:
+			self._seeds = list(self.servers.keys())[:1]
+
+		closed = ServerSocket((FLEET_HOST, 0))
+		self.closed_address = closed.getsockname()
+		closed.close()
+
+
+	def __enter__(self):
+
+		self.start()
+
+		return self
+
+
+	def __exit__(self, *args):
+
+		self.close()
+
+
+	def __len__(self):
+
+		return len(self.servers)
+
+
+	def seeds(self):
+
+		return self._seeds
+
+
+	def expected(self):
+		"""Server IDs aren't known without parsing the conversations, so
+		nothing is reported missing."""
+
+		return set()
+
+
+	def resolve(self, address):
+
+		server = self.servers.get(tuple(address))
+
+		if server is None:
+			return self.closed_address
+
+		return server.local_address
+
+
+	def diverged(self):
+
+		return sum(server.diverged for server in self.servers.values())
+
+
+	def start(self):
+
+		for server in self.servers.values():
+			server.start()
+
+		networking.resolver = self.resolve
+
+
+	def close(self):
+
+		networking.resolver = None
+
+		for server in self.servers.values():
+			server.close()
+
+
+def parse_args():
+
+	parser = ArgumentParser(description=__doc__.splitlines()[0])
+
+	parser.add_argument("transcript", help="transcript written by sc4mpapi.py --record")
+	parser.add_argument("--engine", choices=["asyncio", "threads"], default="asyncio")
+	parser.add_argument("--max-fetchers", type=int, default=None, help="fetchers in flight (default: the engine's)")
+	parser.add_argument("--repeat", type=int, default=3, help="number of cold sweeps")
+	parser.add_argument("--speed", type=float, default=1, help="replay delays this many times faster, or 0 for none")
+	parser.add_argument("--fetch-timeout", type=float, default=30, help="scanner timeout per connection, in seconds")
+	parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+
+	return parser.parse_args()
+
+
+def main():
+
+	args = parse_args()
+
+	api = load_api()
+
+	fleet = ReplayFleet(args.transcript, speed=args.speed, seeds=list(api.SC4MP_SERVERS))
+
+	print(
+		f"Replaying {fleet.conversations} conversations ({fleet.bytes / (1 << 20):.1f} MiB) "
+		f"with {len(fleet)} servers to the {args.engine} engine..."
+	)
+
+	runs = []
+	with fleet:
+		for index in range(args.repeat):
+			with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+				result = sweep(api, fleet, args.engine, args.max_fetchers, args.fetch_timeout)
+			result["diverged"] = fleet.diverged()
+			runs.append(result)
+			print(
+				f"  #{index + 1}: {result['servers']} servers in {result['sweep_seconds']:.3f}s "
+				f"({result['servers_per_second']:.1f}/s), {result['peak_threads']} threads peak, "
+				f"{result['diverged']} requests diverged from the transcript so far"
+			)
+
+	rss = peak_rss()
+	if rss is not None:
+		print(f"Peak RSS: {rss / (1 << 20):.1f} MiB")
+
+	if args.output:
+		with open(args.output, "w") as file:
+			json.dump({"args": vars(args), "runs": runs}, file, indent=4)
+		print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+	main()
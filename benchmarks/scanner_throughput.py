@@ -0,0 +1,211 @@
+"""Measures how fast the scanner sweeps a fleet of fake servers.
+
+Run from the repository root, for example:
+
+	python -m benchmarks.scanner_throughput --servers 500 --latency .05 --engine asyncio
+
+Every repetition starts a fresh scanner from one seed server and stops it
+when its first sweep is published, reporting servers per second, the sweep
+wall time, the peak number of scanner threads and the peak RSS of the
+process (which includes the fleet)."""
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+from benchmarks.fleet import FakeFleet, FLEET_THREAD_NAME
+
+
+def load_api():
+	"""Imports sc4mpapi without starting its scanner or writing its log here."""
+
+	sys.argv = [
+		"sc4mpapi.py", "--role", "api", "--state-file", "",
+		"--snapshot-file", os.path.join(tempfile.gettempdir(), "sc4mpapi-benchmark.bin")
+	]
+
+	stdout = sys.stdout
+	cwd = os.getcwd()
+	os.chdir(tempfile.mkdtemp(prefix="sc4mpapi-benchmark-"))
+	try:
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			import sc4mpapi
+	finally:
+		os.chdir(cwd)
+		sys.stdout = stdout
+
+	return sc4mpapi
+
+
+def peak_rss():
+	"""Returns the peak resident set size of the process in bytes, if known."""
+
+	if resource is None:
+		return None
+
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	# Kilobytes on Linux, bytes on macOS
+	return rss if sys.platform == "darwin" else rss * 1024
+
+
+class ThreadSampler(threading.Thread):
+	"""Samples the number of live threads, not counting the fleet's."""
+
+
+	def __init__(self, interval=.005):
+
+		super().__init__(name="Sampler", daemon=True)
+
+		self.interval = interval
+		self.peak = 0
+		self.end = threading.Event()
+
+
+	def count(self):
+
+		return sum(1 for thread in threading.enumerate() if thread.name != FLEET_THREAD_NAME)
+
+
+	def run(self):
+
+		while not self.end.wait(self.interval):
+			self.peak = max(self.peak, self.count())
+
+
+	def stop(self):
+
+		self.end.set()
+		self.join()
+
+		return self.peak
+
+
+def sweep(api, fleet, engine, max_fetchers, fetch_timeout):
+	"""Runs one cold sweep over the fleet and returns its measurements."""
+
+	api.SC4MP_SERVERS[:] = fleet.seeds()
+
+	if engine == "threads":
+		scanner = api.Scanner(max_fetchers=max_fetchers or 50)
+	else:
+		scanner = api.AsyncScanner(max_fetchers=max_fetchers or 1000)
+	scanner.FETCH_TIMEOUT = fetch_timeout
+	scanner.SWEEP_TIMEOUT = fetch_timeout * 4
+
+	# Stop at the end of the first sweep, once it is published
+	published = threading.Event()
+	sweep_finished = scanner.sweep_finished
+	def sweep_finished_once():
+		sweep_finished()
+		published.set()
+		scanner.end = True
+	scanner.sweep_finished = sweep_finished_once
+
+	sampler = ThreadSampler()
+	sampler.start()
+
+	start = time.perf_counter()
+	scanner.start()
+	published.wait()
+	elapsed = time.perf_counter() - start
+
+	threads = sampler.stop()
+	scanner.join(5)
+
+	servers = len(scanner.servers)
+
+	return {
+		"servers": servers,
+		"missing": len(fleet.expected() - set(scanner.servers.keys())),
+		"sweep_seconds": elapsed,
+		"servers_per_second": servers / elapsed if elapsed > 0 else None,
+		"peak_threads": threads,
+		"peak_rss_bytes": peak_rss()
+	}
+
+
+def parse_args():
+
+	parser = ArgumentParser(description=__doc__.splitlines()[0])
+
+	parser.add_argument("--servers", type=int, default=200, help="number of fake servers")
+	parser.add_argument("--engine", choices=["asyncio", "threads"], default="asyncio")
+	parser.add_argument("--max-fetchers", type=int, default=None, help="fetchers in flight (default: the engine's)")
+	parser.add_argument("--repeat", type=int, default=3, help="number of cold sweeps")
+	parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+	parser.add_argument("--jitter", type=float, default=0, help="random extra latency, up to this many seconds")
+	parser.add_argument("--legacy-rate", type=float, default=.2, help="fraction of servers on the v0.8 protocol")
+	parser.add_argument("--keep-alive-rate", type=float, default=.5, help="fraction of servers keeping connections alive")
+	parser.add_argument("--timeout-rate", type=float, default=0, help="fraction of servers that never answer")
+	parser.add_argument("--failure-rate", type=float, default=0, help="fraction of servers that refuse connections")
+	parser.add_argument("--fetch-timeout", type=float, default=2, help="scanner timeout per connection, in seconds")
+	parser.add_argument("--regions", type=int, default=2, help="regions per server")
+	parser.add_argument("--region-size", type=int, default=8, help="width of each region, in cities")
+	parser.add_argument("--city-size", type=int, default=1 << 16, help="size of each city file, in bytes")
+	parser.add_argument("--plugins", type=int, default=4, help="plugin files per server")
+	parser.add_argument("--plugin-size", type=int, default=1 << 20, help="size of each plugin file, in bytes")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+
+	return parser.parse_args()
+
+
+def main():
+
+	args = parse_args()
+
+	api = load_api()
+
+	fleet = FakeFleet(
+		args.servers,
+		legacy_rate=args.legacy_rate,
+		keep_alive_rate=args.keep_alive_rate,
+		timeout_rate=args.timeout_rate,
+		failure_rate=args.failure_rate,
+		seed=args.seed,
+		latency=args.latency,
+		jitter=args.jitter,
+		regions=args.regions,
+		region_size=args.region_size,
+		city_size=args.city_size,
+		plugins=args.plugins,
+		plugin_size=args.plugin_size
+	)
+
+	print(f"Sweeping {len(fleet)} fake servers with the {args.engine} engine...")
+
+	runs = []
+	with fleet:
+		for index in range(args.repeat):
+			with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+				result = sweep(api, fleet, args.engine, args.max_fetchers, args.fetch_timeout)
+			runs.append(result)
+			print(
+				f"  #{index + 1}: {result['servers']} servers in {result['sweep_seconds']:.3f}s "
+				f"({result['servers_per_second']:.1f}/s), {result['missing']} missing, "
+				f"{result['peak_threads']} threads peak"
+			)
+
+	rss = peak_rss()
+	if rss is not None:
+		print(f"Peak RSS: {rss / (1 << 20):.1f} MiB")
+
+	if args.output:
+		with open(args.output, "w") as file:
+			json.dump({"args": vars(args), "runs": runs}, file, indent=4)
+		print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,834 @@
+"""Simulates the scanner against a large virtual network on a virtual clock.
+
+The asyncio scanner runs unchanged on an event loop whose clock jumps
+straight to the next timer instead of sleeping, with `core.networking`
+connecting its sockets to simulated servers instead of the network. Publish
+intervals, refresh intervals, backoff and timeouts all pass in virtual time, so
+hours of scanning a network of thousands of servers take seconds. Run from
+the repository root, for example:
+
+	python -m benchmarks.simulation --servers 1000 --hours 6
+
+The same seed always builds the same network and, because every wait is a
+timer on one event loop, replays the same run."""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import math
+import os
+import random
+import selectors
+import struct
+import time
+from argparse import ArgumentParser
+from collections import deque
+from datetime import datetime
+
+from core import networking
+from core.networking import \
+	COMMAND_INFO, COMMAND_PLUGINS_DATA, COMMAND_PLUGINS_TABLE, COMMAND_REGIONS_DATA, \
+	COMMAND_REGIONS_TABLE, COMMAND_SERVER_LIST, COMMAND_TIME, HEADER_KEEP_ALIVE, encode_message
+
+from benchmarks.fleet import bitmap
+from benchmarks.scanner_throughput import load_api, peak_rss
+
+
+SIMULATION_START = 1767225600 # 2026-01-01 00:00:00 UTC
+
+SIMULATION_PORT = 7240
+
+SIMULATION_BEHAVIOURS = ["ok", "down", "blackhole", "flaky"]
+
+
+def percentile(values, fraction):
+
+	if not values:
+		return None
+
+	values = sorted(values)
+
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def timestamp(t):
+
+	return datetime.utcfromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class VirtualClock():
+	"""Wall-clock time for the scanner's tables and the simulated servers,
+	and, counted from zero so small steps aren't lost to rounding, monotonic
+	time for the event loop."""
+
+
+	def __init__(self, start=SIMULATION_START):
+
+		self.start = start
+		self.elapsed = 0
+
+
+	@property
+	def now(self):
+
+		return self.start + self.elapsed
+
+
+	def time(self):
+
+		return self.now
+
+
+	def advance(self, seconds):
+
+		self.elapsed += seconds
+
+
+class VirtualSelector(selectors.DefaultSelector):
+	"""Advances the clock by the time the event loop would have waited for
+	its next timer, instead of waiting."""
+
+
+	def __init__(self, clock):
+
+		super().__init__()
+
+		self.clock = clock
+
+
+	def select(self, timeout=None):
+
+		# Nothing scheduled, so only another thread can wake the loop
+		if timeout is None:
+			return super().select(None)
+
+		# Simulated connections have no file descriptors, and callbacks from
+		# other threads are queued whether or not the loop's wakeup pipe is read
+		if timeout > 0:
+			self.clock.advance(timeout)
+
+		return []
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+
+
+	def __init__(self, clock):
+
+		self.clock = clock
+
+		super().__init__(VirtualSelector(clock))
+
+
+	def time(self):
+
+		return self.clock.elapsed
+
+
+class SimulatedWriter():
+	"""Client end of a simulated connection, in place of `asyncio.StreamWriter`."""
+
+
+	def __init__(self, connection):
+
+		self.connection = connection
+
+
+	def write(self, data):
+
+		self.connection.client_sent(data)
+
+
+	async def drain(self):
+
+		pass
+
+
+	def is_closing(self):
+
+		return self.connection.client_closed
+
+
+	def close(self):
+
+		self.connection.close_client()
+
+
+	async def wait_closed(self):
+
+		pass
+
+
+class SimulatedConnection():
+	"""A connection between the scanner and a simulated server. Bytes sent by
+	the server reach the client after a delay, in the order they were sent."""
+
+
+	def __init__(self, loop):
+
+		self.loop = loop
+
+		self.client_reader = asyncio.StreamReader()
+		self.server_reader = asyncio.StreamReader()
+
+		self.client_closed = False
+		self.server_closed = False
+
+		# Bytes sent by the server and when they arrive, with None for the end
+		self.pending = deque()
+		self.arrival = loop.time()
+
+
+	def client_sent(self, data):
+
+		if not self.server_closed:
+			self.server_reader.feed_data(data)
+
+
+	def close_client(self):
+
+		if not self.client_closed:
+			self.client_closed = True
+			if not self.server_closed:
+				self.server_reader.feed_eof()
+
+
+	def send(self, data, delay=0):
+
+		if not self.server_closed:
+
+			self.arrival = max(self.arrival, self.loop.time() + delay)
+			self.pending.append((self.arrival, data))
+
+			if len(self.pending) == 1:
+				self.loop.call_at(self.arrival, self.deliver)
+
+
+	def close(self):
+
+		if not self.server_closed:
+			self.send(None)
+			self.server_closed = True
+
+
+	def deliver(self):
+
+		# Timers due at the same time may run in any order, so deliver in
+		# the order the bytes were sent
+		while len(self.pending) > 0 and self.pending[0][0] <= self.loop.time():
+			arrival, data = self.pending.popleft()
+			if data is None:
+				self.client_reader.feed_eof()
+			else:
+				self.client_reader.feed_data(data)
+
+		if len(self.pending) > 0:
+			self.loop.call_at(self.pending[0][0], self.deliver)
+
+
+class SimulatedServer():
+	"""A server on the simulated network.
+
+	Mayors save their cities at random, so the region files, and with them
+	the stats the scanner computes, change over time. `behaviour` is one of
+	`SIMULATION_BEHAVIOURS`: "down" servers refuse connections until they
+	recover, "blackhole" servers never answer, and "flaky" servers drop a
+	fraction of their connections."""
+
+
+	def __init__(self, network, index, rng, behaviour, legacy, keep_alive, rtt, saves_per_hour,
+			recovers_at=None, flaky_rate=0, regions=2, region_size=8, bandwidth=1e6):
+
+		self.network = network
+		self.index = index
+		self.rng = rng
+
+		self.address = (f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}", SIMULATION_PORT)
+		self.server_id = f"sim{index:06d}"
+		self.behaviour = behaviour
+		self.legacy = legacy
+		self.keep_alive = keep_alive
+		self.rtt = rtt
+		self.recovers_at = recovers_at
+		self.flaky_rate = flaky_rate
+		self.bandwidth = bandwidth
+		self.peers = []
+
+		self.region_size = region_size
+		self.mayors = [f"user{rng.randrange(1000)}" for _ in range(rng.randint(1, 8))]
+
+		# Owner of the claimed city at each coordinate of each region, and when
+		# it was saved, formatted once rather than every time the files are
+		# rebuilt. Tuples, unlike lists, aren't tracked by the garbage collector
+		self.regions = [dict() for _ in range(regions)]
+		for region in self.regions:
+			for x in range(region_size):
+				for y in range(region_size):
+					if rng.random() < .3:
+						owner = rng.choice(self.mayors)
+						region[(x, y)] = (owner, timestamp(network.clock.now - rng.uniform(3600, 30 * 86400)))
+
+		self.saves_per_hour = saves_per_hour
+		self.next_save = self.schedule_save(network.clock.now)
+
+		self.files = None
+
+
+	def schedule_save(self, t):
+
+		if self.saves_per_hour <= 0:
+			return math.inf
+
+		return t + self.rng.expovariate(self.saves_per_hour / 3600)
+
+
+	def update(self):
+		"""Applies the saves made since the last request."""
+
+		now = self.network.clock.now
+
+		while self.next_save <= now:
+			region = self.rng.choice(self.regions)
+			coords = (self.rng.randrange(self.region_size), self.rng.randrange(self.region_size))
+			region[coords] = (self.rng.choice(self.mayors), timestamp(self.next_save))
+			self.next_save = self.schedule_save(self.next_save)
+			self.files = None
+
+		if self.files is None:
+			self.files = dict()
+			for index, region in enumerate(self.regions):
+				database = {
+					f"{x}_{y}": {"owner": owner, "size": 1, "modified": modified}
+					for (x, y), (owner, modified) in region.items()
+				}
+				self.files[f"Region{index}/config.bmp"] = bitmap(self.region_size, self.region_size)
+				self.files[f"Region{index}/_Database/region.json"] = json.dumps(database).encode()
+			self.table = [(hashlib.md5(data).hexdigest(), len(data), path) for path, data in self.files.items()]
+			self.table += [
+				("0" * 32, 1 << 20, f"Region{index}/City {x}-{y}.sc4")
+				for index, region in enumerate(self.regions) for x, y in region.keys()
+			]
+
+
+	def info(self):
+
+		return {
+			"server_id": self.server_id,
+			"server_name": f"Simulated server {self.index}",
+			"server_description": "",
+			"server_url": "",
+			"server_version": "0.8.0" if self.legacy else "0.9.0",
+			"private": False,
+			"password_enabled": False,
+			"user_plugins_enabled": False
+		}
+
+
+	def delay(self, size=0):
+		"""Returns the time a response of `size` bytes takes to arrive."""
+
+		return self.rtt * self.rng.lognormvariate(0, .25) + size / self.bandwidth
+
+
+	def is_up(self):
+
+		if self.behaviour == "down":
+			return self.recovers_at is not None and self.network.clock.now >= self.recovers_at
+
+		return True
+
+
+	async def connect(self):
+		"""Returns the client end of a new connection, or raises like a real connect."""
+
+		self.network.connections += 1
+
+		if self.behaviour == "blackhole":
+			# The scanner's timeout gives up on it
+			await asyncio.sleep(1e9)
+
+		await asyncio.sleep(self.delay())
+
+		if not self.is_up():
+			raise ConnectionRefusedError(111, "Connection refused")
+
+		connection = SimulatedConnection(asyncio.get_running_loop())
+
+		if self.behaviour == "flaky" and self.rng.random() < self.flaky_rate:
+			connection.close()
+		elif self.legacy:
+			self.network.serve(self.handle_legacy(connection))
+		else:
+			self.network.serve(self.handle_message(connection))
+
+		return connection.client_reader, SimulatedWriter(connection)
+
+
+	def send(self, connection, data):
+
+		self.network.bytes_sent += len(data)
+
+		connection.send(data, self.delay(len(data)))
+
+
+	def send_json(self, connection, data):
+
+		data = json.dumps(data).encode()
+
+		self.send(connection, struct.pack("I", len(data)) + data)
+
+
+	async def recv_json(self, connection):
+
+		size = struct.unpack("I", await connection.server_reader.readexactly(4))[0]
+
+		return json.loads(await connection.server_reader.readexactly(size))
+
+
+	def send_files(self, connection, file_table):
+
+		for checksum, size, path in file_table:
+			self.send(connection, self.files[path])
+
+
+	async def handle_message(self, connection):
+
+		try:
+
+			keep_alive = False
+			previous = None
+
+			while True:
+
+				header = await connection.server_reader.readexactly(16)
+				command = header[8:14].rstrip(b"\x00").decode()
+				size = struct.unpack("H", header[14:16])[0]
+				headers = json.loads(await connection.server_reader.readexactly(size))
+
+				keep_alive = self.keep_alive and headers.get(HEADER_KEEP_ALIVE, False)
+
+				response = {HEADER_KEEP_ALIVE: True} if keep_alive else {}
+
+				self.update()
+
+				if command == COMMAND_INFO:
+					response.update(self.info())
+					self.send(connection, encode_message(False, command, response))
+				elif command == COMMAND_TIME:
+					response["time"] = timestamp(self.network.clock.now)
+					self.send(connection, encode_message(False, command, response))
+				elif command == COMMAND_SERVER_LIST:
+					self.send(connection, encode_message(False, command, response))
+					self.send_json(connection, [list(peer) for peer in self.peers])
+				elif command == COMMAND_PLUGINS_TABLE:
+					self.send(connection, encode_message(False, command, response))
+					self.send_json(connection, [["0" * 32, 1 << 20, f"Plugins/plugin{index}.dat"] for index in range(4)])
+				elif command == COMMAND_REGIONS_TABLE:
+					self.send(connection, encode_message(False, command, response))
+					self.send_json(connection, self.table)
+				elif command in [COMMAND_PLUGINS_DATA, COMMAND_REGIONS_DATA]:
+					self.send(connection, encode_message(False, command, response))
+					self.send_files(connection, await self.recv_json(connection))
+				else:
+					return
+
+				# Servers without keep-alive still answer the data command
+				# that follows a file table on the same connection
+				if not keep_alive and previous is not None:
+					return
+				if not keep_alive and command not in [COMMAND_PLUGINS_TABLE, COMMAND_REGIONS_TABLE]:
+					return
+				previous = command
+
+		except (asyncio.IncompleteReadError, ValueError):
+
+			pass
+
+		finally:
+
+			connection.close()
+
+
+	async def handle_legacy(self, connection):
+
+		try:
+
+			request = (await connection.server_reader.read(4096)).decode(errors="replace")
+
+			self.update()
+
+			if request == "server_id":
+				self.send(connection, self.server_id.encode())
+			elif request == "server_version":
+				self.send(connection, b"0.8.0")
+			elif request == "server_list":
+				self.send_json(connection, [list(peer) for peer in self.peers])
+			elif request == "info":
+				self.send_json(connection, self.info())
+			elif request == "time":
+				self.send(connection, timestamp(self.network.clock.now).encode())
+			elif request == "regions":
+				self.send_json(connection, self.table)
+				self.send_files(connection, await self.recv_json(connection))
+			elif request == "plugins":
+				self.send_json(connection, [])
+				await self.recv_json(connection)
+
+		except (asyncio.IncompleteReadError, ValueError):
+
+			pass
+
+		finally:
+
+			connection.close()
+
+
+class SimulatedNetwork():
+	"""A network of `size` servers, each listing `peers` random others and
+	its successor, so every server can be discovered from the first.
+
+	Round trip times are log-normal around `rtt`. The rates are the fractions
+	of servers that are down (recovering after `recover_after` seconds on
+	average, if ever), blackholed or flaky, and that speak the legacy
+	protocol or keep connections alive."""
+
+
+	def __init__(self, clock, size, seed=0, peers=20, rtt=.1, down_rate=.05, recover_rate=.5,
+			recover_after=6 * 3600, blackhole_rate=.02, flaky_rate=.05, flaky_drop=.3,
+			legacy_rate=.2, keep_alive_rate=.5, active_rate=.2, saves_per_hour=6, **options):
+
+		self.clock = clock
+		self.connections = 0
+		self.bytes_sent = 0
+
+		# The event loop only keeps weak references to tasks
+		self.handlers = set()
+
+		rng = random.Random(seed)
+
+		self.servers = []
+		for index in range(size):
+
+			roll = rng.random()
+			if roll < down_rate:
+				behaviour = "down"
+			elif roll < down_rate + blackhole_rate:
+				behaviour = "blackhole"
+			elif roll < down_rate + blackhole_rate + flaky_rate:
+				behaviour = "flaky"
+			else:
+				behaviour = "ok"
+
+			# The first server stays up so the scanner has a way in
+			if index == 0:
+				behaviour = "ok"
+
+			recovers_at = None
+			if behaviour == "down" and rng.random() < recover_rate:
+				recovers_at = clock.now + rng.expovariate(1 / recover_after)
+
+			self.servers.append(SimulatedServer(
+				self, index, random.Random(rng.random()),
+				behaviour=behaviour,
+				legacy=rng.random() < legacy_rate,
+				keep_alive=rng.random() < keep_alive_rate,
+				rtt=rtt * rng.lognormvariate(0, .8),
+				saves_per_hour=saves_per_hour * rng.expovariate(1) if rng.random() < active_rate else 0,
+				recovers_at=recovers_at,
+				flaky_rate=flaky_drop,
+				**options
+			))
+
+		for index, server in enumerate(self.servers):
+			listed = set(rng.sample(range(size), min(peers, size)))
+			listed.add((index + 1) % size)
+			server.peers = [self.servers[peer].address for peer in sorted(listed)]
+
+		self.addresses = {server.address: server for server in self.servers}
+
+
+	def seeds(self):
+
+		return [self.servers[0].address]
+
+
+	def serve(self, handler):
+
+		task = asyncio.ensure_future(handler)
+		self.handlers.add(task)
+		task.add_done_callback(self.handlers.discard)
+
+
+	async def connect(self, host, port):
+
+		server = self.addresses.get((host, port))
+
+		if server is None:
+			raise ConnectionRefusedError(111, "Connection refused")
+
+		return await server.connect()
+
+
+class Simulation():
+	"""Runs an `AsyncScanner` over a `SimulatedNetwork` for `duration`
+	virtual seconds, recording every sweep, publish and fetch. A sweep lasts
+	from the first fetch after the scanner was idle until it is idle again."""
+
+
+	def __init__(self, api, network, duration, max_fetchers=1000, publish_interval=None, fetch_timeout=None):
+
+		self.api = api
+		self.network = network
+		self.clock = network.clock
+		self.duration = duration
+		self.max_fetchers = max_fetchers
+		self.publish_interval = api.SC4MP_PUBLISH_INTERVAL if publish_interval is None else publish_interval
+		self.fetch_timeout = api.SC4MP_FETCH_TIMEOUT if fetch_timeout is None else fetch_timeout
+
+		self.sweeps = []
+		self.publishes = 0
+		self.unpublished = dict()
+		self.publish_latency = []
+		self.successes = 0
+		self.failures = dict()
+		self.last_success = dict()
+		self.first_success = dict()
+		self.max_in_flight = 0
+
+
+	def scanner(self):
+
+		api = self.api
+
+		api.SC4MP_SERVERS[:] = self.network.seeds()
+
+		scanner = api.AsyncScanner(max_fetchers=self.max_fetchers, publish_interval=self.publish_interval)
+		scanner.FETCH_TIMEOUT = self.fetch_timeout
+		for table in [scanner.protocols, scanner.schedule, scanner.health, scanner.stat_history]:
+			table.clock = self.clock.time
+
+		publish = scanner.publish
+		sweep_finished = scanner.sweep_finished
+		fetch_succeeded = scanner.fetch_succeeded
+		fetch_failed = scanner.fetch_failed
+		sweep = {"fetched": 0, "failed": 0}
+
+		def record_publish():
+			publish()
+			self.publishes += 1
+			for refreshed in self.unpublished.values():
+				self.publish_latency.append(self.clock.now - refreshed)
+			self.unpublished.clear()
+
+		def record_sweep():
+			nonlocal sweep
+			seconds = scanner.now() - scanner.sweep_started
+			sweep.update({
+				"started": self.clock.now - seconds,
+				"finished": self.clock.now,
+				"seconds": seconds
+			})
+			sweep_finished()
+			sweep["servers"] = len(scanner.servers)
+			self.sweeps.append(sweep)
+			sweep = {"fetched": 0, "failed": 0}
+
+		def record_success(server, server_id, entry):
+			fetch_succeeded(server, server_id, entry)
+			self.successes += 1
+			sweep["fetched"] += 1
+			self.last_success[server] = self.clock.now
+			self.unpublished.setdefault(server, self.clock.now)
+			self.first_success.setdefault(server, self.clock.now)
+			self.max_in_flight = max(self.max_in_flight, scanner.in_flight)
+
+		def record_failure(server, e):
+			fetch_failed(server, e)
+			category = api.error_category(e)
+			self.failures[category] = self.failures.get(category, 0) + 1
+			sweep["failed"] += 1
+
+		scanner.publish = record_publish
+		scanner.sweep_finished = record_sweep
+		scanner.fetch_succeeded = record_success
+		scanner.fetch_failed = record_failure
+
+		return scanner
+
+
+	def run(self):
+
+		loop = VirtualEventLoop(self.clock)
+		asyncio.set_event_loop(loop)
+		networking.connector = self.network.connect
+
+		start = time.perf_counter()
+		started = self.clock.now
+
+		try:
+
+			scanner = self.scanner()
+			loop.call_later(self.duration, scanner.stop)
+			loop.run_until_complete(scanner.run_async())
+
+			# Drop the fetchers and simulated servers still running, including
+			# servers answering the connections closed by cancelling fetchers
+			while True:
+				tasks = asyncio.all_tasks(loop)
+				if len(tasks) == 0:
+					break
+				for task in tasks:
+					task.cancel()
+				loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+		finally:
+
+			networking.connector = None
+			asyncio.set_event_loop(None)
+			loop.close()
+
+		return self.results(scanner, time.perf_counter() - start, self.clock.now - started)
+
+
+	def results(self, scanner, wall, virtual):
+
+		now = self.clock.now
+		servers = self.network.servers
+
+		# Age of the data of every reachable server at the end
+		staleness = [
+			now - self.last_success.get(server.address, self.clock.now - virtual)
+			for server in servers if server.behaviour in ["ok", "flaky"]
+		]
+
+		# How long recovered servers went unnoticed
+		detection = [
+			self.first_success[server.address] - server.recovers_at
+			for server in servers
+			if server.recovers_at is not None and server.address in self.first_success
+		]
+		undetected = sum(
+			1 for server in servers
+			if server.recovers_at is not None and server.recovers_at < now and server.address not in self.first_success
+		)
+
+		sweeps = [sweep["seconds"] for sweep in self.sweeps]
+
+		return {
+			"servers": len(servers),
+			"wall_seconds": wall,
+			"virtual_seconds": virtual,
+			"speedup": virtual / wall if wall > 0 else None,
+			"sweeps": len(self.sweeps),
+			"sweep_seconds_mean": sum(sweeps) / len(sweeps) if sweeps else None,
+			"sweep_seconds_max": max(sweeps) if sweeps else None,
+			"publishes": self.publishes,
+			"publish_latency_mean": sum(self.publish_latency) / len(self.publish_latency) if self.publish_latency else None,
+			"publish_latency_p95": percentile(self.publish_latency, .95),
+			"publish_latency_max": max(self.publish_latency) if self.publish_latency else None,
+			"published": len(scanner.servers),
+			"fetches": self.successes + sum(self.failures.values()),
+			"successes": self.successes,
+			"failures": self.failures,
+			"connections": self.network.connections,
+			"bytes": self.network.bytes_sent,
+			"max_in_flight": self.max_in_flight,
+			"staleness_mean": sum(staleness) / len(staleness) if staleness else None,
+			"staleness_p95": percentile(staleness, .95),
+			"recovery_detection_mean": sum(detection) / len(detection) if detection else None,
+			"recovery_detection_p95": percentile(detection, .95),
+			"recoveries_undetected": undetected,
+			"peak_rss_bytes": peak_rss(),
+			"history": self.sweeps
+		}
+
+
+def parse_args():
+
+	parser = ArgumentParser(description=__doc__.splitlines()[0])
+
+	parser.add_argument("--servers", type=int, default=1000, help="number of simulated servers")
+	parser.add_argument("--hours", type=float, default=6, help="virtual time to simulate")
+	parser.add_argument("--max-fetchers", type=int, default=1000, help="fetchers in flight")
+	parser.add_argument("--publish-interval", type=float, default=None, help="seconds between publishes (default: the scanner's)")
+	parser.add_argument("--fetch-timeout", type=float, default=None, help="scanner timeout per connection (default: the scanner's)")
+	parser.add_argument("--peers", type=int, default=20, help="servers in each server list")
+	parser.add_argument("--rtt", type=float, default=.1, help="median round trip time, in seconds")
+	parser.add_argument("--down-rate", type=float, default=.05, help="fraction of servers refusing connections")
+	parser.add_argument("--recover-rate", type=float, default=.5, help="fraction of down servers that come back")
+	parser.add_argument("--recover-after", type=float, default=6 * 3600, help="mean time until they do, in seconds")
+	parser.add_argument("--blackhole-rate", type=float, default=.02, help="fraction of servers that never answer")
+	parser.add_argument("--flaky-rate", type=float, default=.05, help="fraction of servers dropping connections")
+	parser.add_argument("--flaky-drop", type=float, default=.3, help="fraction of connections they drop")
+	parser.add_argument("--legacy-rate", type=float, default=.2, help="fraction of servers on the v0.8 protocol")
+	parser.add_argument("--keep-alive-rate", type=float, default=.5, help="fraction of servers keeping connections alive")
+	parser.add_argument("--active-rate", type=float, default=.2, help="fraction of servers with mayors playing")
+	parser.add_argument("--saves-per-hour", type=float, default=6, help="mean saves per hour on those servers")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+
+	return parser.parse_args()
+
+
+def main():
+
+	args = parse_args()
+
+	api = load_api()
+
+	random.seed(args.seed)
+
+	clock = VirtualClock()
+	network = SimulatedNetwork(
+		clock,
+		args.servers,
+		seed=args.seed,
+		peers=args.peers,
+		rtt=args.rtt,
+		down_rate=args.down_rate,
+		recover_rate=args.recover_rate,
+		recover_after=args.recover_after,
+		blackhole_rate=args.blackhole_rate,
+		flaky_rate=args.flaky_rate,
+		flaky_drop=args.flaky_drop,
+		legacy_rate=args.legacy_rate,
+		keep_alive_rate=args.keep_alive_rate,
+		active_rate=args.active_rate,
+		saves_per_hour=args.saves_per_hour
+	)
+
+	print(f"Simulating {args.hours} hours of scanning {len(network.servers)} servers...")
+
+	simulation = Simulation(
+		api, network, args.hours * 3600,
+		max_fetchers=args.max_fetchers,
+		publish_interval=args.publish_interval,
+		fetch_timeout=args.fetch_timeout
+	)
+
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		results = simulation.run()
+
+	print(f"  {results['virtual_seconds']:.0f} virtual seconds in {results['wall_seconds']:.1f}s ({results['speedup']:.0f}x)")
+	print(f"  {results['sweeps']} sweeps, {results['sweep_seconds_mean'] or 0:.1f}s mean, {results['sweep_seconds_max'] or 0:.1f}s max")
+	print(
+		f"  {results['publishes']} publishes, refreshes published after {results['publish_latency_mean'] or 0:.1f}s mean, "
+		f"{results['publish_latency_p95'] or 0:.1f}s p95, {results['publish_latency_max'] or 0:.1f}s max"
+	)
+	print(f"  {results['published']} servers published, {results['fetches']} fetches, {results['connections']} connections")
+	print(f"  failures: {results['failures']}")
+	print(f"  staleness: {results['staleness_mean'] or 0:.0f}s mean, {results['staleness_p95'] or 0:.0f}s p95")
+	print(
+		f"  recoveries noticed after {results['recovery_detection_mean'] or 0:.0f}s mean, "
+		f"{results['recovery_detection_p95'] or 0:.0f}s p95, {results['recoveries_undetected']} unnoticed"
+	)
+
+	if args.output:
+		with open(args.output, "w") as file:
+			json.dump({"args": vars(args), "results": results}, file, indent=4)
+		print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+	main()
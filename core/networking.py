@@ -1,11 +1,14 @@
+import asyncio
 import errno
 import socket
 import json
 import struct
 import hashlib
+import time
+from contextlib import nullcontext
 from datetime import datetime
 from typing import Optional, Any, Type
-from threading import Thread
+from threading import Lock, Thread
 
 
 BUFFER_SIZE = 4096
@@ -32,6 +35,29 @@ COMMAND_TOKEN = 'Token'
 COMMAND_TIME = 'Time'
 COMMAND_LOADING_BACKGROUND = 'LdgBkg'
 
+HEADER_KEEP_ALIVE = 'keep_alive'
+
+# Set by applications to trace connections and requests: a callable taking
+# a span name and returning a context manager. None disables tracing.
+tracer = None
+
+_NULL_SPAN = nullcontext()
+
+# Set by simulations to connect `AsyncClientSocket` to something other than
+# the network: a coroutine function taking a host and port and returning a
+# stream reader/writer pair. None uses `asyncio.open_connection`.
+connector = None
+
+# Set by applications to record the conversations of client sockets: a
+# `Transcript` every new connection writes its traffic to. None disables
+# recording.
+recorder = None
+
+# Set by replays to connect client sockets somewhere else: a callable taking
+# an address and returning the address to connect to. None connects to the
+# address as given.
+resolver = None
+
 
 def send_json(s: socket.socket, data, length_encoding="I"):
 
@@ -93,31 +119,34 @@ def recv_exact(s: socket.socket, length: int) -> bytes:
 	return bytes(data)
 	
 
-def send_message(s: socket.socket, is_request=True, command="Ping", headers=None):
+def encode_message(is_request=True, command="Ping", headers=None) -> bytes:
 
-	try:
+	if headers is None:
+		headers = {}
 
-		if headers is None:
-			headers = {}
+	m = MESSAGE_PROTOCOL
+	if is_request:
+		m += MESSAGE_TYPE_REQUEST
+	else:
+		m += MESSAGE_TYPE_RESPONSE
+	m += command
 
-		m = MESSAGE_PROTOCOL
-		if is_request:
-			m += MESSAGE_TYPE_REQUEST
-		else:
-			m += MESSAGE_TYPE_RESPONSE
-		m += command
+	message = m.encode('ascii')
+
+	while len(message) < 14:
+		message += b"\x00"
 
-		message = m.encode('ascii')
+	h = json.dumps(headers).encode()
+	l = struct.pack("H", len(h))
 
-		while len(message) < 14:
-			message += b"\x00"
+	return message + l + h
 
-		h = json.dumps(headers).encode()
-		l = struct.pack("H", len(h))
 
-		message += l + h
+def send_message(s: socket.socket, is_request=True, command="Ping", headers=None):
+
+	try:
 
-		s.sendall(message)
+		s.sendall(encode_message(is_request, command, headers))
 
 	except NetworkException as e:
 		raise e
@@ -256,6 +285,15 @@ def recv_files(s: socket.socket, file_table):
 		yield checksum, filesize, relpath, _recv_file()
 
 
+def trace(name: str):
+	"""Returns a context manager timing `name` with `tracer`, or a no-op
+	one if tracing is disabled."""
+
+	if tracer is None:
+		return _NULL_SPAN
+	return tracer(name)
+
+
 def interpret_socket_error(e: BaseException) -> str:
     """
     Inspect a socket-related exception and return a human-readable description
@@ -345,6 +383,10 @@ class Socket(socket.socket):
 
 		self.headers = {}
 
+		# Set once connected, if recording
+		self.transcript = None
+		self.connection = None
+
 		if s:
 
 			super().__init__(s.family, s.type, s.proto, socket.dup(s.fileno()))
@@ -360,6 +402,49 @@ class Socket(socket.socket):
 		self.headers.update(headers)
 
 
+	def connect(self, address):
+
+		super().connect(address if resolver is None else resolver(address))
+
+		if recorder is not None:
+			self.transcript = recorder
+			self.connection = recorder.open(address)
+
+			# Only recording sockets pay for recording
+			self.send = self._record_send
+			self.sendall = self._record_sendall
+			self.recv = self._record_recv
+
+
+	def close(self):
+
+		if self.connection is not None:
+			self.transcript.close(self.connection)
+			self.connection = None
+
+		super().close()
+
+
+	def _record_send(self, data, *args):
+
+		size = super().send(data, *args)
+		self.transcript.sent(self.connection, data[:size])
+		return size
+
+
+	def _record_sendall(self, data, *args):
+
+		super().sendall(data, *args)
+		self.transcript.sent(self.connection, data)
+
+
+	def _record_recv(self, size, *args):
+
+		data = super().recv(size, *args)
+		self.transcript.received(self.connection, data)
+		return data
+
+
 	def send_json(self, data, length_encoding="I"):
 
 		send_json(self, data, length_encoding)
@@ -403,19 +488,38 @@ class Socket(socket.socket):
 class ClientSocket(Socket):
 
 	
-	def __init__(self, address=None, timeout=10, **options):
+	def __init__(self, address=None, timeout=10, keep_alive=False, **options):
 
 		super().__init__(**options)
 
 		self.settimeout(timeout)
 
+		# Whether to ask the server to keep the connection open, and whether
+		# the server agreed to (known after the first response)
+		self.request_keep_alive = keep_alive
+		self.keep_alive = False
+
 		try:
 			if address:
-				self.connect(address)
+				with trace("connect"):
+					self.connect(address)
 		except Exception as e:
 			raise NetworkException(e) from e
 
 
+	def request(self, command, **headers):
+
+		if self.request_keep_alive:
+			headers.setdefault(HEADER_KEEP_ALIVE, True)
+
+		with trace(command):
+			response = super().request(command, **headers)
+
+		self.keep_alive = bool(response.get(HEADER_KEEP_ALIVE, False))
+
+		return response
+
+
 	def add_server(self, host, port, **headers) -> bool:
 
 		return is_success(
@@ -581,6 +685,474 @@ class ClientSocket(Socket):
 
 		return pluck_header(headers, 'result', str)
 
+
+class AsyncClientSocket:
+	"""Asyncio counterpart of `ClientSocket` built on stream reader/writer
+	pairs, so many servers can be queried concurrently on one event loop.
+
+	The timeout applies to each read and write, matching the behavior of
+	`socket.settimeout` on a blocking `ClientSocket`."""
+
+
+	def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout=10, keep_alive=False):
+
+		self.reader = reader
+		self.writer = writer
+		self.timeout = timeout
+
+		self.headers = {}
+
+		self.request_keep_alive = keep_alive
+		self.keep_alive = False
+
+		# Set by `open`, if recording
+		self.transcript = None
+		self.connection = None
+
+		# Timeout of the current read or write, see `_wait`
+		self.deadline = None
+		self.waiter = None
+		self.timer = None
+		self.expired = False
+
+
+	@classmethod
+	async def open(cls, address, timeout=10, keep_alive=False):
+		"""Opens a connection, raising socket errors as they are."""
+
+		host, port = address if resolver is None else resolver(address)
+
+		s = cls(None, None, timeout, keep_alive)
+
+		with trace("connect"):
+			s.reader, s.writer = await s._wait((connector or asyncio.open_connection)(host, port))
+
+		if recorder is not None:
+			s.transcript = recorder
+			s.connection = recorder.open(address)
+
+		return s
+
+
+	@classmethod
+	async def connect(cls, address, timeout=10, keep_alive=False):
+		"""Opens a connection, raising socket errors as `NetworkException`,
+		like `ClientSocket`."""
+
+		try:
+			return await cls.open(address, timeout, keep_alive)
+		except Exception as e:
+			raise NetworkException(e) from e
+
+
+	async def __aenter__(self):
+
+		return self
+
+
+	async def __aexit__(self, *args):
+
+		await self.close()
+
+
+	async def close(self):
+
+		if self.connection is not None:
+			self.transcript.close(self.connection)
+			self.connection = None
+
+		self.writer.close()
+
+		try:
+			await self._wait(self.writer.wait_closed())
+		except Exception:
+			pass
+
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+
+
+	def set_headers(self, **headers):
+
+		self.headers.update(headers)
+
+
+	async def _wait(self, aw):
+		"""Awaits `aw`, raising `socket.timeout` after `self.timeout` seconds.
+
+		`asyncio.wait_for` would add a timer and a task to every read. This
+		keeps one timer per connection instead, which cancels the waiting
+		task at the deadline of the current read, or is pushed back to it."""
+
+		loop = asyncio.get_running_loop()
+
+		self.deadline = loop.time() + self.timeout
+		self.waiter = asyncio.current_task()
+		if self.timer is None:
+			self.timer = loop.call_at(self.deadline, self._expire)
+
+		try:
+			return await aw
+		except asyncio.CancelledError:
+			if not self.expired:
+				raise
+			self.expired = False
+			# Python 3.11+ counts cancellations, for `asyncio.timeout`
+			if hasattr(self.waiter, "uncancel"):
+				self.waiter.uncancel()
+			raise socket.timeout("timed out") from None
+		finally:
+			self.waiter = None
+
+
+	def _expire(self):
+
+		self.timer = None
+
+		# Nothing is waiting, the next read starts a new timer
+		if self.waiter is None:
+			return
+
+		loop = asyncio.get_running_loop()
+
+		if loop.time() < self.deadline:
+			self.timer = loop.call_at(self.deadline, self._expire)
+		else:
+			self.expired = True
+			self.waiter.cancel()
+
+
+	async def send(self, data: bytes):
+
+		self.writer.write(data)
+
+		if self.connection is not None:
+			self.transcript.sent(self.connection, data)
+
+		await self._wait(self.writer.drain())
+
+
+	async def recv(self, size: int) -> bytes:
+
+		data = await self._wait(self.reader.read(size))
+
+		if self.connection is not None:
+			self.transcript.received(self.connection, data)
+
+		return data
+
+
+	async def recv_exact(self, length: int) -> bytes:
+
+		try:
+			data = await self._wait(self.reader.readexactly(length))
+		except asyncio.IncompleteReadError as e:
+			if self.connection is not None:
+				self.transcript.received(self.connection, e.partial)
+				self.transcript.received(self.connection, b"")
+			raise ConnectionClosedException() from e
+
+		if self.connection is not None:
+			self.transcript.received(self.connection, data)
+
+		return data
+
+
+	async def send_json(self, data, length_encoding="I"):
+
+		if data is None:
+			data = {}
+
+		data = json.dumps(data).encode()
+
+		await self.send(struct.pack(length_encoding, len(data)) + data)
+
+
+	async def recv_json(self, length_encoding="I"):
+
+		length_header = await self.recv_exact(struct.calcsize(length_encoding))
+
+		data_size = struct.unpack(length_encoding, length_header)[0]
+
+		data = await self.recv_exact(data_size)
+
+		if len(data) < 1:
+			raise NetworkException('No data received.')
+
+		return json.loads(data.decode())
+
+
+	async def send_message(self, is_request=True, command="Ping", headers=None):
+
+		try:
+			await self.send(encode_message(is_request, command, headers))
+		except NetworkException:
+			raise
+		except Exception as e:
+			raise NetworkException(e) from e
+
+
+	async def recv_message(self):
+
+		try:
+
+			p = (await self.recv_exact(5)).decode('ascii')
+			if p != MESSAGE_PROTOCOL:
+				raise NetworkException(
+					f"Expected {MESSAGE_PROTOCOL!r}, but received {p!r}."
+				)
+
+			t = (await self.recv_exact(3)).rstrip(b"\x00").decode('ascii')
+			if t == MESSAGE_TYPE_REQUEST:
+				is_request = True
+			elif t == MESSAGE_TYPE_RESPONSE:
+				is_request = False
+			else:
+				raise NetworkException(
+					f"Expected message type {MESSAGE_TYPE_REQUEST!r} or "
+					f"{MESSAGE_TYPE_RESPONSE!r} but received {t!r}."
+				)
+
+			command = (await self.recv_exact(6)).rstrip(b"\x00").decode('ascii')
+
+			l = struct.unpack("H", await self.recv_exact(2))[0]
+
+			headers = json.loads((await self.recv_exact(l)).decode())
+
+		except NetworkException:
+			raise
+		except Exception as e:
+			raise NetworkException(e) from e
+
+		return is_request, command, headers
+
+
+	async def request(self, command, **headers) -> dict:
+
+		if self.request_keep_alive:
+			headers.setdefault(HEADER_KEEP_ALIVE, True)
+
+		with trace(command):
+			await self.send_message(True, command, {**self.headers, **headers})
+			is_request, c, h = await self.recv_message()
+
+		if is_request:
+			raise NetworkException(
+				"Expected response message but received request message."
+			)
+
+		if c != command:
+			raise NetworkException(
+				f"Expected command {command!r} but received {c!r}."
+			)
+
+		if error := h.get('error'):
+			raise NetworkException(error)
+
+		self.keep_alive = bool(h.get(HEADER_KEEP_ALIVE, False))
+
+		return h
+
+
+	async def recv_files(self, file_table):
+
+		for checksum, filesize, relpath in file_table:
+
+			async def _recv_file():
+
+				filesize_read: int = 0
+				checksummer = hashlib.md5()
+
+				while filesize_read < filesize:
+
+					buffersize = min(filesize - filesize_read, BUFFER_SIZE)
+
+					chunk = await self.recv(buffersize)
+
+					if not chunk:
+						raise ConnectionClosedException()
+
+					filesize_read += len(chunk)
+					checksummer.update(chunk)
+
+					yield chunk
+
+				checksum_actual = checksummer.hexdigest()
+				if checksum != checksum_actual:
+					raise NetworkException(
+						f"Checksum mismatch for {relpath!r}: "
+						f"expected {checksum!r}, got {checksum_actual!r}."
+					)
+
+			yield checksum, filesize, relpath, _recv_file()
+
+
+	async def info(self, **headers) -> dict:
+
+		return await self.request(COMMAND_INFO, **headers)
+
+
+	async def ping(self, **headers) -> dict:
+
+		return await self.request(COMMAND_PING, **headers)
+
+
+	async def file_table(self, target, **headers) -> list:
+
+		if target == 'plugins':
+			await self.request(COMMAND_PLUGINS_TABLE, **headers)
+		elif target == 'regions':
+			await self.request(COMMAND_REGIONS_TABLE, **headers)
+		else:
+			raise ValueError(f"Invalid target: {target!r}")
+
+		return await self.recv_json()
+
+
+	async def file_table_data(self, target, file_table, **headers):
+
+		if target == 'plugins':
+			command = COMMAND_PLUGINS_DATA
+		elif target == 'regions':
+			command = COMMAND_REGIONS_DATA
+		else:
+			raise ValueError(f"Invalid target: {target!r}")
+
+		if not file_table:
+			return
+
+		await self.request(command, **headers)
+		await self.send_json(file_table)
+
+		async for entry in self.recv_files(file_table):
+			yield entry
+
+
+	async def time(self, **headers):
+
+		response = await self.request(COMMAND_TIME, **headers)
+
+		time = pluck_header(response, 'time', str)
+
+		return datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
+
+
+	async def server_list(self, **headers):
+
+		await self.request(COMMAND_SERVER_LIST, **headers)
+
+		return await self.recv_json()
+
+
+class ClientSession:
+	"""Runs many commands against one server over a single keep-alive
+	`ClientSocket`.
+
+	The first connection asks the server to keep it open. Servers that don't
+	acknowledge the `keep_alive` header close the connection after each
+	command, so the session falls back to a new connection for every call to
+	`socket()`. A streamed response (e.g. `file_table_data`) must be consumed
+	before the next command is sent."""
+
+
+	def __init__(self, address, timeout=10):
+
+		self.address = address
+		self.timeout = timeout
+
+		self._socket: Optional[ClientSocket] = None
+
+
+	def __enter__(self):
+
+		return self
+
+
+	def __exit__(self, *args):
+
+		self.close()
+
+
+	@property
+	def keep_alive(self) -> bool:
+
+		return self._socket is not None and self._socket.keep_alive
+
+
+	def socket(self) -> ClientSocket:
+		"""Returns the open connection if the server keeps it alive, or a new
+		connection otherwise."""
+
+		if self.keep_alive:
+			return self._socket
+
+		self.close()
+
+		self._socket = ClientSocket(self.address, self.timeout, keep_alive=True)
+
+		return self._socket
+
+
+	def close(self):
+
+		if self._socket is not None:
+			try:
+				self._socket.close()
+			except Exception:
+				pass
+			self._socket = None
+
+
+class AsyncClientSession:
+	"""Asyncio counterpart of `ClientSession`."""
+
+
+	def __init__(self, address, timeout=10):
+
+		self.address = address
+		self.timeout = timeout
+
+		self._socket: Optional[AsyncClientSocket] = None
+
+
+	async def __aenter__(self):
+
+		return self
+
+
+	async def __aexit__(self, *args):
+
+		await self.close()
+
+
+	@property
+	def keep_alive(self) -> bool:
+
+		return self._socket is not None and self._socket.keep_alive
+
+
+	async def socket(self) -> AsyncClientSocket:
+
+		if self.keep_alive:
+			return self._socket
+
+		await self.close()
+
+		self._socket = await AsyncClientSocket.connect(
+			self.address, self.timeout, keep_alive=True
+		)
+
+		return self._socket
+
+
+	async def close(self):
+
+		if self._socket is not None:
+			await self._socket.close()
+			self._socket = None
+
+
 class ServerSocket(Socket):
 
 
@@ -610,7 +1182,7 @@ class ServerSocket(Socket):
 class BaseRequestHandler(Thread):
 
 
-	def __init__(self, c: Socket, private=False):
+	def __init__(self, c: Socket, private=False, keep_alive=True):
 
 		super().__init__()
 
@@ -619,6 +1191,11 @@ class BaseRequestHandler(Thread):
 		self.command = None
 		self.headers = {}
 
+		# Whether clients may run several commands over this connection, and
+		# whether the client asked to
+		self.allow_keep_alive = keep_alive
+		self.keep_alive = False
+
 		self.commands = {
 			COMMAND_ADD_SERVER: self.res_add_server,
 			COMMAND_CHECK_PASSWORD: self.res_check_password,
@@ -690,25 +1267,131 @@ class BaseRequestHandler(Thread):
 		self.command = command
 		self.headers = headers
 
+		if self.allow_keep_alive and headers.get(HEADER_KEEP_ALIVE):
+			self.keep_alive = True
+
 		return command, headers
 
 
 	def handle_request(self):
+		"""Handles the pending request, then any further requests sent over a
+		keep-alive connection until the client closes it."""
 
-		if self.command is None:
-			self.recv_request()
-		
-		if self.command in self.require_auth:
-			self.authenticate()
+		while True:
+
+			if self.command is None:
+				self.recv_request()
 
-		return self.commands[self.command]()
+			if self.command in self.require_auth:
+				self.authenticate()
+
+			result = self.commands[self.command]()
+
+			if not self.keep_alive:
+				return result
+
+			self.command = None
+
+			# The client closing the connection, or leaving it idle until it
+			# times out or is reset, is the normal end of the session
+			try:
+				self.recv_request()
+			except NetworkException:
+				return result
 
 
 	def respond(self, **headers):
 
+		if self.keep_alive:
+			headers.setdefault(HEADER_KEEP_ALIVE, True)
+
 		return self.c.respond(self.command, **headers)
 
 
+class Transcript:
+	"""Records the bytes client sockets send and receive, with timings, so
+	conversations with real servers can be replayed offline.
+
+	The file starts with `MAGIC`, followed by one record per event: a
+	`RECORD` header (event kind, connection number, seconds since the
+	transcript was opened, payload length), then the payload. `OPEN` records
+	carry the address as JSON, `SENT` and `RECEIVED` records the bytes, with
+	an empty `RECEIVED` record where the server closed the connection."""
+
+
+	MAGIC = b"SC4MPTR1"
+	RECORD = struct.Struct("<cIdI")
+
+	OPEN = b"O"
+	SENT = b"S"
+	RECEIVED = b"R"
+	CLOSE = b"C"
+
+
+	def __init__(self, path):
+
+		self.file = open(path, "wb")
+		self.file.write(self.MAGIC)
+
+		self.start = time.perf_counter()
+		self.connections = 0
+		self.lock = Lock()
+
+
+	def write(self, kind, connection, data=b""):
+
+		with self.lock:
+			self.file.write(self.RECORD.pack(kind, connection, time.perf_counter() - self.start, len(data)))
+			self.file.write(data)
+
+
+	def open(self, address) -> int:
+		"""Records a new connection and returns its number."""
+
+		with self.lock:
+			self.connections += 1
+			connection = self.connections
+
+		self.write(self.OPEN, connection, json.dumps(list(address)).encode())
+
+		return connection
+
+
+	def sent(self, connection, data):
+
+		self.write(self.SENT, connection, bytes(data))
+
+
+	def received(self, connection, data):
+
+		self.write(self.RECEIVED, connection, bytes(data))
+
+
+	def close(self, connection):
+
+		self.write(self.CLOSE, connection)
+
+		with self.lock:
+			self.file.flush()
+
+
+	@classmethod
+	def read(cls, path):
+		"""Yields the `(kind, connection, seconds, payload)` of each record in a transcript."""
+
+		with open(path, "rb") as file:
+
+			if file.read(len(cls.MAGIC)) != cls.MAGIC:
+				raise ValueError(f"Not a transcript: {path!r}")
+
+			while True:
+				header = file.read(cls.RECORD.size)
+				if len(header) < cls.RECORD.size:
+					return
+				kind, connection, seconds, length = cls.RECORD.unpack(header)
+				yield kind, connection, seconds, file.read(length)
+
+
 class NetworkException(Exception):
 	
 
@@ -1,31 +1,54 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import heapq
 import json
+import math
+import mmap
 import os
+import queue
 import random
-import shutil
+import signal
 import struct
 import sys
-import tempfile
 import time
 import traceback
 from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import wraps
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from inspect import stack
-from os import unlink
 from pathlib import Path
-from socket import socket
-from threading import Thread, current_thread
+from threading import Condition, Lock, Thread, current_thread, get_ident
+from urllib.error import HTTPError
+from urllib.parse import quote, unquote, urlencode
+from urllib.request import urlopen
 
 try:
-	from flask import Flask, jsonify, abort, send_from_directory
+	from flask import Flask, Response, request, abort, g, send_from_directory
 	app = Flask(__name__)
 	sc4mp_has_flask = True
 except ImportError:
 	sc4mp_has_flask = False
 
+try:
+	import brotli
+	sc4mp_has_brotli = True
+except ImportError:
+	sc4mp_has_brotli = False
+
+from core import networking
+from core.database import Database
 from core.networking import \
-	ClientSocket, NetworkException, ConnectionClosedException, \
-	send_json, recv_json, BUFFER_SIZE
+	Socket, ClientSocket, ClientSession, AsyncClientSocket, AsyncClientSession, \
+	NetworkException, ConnectionClosedException, send_json, recv_json, \
+	interpret_socket_error, Transcript, BUFFER_SIZE
 
 
 SC4MP_TITLE = "SC4MP API"
@@ -34,31 +57,158 @@ SC4MP_SERVERS = [("servers.sc4mp.org", port) for port in range(7240, 7250)]
 
 SC4MP_BUFFER_SIZE = BUFFER_SIZE
 
+SC4MP_ENGINES = ["asyncio", "threads"]
+
+SC4MP_PROTOCOL_MESSAGE = "message"
+SC4MP_PROTOCOL_LEGACY = "legacy"
+SC4MP_PROTOCOL_TTL = 3600
+
+SC4MP_REFRESH_MIN = 60
+SC4MP_REFRESH_MAX = 1800
+
+SC4MP_BACKOFF_BASE = 60
+SC4MP_BACKOFF_MAX = 3600
+SC4MP_BREAKER_THRESHOLD = 5
+
+SC4MP_PUBLISH_INTERVAL = 10
+SC4MP_SWEEP_TIMEOUT = 600
+SC4MP_FETCH_TIMEOUT = 30
+
+SC4MP_ENCODINGS = ["br", "gzip", "identity"]
+SC4MP_COMPRESS_MIN = 1024
+SC4MP_GZIP_LEVEL = 6
+SC4MP_BROTLI_QUALITY = 5
+
+SC4MP_QUERY_ARGS = ["sort", "fields", "limit", "cursor"]
+
+SC4MP_DELTA_HISTORY = 64
+
+SC4MP_STREAM_HEARTBEAT = 15
+
+SC4MP_ROLES = ["all", "scanner", "api"]
+
+SC4MP_SNAPSHOT_FILE = "snapshot.bin"
+SC4MP_SNAPSHOT_MAGIC = b"SC4MPSNP"
+SC4MP_SNAPSHOT_HEADER = struct.Struct("<8sQQQ")
+SC4MP_SNAPSHOT_SIZE = 1 << 24
+SC4MP_SNAPSHOT_POLL = 1
+
+# API workers ask the scanner process for the history it records
+SC4MP_SCANNER_TIMEOUT = 5
+
+SC4MP_STATE_FILE = "state.json"
+
+SC4MP_HISTORY_METRICS = ["stat_mayors", "stat_mayors_online", "stat_claimed", "stat_download"]
+SC4MP_HISTORY_TIERS = [(60, 1440), (3600, 720), (86400, 365)]
+
+SC4MP_METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Metric categories of `NetworkException` messages, by prefix
+SC4MP_ERROR_CATEGORIES = [
+	("Expected ", "Protocol error"),
+	("Headers missing", "Protocol error"),
+	("Response headers missing", "Protocol error"),
+	("Invalid request", "Protocol error"),
+	("No data received", "No data received"),
+	("Checksum mismatch", "Checksum mismatch"),
+	("Authentication failed", "Authentication failed")
+]
+
+SC4MP_TRACE_BUFFER = 100000
+SC4MP_TRACE_FILE = "sc4mpapi.trace.json"
+
+SC4MP_LOG_FILE = "sc4mpapi.log"
+SC4MP_WORKER_LOG_FILE = "sc4mpapi-worker-{pid}.log"
+SC4MP_LOG_MAX_SIZE = 10 * 1024 * 1024
+SC4MP_LOG_BACKUPS = 3
+
+# Label for log lines written by asyncio tasks, which share a thread
+sc4mp_log_label = ContextVar("sc4mp_log_label", default=None)
+
 
 def init():
 
-	global sc4mp_scanner
+	global sc4mp_args, sc4mp_scanner, sc4mp_source
+
+	sc4mp_args = parse_args()
 
-	sys.stdout = Logger()
+	# API workers each keep their own log, so they don't truncate or rotate
+	# the log of the scanner or of each other
+	if sc4mp_args.role == "api":
+		sys.stdout = Logger(SC4MP_WORKER_LOG_FILE.format(pid=os.getpid()))
+	else:
+		sys.stdout = Logger()
 	current_thread().name = "Main"
 
 	print(SC4MP_TITLE)
 
-	print("Starting scanner...")
+	if sc4mp_args.trace:
+		print(f"Tracing enabled, dump with GET /trace or SIGUSR1 to {SC4MP_TRACE_FILE}")
+		sc4mp_tracer.enable()
+		if hasattr(signal, "SIGUSR1"):
+			try:
+				signal.signal(signal.SIGUSR1, sc4mp_tracer.dump_file)
+			except ValueError:
+				# Signals can only be handled from the main thread
+				pass
 
-	sc4mp_scanner = Scanner()
+	if sc4mp_args.record:
+		print(f"Recording server conversations to {sc4mp_args.record}...")
+		networking.recorder = Transcript(sc4mp_args.record)
+
+	# API workers serve the snapshots written by a separate scanner process
+	if sc4mp_args.role == "api":
+		print(f"Reading snapshots from {sc4mp_args.snapshot_file}...")
+		sc4mp_scanner = None
+		sc4mp_source = SnapshotReader(sc4mp_args.snapshot_file)
+		sc4mp_source.start()
+		return
+
+	print(f"Starting scanner ({sc4mp_args.engine})...")
+
+	if sc4mp_args.engine == "threads":
+		sc4mp_scanner = Scanner(
+			max_fetchers=sc4mp_args.max_fetchers or 50,
+			publish_interval=sc4mp_args.publish_interval
+		)
+	else:
+		sc4mp_scanner = AsyncScanner(
+			max_fetchers=sc4mp_args.max_fetchers or 1000,
+			publish_interval=sc4mp_args.publish_interval
+		)
+	if sc4mp_args.role == "scanner":
+		sc4mp_scanner.snapshot_writer = SnapshotWriter(sc4mp_args.snapshot_file)
+	if sc4mp_args.state_file:
+		try:
+			sc4mp_scanner.load_state(Database(sc4mp_args.state_file))
+		except Exception as e:
+			show_error(e)
 	sc4mp_scanner.start()
 
+	sc4mp_source = sc4mp_scanner
+
 
 def main():
 
-	global sc4mp_args
+	if sc4mp_args.role == "scanner":
 
-	sc4mp_args = parse_args()
+		print(f"Writing snapshots to {sc4mp_args.snapshot_file}...")
+
+		# Without the webserver, metrics are served on their own
+		if sc4mp_args.port:
+			metrics_server = HTTPServer((sc4mp_args.host or "", int(sc4mp_args.port)), MetricsRequestHandler)
+			Thread(target=metrics_server.serve_forever, daemon=True).start()
+			print(f"Metrics and history served on http://localhost:{sc4mp_args.port}")
 
-	print("Starting webserver...")
+		try:
+			while True:
+				time.sleep(.1)
+		except KeyboardInterrupt:
+			pass
+
+	elif sc4mp_has_flask:
 
-	if sc4mp_has_flask:
+		print("Starting webserver...")
 
 		print(f"Webserver started on http://localhost:{sc4mp_args.port}")
 
@@ -71,6 +221,8 @@ def main():
 
 	else:
 
+		print("Starting webserver...")
+
 		print("[WARNING] Flask is unavailable. Webserver cannot start.")
 
 		try:
@@ -79,9 +231,10 @@ def main():
 		except KeyboardInterrupt:
 			pass
 
-	print("Stopping scanner...")
+	if sc4mp_scanner is not None:
+		print("Stopping scanner...")
 
-	sc4mp_scanner.end = True
+	sc4mp_source.stop()
 
 
 def parse_args():
@@ -90,19 +243,134 @@ def parse_args():
 
 	parser.add_argument("--host", required=False)
 	parser.add_argument("--port", required=False)
+	parser.add_argument("--engine", required=False, choices=SC4MP_ENGINES, default=SC4MP_ENGINES[0])
+	parser.add_argument("--max-fetchers", required=False, type=int)
+	parser.add_argument("--publish-interval", required=False, type=float, default=SC4MP_PUBLISH_INTERVAL)
+	parser.add_argument("--state-file", required=False, default=SC4MP_STATE_FILE)
+	parser.add_argument("--trace", required=False, action="store_true")
+	parser.add_argument("--record", required=False)
+
+	# Environment defaults, for API workers started by a WSGI server
+	parser.add_argument("--role", required=False, choices=SC4MP_ROLES, default=os.environ.get("SC4MP_ROLE", SC4MP_ROLES[0]))
+	parser.add_argument("--snapshot-file", required=False, default=os.environ.get("SC4MP_SNAPSHOT_FILE", SC4MP_SNAPSHOT_FILE))
+	parser.add_argument("--scanner-url", required=False, default=os.environ.get("SC4MP_SCANNER_URL"))
+
+	# Unknown arguments are ignored so the app can be imported by a WSGI server
+	return parser.parse_known_args()[0]
+
+
+def get_bitmap_dimensions(data):
+	"""Returns the width and height from the header of a bitmap file."""
+
+	width, height = struct.unpack_from('<ii', data, 18)
+
+	return (width, height)
+
+
+def prune_file_table(file_table):
+	"""Returns the entries of a file table needed to calculate region stats."""
+	ft = []
+	for entry in file_table:
+		filename = os.path.basename(entry[2])
+		if filename in ["region.json", "config.bmp"]:
+			ft.append(entry)
+	return ft
+
+
+def calculate_region_stats(region_files, server_time):
+	"""Calculate region statistics from downloaded region data."""
+
+	# Check if any region files were received
+	if not region_files.received:
+		return {
+			"stat_mayors": 0,
+			"stat_mayors_online": 0,
+			"stat_claimed": 0
+		}
+
+	mayors = set()
+	mayors_online = set()
+	claimed_area = 0
+	total_area = 0
+
+	for region, region_dimensions in region_files.dimensions.items():
+		try:
+			region_database = region_files.database(region)
+
+			for coords in region_database.keys():
+				city_entry = region_database[coords]
+				if city_entry is not None:
+					owner = city_entry["owner"]
+					if owner is not None:
+						claimed_area += city_entry["size"] ** 2
+						mayors.add(owner)
+						modified = city_entry["modified"]
+						if modified is not None:
+							modified = datetime.fromisoformat(modified)
+							if modified > server_time - timedelta(minutes=60):
+								mayors_online.add(owner)
+			total_area += region_dimensions[0] * region_dimensions[1]
+		except Exception:
+			# Skip regions that don't have the expected structure
+			pass
+
+	stat_mayors = len(mayors)
+	stat_mayors_online = len(mayors_online)
+
+	try:
+		stat_claimed = float(claimed_area) / float(total_area)
+	except ZeroDivisionError:
+		stat_claimed = 1
+
+	return {
+		"stat_mayors": stat_mayors,
+		"stat_mayors_online": stat_mayors_online,
+		"stat_claimed": stat_claimed
+	}
+
+
+def error_category(e):
+	"""Short description of a fetch error with a bounded number of values,
+	for labelling metrics."""
+
+	if isinstance(e, str):
+		return e
+
+	if isinstance(e, ConnectionClosedException):
+		return "Connection closed"
+
+	if isinstance(e, NetworkException):
+		for prefix, category in SC4MP_ERROR_CATEGORIES:
+			if e.message.startswith(prefix):
+				return category
+		if e.__cause__ is None:
+			# Errors reported by the server itself
+			return "Server error"
+		e = e.__cause__
 
-	return parser.parse_args()
+	category = interpret_socket_error(e).split(":")[0]
 
+	# Keep the type of unrecognized errors, but not their details
+	if category == "Unknown error":
+		return f"Unknown error ({type(e).__name__})"
 
-def get_bitmap_dimensions(filename):
+	return category
 
-	with open(filename, "rb") as file:
-		data = bytearray(file.read())
 
-	width = struct.unpack_from('<i', data, 18)
-	height = struct.unpack_from('<i', data, 22)
+async def gather_or_cancel(*coroutines):
+	"""Runs coroutines concurrently like `asyncio.gather`, but cancels the
+	others as soon as one raises, so no transfer outlives the fetch."""
 
-	return (width[0], height[0])
+	tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+
+	try:
+		return await asyncio.gather(*tasks)
+	finally:
+		unfinished = [task for task in tasks if not task.done()]
+		for task in unfinished:
+			task.cancel()
+		if len(unfinished) > 0:
+			await asyncio.wait(unfinished)
 
 
 def show_error(e):
@@ -116,6 +384,12 @@ def show_error(e):
 	print("[ERROR] " + message + "\n\n" + traceback.format_exc())
 
 
+@app.before_request
+def start_request_timer():
+
+	g.sc4mp_request_started = time.perf_counter()
+
+
 @app.after_request
 def add_cors_headers(response):
 
@@ -124,6 +398,50 @@ def add_cors_headers(response):
 	return response
 
 
+@app.after_request
+def record_request_metrics(response):
+
+	endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+	sc4mp_metrics.request_duration.observe(
+		time.perf_counter() - g.sc4mp_request_started,
+		endpoint=endpoint, method=request.method, status=str(response.status_code)
+	)
+	if response.content_length is not None:
+		sc4mp_metrics.response_size.observe(response.content_length, endpoint=endpoint)
+
+	return response
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+
+	return Response(render_metrics(), mimetype=SC4MP_METRICS_CONTENT_TYPE)
+
+
+@app.route("/trace", methods=["GET"])
+def get_trace():
+
+	if not sc4mp_tracer.enabled:
+		abort(404)
+
+	return Response(sc4mp_tracer.dump(), mimetype="application/json")
+
+
+def render_metrics():
+	"""Updates the gauges and renders every metric in the Prometheus text format."""
+
+	if sc4mp_scanner is not None:
+		sc4mp_metrics.fetchers_in_flight.set(sc4mp_scanner.in_flight)
+		sc4mp_metrics.frontier_size.set(len(sc4mp_scanner.frontier))
+
+	snapshot = sc4mp_source.snapshot
+	sc4mp_metrics.generation.set(snapshot.generation)
+	sc4mp_metrics.servers.set(len(snapshot.servers))
+
+	return sc4mp_metrics.render()
+
+
 @app.route('/.well-known/acme-challenge/<filename>')
 def serve_challenge(filename):
 
@@ -135,623 +453,2975 @@ def serve_challenge(filename):
 @app.route("/servers", methods=["GET"])
 def get_servers():
 
-	return jsonify(list(sc4mp_scanner.servers.values()))
+	snapshot = sc4mp_source.snapshot
+
+	if not request.args:
+		return json_response(snapshot.variants, snapshot.generation)
+
+	if "since" in request.args:
+		try:
+			since = int(request.args["since"])
+		except ValueError:
+			abort(400, "Invalid generation.")
+		if any(not key.startswith("_") for key in request.args.keys() if key != "since"):
+			abort(400, "Since cannot be combined with other arguments.")
+		return json_response(snapshot.delta(since), snapshot.generation)
+
+	try:
+		servers, cursor = query_servers(snapshot.index, request.args)
+	except ValueError as e:
+		abort(400, str(e))
+
+	# The result only depends on the generation and the query string
+	body = encode_json(servers)
+	etag = hashlib.sha1(snapshot.variants["identity"][1].encode() + request.query_string).hexdigest()
+
+	response = json_response({"identity": (body, etag)}, snapshot.generation)
+
+	if cursor is not None:
+		args = [(key, value) for key, value in request.args.items(multi=True) if key != "cursor"]
+		args.append(("cursor", cursor))
+		response.headers["Link"] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+
+	return response
+
+
+@app.route("/servers/stream", methods=["GET"])
+def get_servers_stream():
+
+	snapshot = sc4mp_source.snapshot
+
+	# Resume after the last generation the client received, if any
+	try:
+		since = int(request.headers.get("Last-Event-ID", request.args.get("since", -1)))
+	except ValueError:
+		abort(400, "Invalid generation.")
+
+	response = Response(sc4mp_source.stream.subscribe(snapshot, since), mimetype="text/event-stream")
+	response.headers["Cache-Control"] = "no-cache"
+	response.headers["X-Accel-Buffering"] = "no"
+
+	return response
 
 
 @app.route("/servers/<server_id>", methods=["GET"])
 def get_server(server_id):
 
-    server = sc4mp_scanner.servers.get(server_id)
+	variants = sc4mp_source.snapshot.entries.get(server_id)
 
-    if server is None:
-        abort(404)
+	if variants is None:
+		abort(404)
 
-    return jsonify(server)
+	return json_response(variants)
 
 
-class Scanner(Thread):
+@app.route("/servers/<server_id>/history", methods=["GET"])
+def get_server_history(server_id):
 
+	try:
+		body = server_history(server_id)
+	except Exception as e:
+		show_error(e)
+		abort(502)
 
-	def __init__(self):
+	if body is None:
+		abort(404)
 
-		super().__init__()
-		self.daemon = True
+	return Response(body, mimetype="application/json")
 
-		self.MAX_THREADS = 50
 
-		self.new_servers = dict()
-		self.servers = self.new_servers
-		self.server_queue = SC4MP_SERVERS.copy()
-		self.thread_count = 0
-		self.end = False
+def server_history(server_id):
+	"""Returns the encoded stat history of a server, or None if none was
+	recorded. Only the scanner process records history, so API workers ask
+	it for the history at `--scanner-url`."""
 
+	if sc4mp_scanner is not None:
+		history = sc4mp_scanner.stat_history.get(server_id)
+		return None if history is None else encode_json(history)
 
-	def run(self):
+	if not sc4mp_args.scanner_url:
+		return None
+
+	url = f"{sc4mp_args.scanner_url.rstrip('/')}/servers/{quote(server_id, safe='')}/history"
+	try:
+		with urlopen(url, timeout=SC4MP_SCANNER_TIMEOUT) as response:
+			return response.read()
+	except HTTPError as e:
+		if e.code == 404:
+			return None
+		raise
+
+
+def json_response(variants, generation=None):
+	"""Serves the pre-encoded JSON variant best matching `Accept-Encoding`,
+	or 304 if the client already has it."""
 
+	encoding = request.accept_encodings.best_match(
+		[encoding for encoding in SC4MP_ENCODINGS if encoding in variants]
+	) or "identity"
+
+	body, etag = variants[encoding]
+
+	response = Response(body, mimetype="application/json")
+	if encoding != "identity":
+		response.headers["Content-Encoding"] = encoding
+	response.vary.add("Accept-Encoding")
+	response.set_etag(etag)
+	if generation is not None:
+		response.headers["X-Generation"] = str(generation)
+
+	return response.make_conditional(request)
+
+
+def query_servers(index, args):
+	"""Runs a `/servers` query string against the index of a generation.
+
+	Any argument other than `sort`, `fields`, `limit` and `cursor` filters
+	on a field, by value (`private=false`, repeat for any of several) or by
+	range (`min_stat_mayors_online=1`). Arguments starting with `_` are
+	ignored. Returns the servers and the cursor of the next page, if any."""
+
+	filters = dict()
+	ranges = dict()
+	for name in args.keys():
+		if name in SC4MP_QUERY_ARGS or name.startswith("_"):
+			continue
+		elif name.startswith("min_"):
+			ranges.setdefault(name[4:], [None, None])[0] = args[name]
+		elif name.startswith("max_"):
+			ranges.setdefault(name[4:], [None, None])[1] = args[name]
+		else:
+			filters[name] = args.getlist(name)
+
+	sort = args.get("sort") or None
+	descending = sort is not None and sort.startswith("-")
+	field = sort[1:] if descending else sort
+
+	after = None
+	if "cursor" in args:
+		try:
+			cursor_sort, after = json.loads(base64.urlsafe_b64decode(args["cursor"].encode()))
+		except Exception:
+			raise ValueError("Invalid cursor.")
+		if not isinstance(cursor_sort, (str, type(None))) or not isinstance(after, str):
+			raise ValueError("Invalid cursor.")
+		if cursor_sort != sort:
+			raise ValueError("Cursor does not match the sort order.")
+
+	limit = None
+	if "limit" in args:
 		try:
+			limit = int(args["limit"])
+		except ValueError:
+			raise ValueError("Invalid limit.")
+		if limit < 1:
+			raise ValueError("Invalid limit.")
 
-			tried_servers = []
+	server_ids, more = index.query(filters, ranges, field, descending, after, limit)
 
-			while not self.end:
+	cursor = None
+	if more:
+		cursor = base64.urlsafe_b64encode(json.dumps([sort, server_ids[-1]]).encode()).decode()
 
-				try:
+	fields = [name for name in args.get("fields", "").split(",") if name]
 
-					if len(self.server_queue) > 0:
+	servers = []
+	for server_id in server_ids:
+		if fields:
+			servers.append(index.project(server_id, fields))
+		else:
+			servers.append(index.servers[server_id])
 
-						if self.thread_count < self.MAX_THREADS:
+	return servers, cursor
 
-							server = self.server_queue.pop(0)
 
-							if not server in tried_servers:
+def encode_json(value):
 
-								#print(f"Fetching server at {server[0]}:{server[1]}...")
+	return json.dumps(value, separators=(",", ":"), sort_keys=True).encode()
 
-								fetcher = self.Fetcher(self, server)
-								fetcher.start()
 
-								self.thread_count += 1
+def encode_variants(body, compress=True):
+	"""Returns `{content_encoding: (body, etag)}`, compressing `body` once
+	with every available encoding if it is large enough to benefit."""
 
-								tried_servers.append(server)
+	etag = hashlib.sha1(body).hexdigest()
 
-						time.sleep(.1)
+	variants = {"identity": (body, etag)}
 
-					else:
+	if compress and len(body) >= SC4MP_COMPRESS_MIN:
+		variants["gzip"] = (gzip.compress(body, compresslevel=SC4MP_GZIP_LEVEL, mtime=0), f"{etag}-gzip")
+		if sc4mp_has_brotli:
+			variants["br"] = (brotli.compress(body, quality=SC4MP_BROTLI_QUALITY), f"{etag}-br")
 
-						count = 0
+	return variants
 
-						while not self.end:
 
-							if len(self.server_queue) > 0:
+class Snapshot():
+	"""Immutable, pre-encoded view of one generation of servers.
 
-								break
+	The list and each server are encoded and compressed once when the
+	generation is published, each variant with a strong ETag. Generations
+	are numbered, and the servers added, changed and removed by each of
+	the last `SC4MP_DELTA_HISTORY` are kept to answer `?since=`."""
 
-							elif count < 60 and self.thread_count > 0:
 
-								count += 1
+	def __init__(self, servers=None, previous=None, generation=0):
 
-								time.sleep(10)
+		self.servers = servers or dict()
 
-							else:
+		# Servers that didn't change since the previous generation keep their
+		# encoding, so publishing often only compresses what was refreshed
+		self.entries = dict()
+		for server_id, server in self.servers.items():
+			if previous is not None and server_id in previous.entries and previous.servers.get(server_id) == server:
+				self.entries[server_id] = previous.entries[server_id]
+			else:
+				self.entries[server_id] = encode_variants(encode_json(server))
 
-								#try:
-								#	shutil.rmtree(os.path.join("_SC4MP", "_Temp", "ServerList"))
-								#except Exception as e:
-								#	pass
+		# The list is the encoded entries joined, as `encode_json` would write it
+		self.variants = encode_variants(
+			b"[" + b",".join(variants["identity"][0] for variants in self.entries.values()) + b"]"
+		)
 
-								for server_id, entry in self.servers.items():
-									self.new_servers.setdefault(server_id, entry)
+		self._index = None
+		self._index_lock = Lock()
 
-								for server_id in self.new_servers.keys():
-									if "stats" not in self.new_servers[server_id].keys():
-										try:
-											self.new_servers[server_id]["stats"] = self.servers[server_id]["stats"]
-										except Exception:
-											pass
+		if previous is None:
+			self.generation = generation
+			self.history = ()
+		else:
+			self.generation = previous.generation + 1
 
-								self.servers = self.new_servers
-								self.new_servers = dict()
-								self.server_queue = SC4MP_SERVERS.copy()
-								tried_servers = []
+			# Compare each server with the previous generation by its ETag
+			added = set()
+			changed = set()
+			for server_id, variants in self.entries.items():
+				old_variants = previous.entries.get(server_id)
+				if old_variants is None:
+					added.add(server_id)
+				elif old_variants["identity"][1] != variants["identity"][1]:
+					changed.add(server_id)
+			removed = set(previous.entries.keys()) - set(self.entries.keys())
 
-								time.sleep(60) #300
+			self.history = previous.history[-(SC4MP_DELTA_HISTORY - 1):] + (
+				(self.generation, added, changed, removed),
+			)
 
-								break
+		# Encoded deltas by the generation they start from. The reset and the
+		# delta from the previous generation, which most clients ask for, are
+		# compressed now so requests never have to
+		self.deltas = {None: encode_variants(self.encode_delta(None))}
+		if self.history:
+			self.deltas[self.generation - 1] = encode_variants(self.encode_delta(self.generation - 1))
 
-				except Exception as e:
 
-					show_error(e)
+	@property
+	def index(self):
+		"""The `ServerIndex` of the generation, built by its first query, so
+		publishing doesn't pay for it where nothing is queried."""
 
-					time.sleep(10)
+		if self._index is None:
+			with self._index_lock:
+				if self._index is None:
+					self._index = ServerIndex(self.servers)
 
-		except KeyboardInterrupt:
+		return self._index
 
-			pass
 
+	def dump(self):
+		"""Serializes the snapshot with all of its encoded variants."""
 
-	class Fetcher(Thread):
+		blobs = []
+		offset = 0
 
+		def add(variants):
+			nonlocal offset
+			table = dict()
+			for encoding, (body, etag) in variants.items():
+				table[encoding] = [offset, len(body), etag]
+				blobs.append(body)
+				offset += len(body)
+			return table
 
-		def __init__(self, parent, server):
+		table = encode_json({
+			"generation": self.generation,
+			"history": [
+				[generation, sorted(added), sorted(changed), sorted(removed)]
+				for generation, added, changed, removed in self.history
+			],
+			"variants": add(self.variants),
+			"entries": [[server_id, add(variants)] for server_id, variants in self.entries.items()],
+			"deltas": [[since, add(variants)] for since, variants in list(self.deltas.items())]
+		})
+
+		return struct.pack("<I", len(table)) + table + b"".join(blobs)
+
+
+	@classmethod
+	def load(cls, data):
+		"""Restores a snapshot serialized by `dump()` without re-encoding it."""
+
+		length = struct.unpack_from("<I", data)[0]
+		table = json.loads(data[4:4 + length])
+		start = 4 + length
+
+		def get(table):
+			return {
+				encoding: (data[start + offset:start + offset + size], etag)
+				for encoding, (offset, size, etag) in table.items()
+			}
 
-			super().__init__()
+		snapshot = cls.__new__(cls)
 
-			self.parent = parent
-			self.server = server
+		snapshot.generation = table["generation"]
+		snapshot.history = tuple(
+			(generation, set(added), set(changed), set(removed))
+			for generation, added, changed, removed in table["history"]
+		)
+		snapshot.variants = get(table["variants"])
+		snapshot.entries = {server_id: get(variants) for server_id, variants in table["entries"]}
 
+		# The list is in the same order as the entries
+		snapshot.servers = dict(zip(snapshot.entries.keys(), json.loads(snapshot.variants["identity"][0])))
+		# Built here, by the reader, rather than by the first request
+		snapshot._index = ServerIndex(snapshot.servers)
+		snapshot._index_lock = Lock()
+		snapshot.deltas = {since: get(variants) for since, variants in table.get("deltas", [])}
 
-		def run(self):
+		return snapshot
 
-			print(f"Fetching server at {self.server[0]}:{self.server[1]}...")
 
-			try:
+	def delta(self, since):
+		"""Returns the encoded variants of the changes after generation
+		`since`, or every server with `reset` if it is too old to tell."""
 
-				try:
+		# Every generation too old to tell shares the same reset
+		if since is None or not (self.history and self.history[0][0] - 1 <= since <= self.generation):
+			since = None
 
-					entry = dict()
+		variants = self.deltas.get(since)
+		if variants is not None:
+			return variants
 
-					entry["host"] = self.server[0]
-					entry["port"] = self.server[1]
-					entry["url"] = f"sc4mp://{entry['host']}:{entry['port']}"
+		# Older deltas are rarely asked for and are encoded on demand, but
+		# not compressed, so the request path never compresses
+		variants = self.deltas[since] = encode_variants(self.encode_delta(since), compress=False)
 
-					# Determine which protocol to use
-					use_legacy = False
-					try:
-						server_id, server_version = self.fetch()
-					except (NetworkException, ConnectionClosedException):
-						use_legacy = True
+		return variants
 
-					# Use legacy protocol if needed
-					if use_legacy:
-						server_id = self.get("server_id")
-						server_version = self.get("server_version")
 
-					entry["version"] = server_version
-					entry["updated"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+	def encode_delta(self, since):
 
-					# Only add server if we got a valid server_id
-					if not server_id:
-						print(f"[WARNING] Server at {self.server[0]}:{self.server[1]} failed to get server ID, skipping.")
-						return
+		if since is None:
 
-					self.parent.new_servers.setdefault(server_id, entry)
+			# The reset is the encoded list wrapped in the delta's other keys
+			return (
+				b'{"added":' + self.variants["identity"][0] +
+				b',"changed":[],"generation":' + str(self.generation).encode() +
+				b',"removed":[],"reset":true}'
+			)
 
-					# Fetch server data using appropriate protocol
-					if use_legacy:
-						self.server_list_0_8()
-						entry["info"] = self.server_info_0_8()
-						if not entry["info"]["private"]:
-							entry["stats"] = self.server_stats_0_8(server_id)
-					else:
-						self.server_list()
-						entry["info"] = self.server_info()
-						if not entry["info"]["private"]:
-							entry["stats"] = self.server_stats(server_id)
+		# Servers that existed at `since` are those first touched by
+		# anything but an addition
+		existed = dict()
+		for generation, added, changed, removed in self.history:
+			if generation > since:
+				for server_id in added:
+					existed.setdefault(server_id, False)
+				for server_id in changed | removed:
+					existed.setdefault(server_id, True)
 
-				except TimeoutError:
+		delta = {"generation": self.generation, "reset": False, "added": [], "changed": [], "removed": []}
+		for server_id, server in self.servers.items():
+			if server_id in existed:
+				delta["changed" if existed[server_id] else "added"].append(server)
+		delta["removed"] = sorted(
+			server_id for server_id, was in existed.items() if was and server_id not in self.servers
+		)
 
-					print(f"[WARNING] Server at {self.server[0]}:{self.server[1]} timed out.")
+		return encode_json(delta)
 
-				except Exception as e:
 
-					print(f"[WARNING] Failed to fetch server at {self.server[0]}:{self.server[1]}: {e}")
+class SnapshotWriter():
+	"""Publishes each generation to a memory-mapped file for API workers.
 
-				self.parent.thread_count -= 1
+	The header holds a sequence number that is odd while a snapshot is
+	being written, so readers can tell a complete snapshot from a torn one.
+	The file only ever grows, since workers may have it mapped."""
 
-			except KeyboardInterrupt:
 
-				pass
+	def __init__(self, path, size=SC4MP_SNAPSHOT_SIZE):
 
+		self.path = Path(path)
 
-		def client_socket(self, timeout=30):
-			"""Create a ClientSocket instance"""
-			return ClientSocket(address=self.server, timeout=timeout)
+		if not self.path.exists():
+			self.path.touch()
+		self.file = open(self.path, "r+b")
 
+		current_size = os.fstat(self.file.fileno()).st_size
+		if current_size < size:
+			self.file.truncate(size)
+		else:
+			size = current_size
+		self.map = mmap.mmap(self.file.fileno(), size)
 
-		def socket_0_8(self):
-			"""Create a regular socket for v0.8/v0.4 protocol"""
-			s = socket()
-			s.settimeout(30)
-			s.connect(self.server)
-			return s
+		# Carry on from the sequence of a previous scanner, if any
+		magic, sequence, generation, length = SC4MP_SNAPSHOT_HEADER.unpack_from(self.map)
+		self.sequence = sequence + sequence % 2 if magic == SC4MP_SNAPSHOT_MAGIC else 0
 
 
-		def get(self, request):
-			"""Simple request/response for v0.8/v0.4 protocol"""
-			s = self.socket_0_8()
+	def write(self, snapshot):
 
-			s.send(request.encode())
+		data = snapshot.dump()
 
-			return s.recv(SC4MP_BUFFER_SIZE).decode()
+		size = SC4MP_SNAPSHOT_HEADER.size + len(data)
+		if size > len(self.map):
+			self.resize(max(size, 2 * len(self.map)))
 
+		# Each field is stored on its own, the sequence first to mark the
+		# snapshot as being written and last to mark it as complete, since a
+		# copy of the whole header is not atomic across processes
+		self.map[0:8] = SC4MP_SNAPSHOT_MAGIC
+		struct.pack_into("<Q", self.map, 8, self.sequence + 1)
+		self.map[SC4MP_SNAPSHOT_HEADER.size:size] = data
+		struct.pack_into("<QQ", self.map, 16, snapshot.generation, len(data))
+		self.sequence += 2
+		struct.pack_into("<Q", self.map, 8, self.sequence)
 
-		# ===== SHARED HELPER METHODS =====
 
-		def _load_json(self, filename):
-			"""Returns data from a json file as a dictionary."""
-			try:
-				with open(filename, 'r') as file:
-					data = json.load(file)
-					if data is None:
-						return dict()
-					else:
-						return data
-			except FileNotFoundError:
-				return dict()
+	def resize(self, size):
 
+		self.map.close()
+		self.file.truncate(size)
+		self.map = mmap.mmap(self.file.fileno(), size)
 
-		def _calculate_region_stats(self, temp_dir, server_time):
-			"""Calculate region statistics from downloaded region data."""
-			regions_path = os.path.join(temp_dir, "Regions")
 
-			# Check if Regions directory exists (may not if no files were downloaded)
-			if not os.path.exists(regions_path):
-				return {
-					"stat_mayors": 0,
-					"stat_mayors_online": 0,
-					"stat_claimed": 0
-				}
+	def close(self):
 
-			mayors = set()
-			mayors_online = set()
-			claimed_area = 0
-			total_area = 0
+		self.map.close()
+		self.file.close()
 
-			for region in os.listdir(regions_path):
-				try:
-					region_path = os.path.join(regions_path, region)
-					region_config_path = os.path.join(region_path, "config.bmp")
-					region_dimensions = get_bitmap_dimensions(region_config_path)
-					region_database_path = os.path.join(region_path, "_Database", "region.json")
-					region_database = self._load_json(region_database_path)
-
-					for coords in region_database.keys():
-						city_entry = region_database[coords]
-						if city_entry is not None:
-							owner = city_entry["owner"]
-							if owner is not None:
-								claimed_area += city_entry["size"] ** 2
-								mayors.add(owner)
-								modified = city_entry["modified"]
-								if modified is not None:
-									modified = datetime.strptime(modified, "%Y-%m-%d %H:%M:%S")
-									if modified > server_time - timedelta(minutes=60):
-										mayors_online.add(owner)
-					total_area += region_dimensions[0] * region_dimensions[1]
-				except Exception:
-					# Skip directories that don't have the expected region structure
-					pass
-
-			stat_mayors = len(mayors)
-			stat_mayors_online = len(mayors_online)
 
-			try:
-				stat_claimed = float(claimed_area) / float(total_area)
-			except ZeroDivisionError:
-				stat_claimed = 1
+class SnapshotReader(Thread):
+	"""Serves the snapshots written by a `SnapshotWriter` in another process.
 
-			return {
-				"stat_mayors": stat_mayors,
-				"stat_mayors_online": stat_mayors_online,
-				"stat_claimed": stat_claimed
-			}
+	Stands in for the scanner in API workers, providing the latest
+	`snapshot` and a `stream` of its changes."""
 
 
-		# ===== PROTOCOL METHODS =====
+	def __init__(self, path, poll=SC4MP_SNAPSHOT_POLL):
 
-		def fetch(self):
-			"""Fetch server ID and version"""
-			s = self.client_socket()
-			info = s.info()
-			return info.get("server_id"), info.get("server_version")
+		super().__init__(name="SnapshotReader")
+		self.daemon = True
 
+		self.path = Path(path)
+		self.poll = poll
 
-		def server_list(self):
-			"""Fetch server list"""
-			s = self.client_socket()
+		self.file = None
+		self.map = None
+		self.sequence = 0
 
-			servers = s.server_list()
+		self.snapshot = Snapshot()
+		self.stream = EventStream()
 
-			# Loop through server list and append them to the unfetched servers
-			for host, port in servers:
-				self.parent.server_queue.append((host, port))
+		self.end = False
 
 
-		def server_info(self):
-			"""Fetch server info"""
-			s = self.client_socket()
+	def run(self):
 
-			return s.info()
+		while not self.end:
 
+			try:
+				snapshot = self.read()
+				if snapshot is not None:
+					self.snapshot = snapshot
+					self.stream.publish(snapshot)
+			except Exception as e:
+				show_error(e)
 
-		def server_stats(self, server_id):
-			"""Calculate server stats"""
+			time.sleep(self.poll)
 
-			def fetch_temp():
+		if self.map is not None:
+			self.map.close()
+			self.file.close()
 
-				# Create temporary directory
-				temp_dir = tempfile.mkdtemp(prefix="sc4mp_api_")
 
-				TARGETS = ["plugins", "regions"]
-				DIRECTORIES = ["Plugins", "Regions"]
+	def stop(self):
 
-				total_size = 0
+		self.end = True
 
-				for target, directory in zip(TARGETS, DIRECTORIES):
 
-					# Set destination
-					destination = os.path.join(temp_dir, directory)
+	def read(self):
+		"""Returns the latest snapshot in the file, or None if there is no
+		new one or it is being written."""
 
-					# Create the socket
-					s = self.client_socket()
+		if self.map is None:
+			if not self.path.exists() or self.path.stat().st_size < SC4MP_SNAPSHOT_HEADER.size:
+				return None
+			self.file = open(self.path, "rb")
+			self.remap()
 
-					# Request file table
-					file_table = s.file_table(target)
+		# Read the sequence before the fields it guards, as the writer stores
+		# it after them
+		magic, sequence = struct.unpack_from("<8sQ", self.map)
 
-					# Get total download size
-					size = sum([entry[1] for entry in file_table])
+		if magic != SC4MP_SNAPSHOT_MAGIC or sequence % 2 == 1 or sequence == self.sequence:
+			return None
 
-					# Prune file table as necessary
-					ft = []
-					for entry in file_table:
-						filename = Path(entry[2]).name
-						if filename in ["region.json", "config.bmp"]:
-							ft.append(entry)
-					file_table = ft
+		generation, length = struct.unpack_from("<QQ", self.map, 16)
 
-					# Download files
-					for checksum, filesize, relpath, file_data in s.file_table_data(target, file_table):
+		# The writer grew the file
+		size = SC4MP_SNAPSHOT_HEADER.size + length
+		if size > len(self.map):
+			self.remap()
 
-						# Set the destination
-						d = Path(destination) / relpath
+		data = self.map[SC4MP_SNAPSHOT_HEADER.size:size]
 
-						# Create the destination directory if necessary
-						d.parent.mkdir(parents=True, exist_ok=True)
+		# Discard the copy if the writer started another snapshot meanwhile
+		if struct.unpack_from("<Q", self.map, 8)[0] != sequence:
+			return None
 
-						# Delete the destination file if it exists
-						d.unlink(missing_ok=True)
+		# Only skip this sequence from now on if it could be loaded
+		snapshot = Snapshot.load(data)
+		self.sequence = sequence
 
-						# Receive the file
-						with d.open("wb") as dest:
-							for chunk in file_data:
-								dest.write(chunk)
+		return snapshot
 
-					total_size += size
 
-				return total_size, temp_dir
+	def remap(self):
 
+		if self.map is not None:
+			self.map.close()
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
 
-			def get_time():
 
-				try:
+class EventStream():
+	"""Fans out the changes of each generation as Server-Sent Events.
 
-					s = self.client_socket()
-					return s.time()
+	The events of a generation are encoded once when it is published and
+	the same bytes are written to every subscriber. Subscribers that fall
+	more than a generation behind catch up with the snapshot's cached
+	delta instead."""
 
-				except Exception as e:
 
-					show_error(e)
+	HEARTBEAT = b": heartbeat\n\n"
 
-					return datetime.now()
 
-			# Download files
-			stat_download, temp_dir = fetch_temp()
+	def __init__(self, heartbeat=SC4MP_STREAM_HEARTBEAT):
 
-			# Get server time
-			server_time = get_time()
+		self.heartbeat = heartbeat
 
-			# Calculate region statistics
-			region_stats = self._calculate_region_stats(temp_dir, server_time)
+		self.snapshot = None
+		self.message = b""
+		self.condition = Condition()
 
-			# Build entry
-			entry = {
-				"stat_mayors": region_stats["stat_mayors"],
-				"stat_mayors_online": region_stats["stat_mayors_online"],
-				"stat_claimed": region_stats["stat_claimed"],
-				"stat_download": stat_download
-			}
 
-			# Cleanup temp files
-			try:
-				shutil.rmtree(temp_dir)
-			except Exception as e:
-				pass
+	@staticmethod
+	def encode(event, data, generation=None):
 
-			return entry
+		message = b""
+		if generation is not None:
+			message += f"id: {generation}\n".encode()
+		return message + f"event: {event}\ndata: ".encode() + data + b"\n\n"
 
 
-		# ===== V0.8/V0.4 PROTOCOL METHODS (LEGACY) =====
+	def publish(self, snapshot):
+		"""Encodes the per-server patches of a new generation and wakes every subscriber."""
 
-		def server_list_0_8(self):
-			"""Fetch server list using v0.8/v0.4 protocol"""
-			# Create socket
-			s = self.socket_0_8()
+		# Without a history, such as after a warm start, subscribers catch up with a reset
+		if not snapshot.history or snapshot.history[-1][0] != snapshot.generation:
+			with self.condition:
+				self.snapshot = snapshot
+				self.message = None
+				self.condition.notify_all()
+			return
 
-			# Request server list
-			s.send(b"server_list")
+		generation, added, changed, removed = snapshot.history[-1]
 
-			# Receive server list
-			servers = recv_json(s)
+		events = []
+		for server_id, variants in snapshot.entries.items():
+			if server_id in added or server_id in changed:
+				events.append(self.encode("server", variants["identity"][0]))
+		for server_id in sorted(removed):
+			events.append(self.encode("remove", encode_json(server_id)))
 
-			# Loop through server list and append them to the unfetched servers
-			for host, port in servers:
-				self.parent.server_queue.append((host, port))
+		# Only the final event has an ID, so clients resume after whole generations
+		events.append(self.encode("generation", str(generation).encode(), generation))
 
+		message = b"".join(events)
 
-		def server_info_0_8(self):
-			"""Fetch server info using v0.8/v0.4 protocol"""
-			s = self.socket_0_8()
+		with self.condition:
+			self.snapshot = snapshot
+			self.message = message
+			self.condition.notify_all()
 
-			s.send(b"info")
 
-			return recv_json(s)
+	def subscribe(self, snapshot, since=-1):
+		"""Yields the changes after generation `since`, then those of every
+		generation published afterwards, with heartbeats in between."""
 
+		yield self.encode("delta", snapshot.delta(since)["identity"][0], snapshot.generation)
 
-		def server_stats_0_8(self, server_id):
-			"""Calculate server stats using v0.8/v0.4 protocol"""
+		generation = snapshot.generation
 
-			def fetch_temp():
+		while True:
 
-				# Create temporary directory
-				temp_dir = tempfile.mkdtemp(prefix="sc4mp_api_")
+			with self.condition:
+				if self.condition.wait_for(
+					lambda: self.snapshot is not None and self.snapshot.generation > generation, timeout=self.heartbeat
+				):
+					snapshot = self.snapshot
+					message = self.message
+				else:
+					snapshot = None
 
-				REQUESTS = ["plugins", "regions"]
-				DIRECTORIES = ["Plugins", "Regions"]
+			if snapshot is None:
+				yield self.HEARTBEAT
+			elif snapshot.generation == generation + 1 and message is not None:
+				yield message
+			else:
+				yield self.encode("delta", snapshot.delta(generation)["identity"][0], snapshot.generation)
 
-				total_size = 0
+			if snapshot is not None:
+				generation = snapshot.generation
 
-				for request, directory in zip(REQUESTS, DIRECTORIES):
 
-					# Set destination
-					destination = os.path.join(temp_dir, directory)
+class ServerIndex():
+	"""Lookup tables for filtering, sorting and paginating one generation.
 
-					# Create the socket
-					s = self.socket_0_8()
+	Fields are the scalar values at the top level of each server and in
+	its `info` and `stats`. The tables are built once per generation, so
+	a query costs about the size of its result, not the number of servers."""
 
-					# Request the type of data
-					s.send(request.encode())
 
-					# Receive file table
-					file_table = recv_json(s)
+	def __init__(self, servers):
 
-					# Get total download size
-					size = sum([entry[1] for entry in file_table])
+		self.servers = servers
 
-					# Prune file table as necessary
-					ft = []
-					for entry in file_table:
-						filename = Path(entry[2]).name
-						if filename in ["region.json", "config.bmp"]:
-							ft.append(entry)
-					file_table = ft
+		# Values of each field by server ID
+		self.fields = dict()
+		for server_id, server in servers.items():
+			for field, value in self.flatten(server).items():
+				self.fields.setdefault(field, dict())[server_id] = value
 
-					# Send pruned file table
-					send_json(s, file_table)
+		# Server IDs by the value of each field
+		self.matches = dict()
+		for field, values in self.fields.items():
+			matches = self.matches[field] = dict()
+			for server_id, value in values.items():
+				matches.setdefault(self.format(value), set()).add(server_id)
 
-					# Receive files
-					for entry in file_table:
+		# Server IDs in the order of each field, servers without it last,
+		# along with the sorted keys and the rank of each server
+		self.keys = dict()
+		self.orders = {(None, False): list(servers.keys())}
+		for field, values in self.fields.items():
+			present = sorted(
+				(self.key(value), server_id) for server_id, value in values.items() if value is not None
+			)
+			missing = [server_id for server_id in servers.keys() if values.get(server_id) is None]
+			self.keys[field] = [key for key, server_id in present]
+			self.orders[(field, False)] = [server_id for key, server_id in present] + missing
+			self.orders[(field, True)] = [server_id for key, server_id in reversed(present)] + missing
+		self.ranks = {
+			order_id: {server_id: rank for rank, server_id in enumerate(order)}
+			for order_id, order in self.orders.items()
+		}
 
-						# Get necessary values from entry
-						filesize = entry[1]
-						relpath = Path(entry[2])
 
-						# Set the destination
-						d = Path(destination) / relpath
+	@staticmethod
+	def flatten(server):
+
+		fields = dict()
+		for field, value in server.items():
+			if field in ("info", "stats"):
+				if isinstance(value, dict):
+					for subfield, subvalue in value.items():
+						if not isinstance(subvalue, (dict, list)):
+							fields[subfield] = subvalue
+			elif not isinstance(value, (dict, list)):
+				fields[field] = value
+		return fields
 
-						# Create the destination directory if necessary
-						d.parent.mkdir(parents=True, exist_ok=True)
 
-						# Delete the destination file if it exists
-						d.unlink(missing_ok=True)
+	@staticmethod
+	def format(value):
+		"""Formats a value the way it would appear in a query string."""
 
-						# Receive the file
-						filesize_read = 0
-						with d.open("wb") as dest:
-							while filesize_read < filesize:
-								filesize_remaining = filesize - filesize_read
-								buffersize = SC4MP_BUFFER_SIZE if filesize_remaining > SC4MP_BUFFER_SIZE else filesize_remaining
-								bytes_read = s.recv(buffersize)
-								if not bytes_read:
-									break
-								dest.write(bytes_read)
-								filesize_read += len(bytes_read)
+		if value is None:
+			return "null"
+		elif isinstance(value, bool):
+			return "true" if value else "false"
+		else:
+			return str(value)
 
-					total_size += size
 
-				return total_size, temp_dir
+	@staticmethod
+	def key(value):
+		"""Sort key that orders numbers before strings."""
 
+		if isinstance(value, (int, float)) and not isinstance(value, bool):
+			return (0, value)
+		else:
+			return (1, ServerIndex.format(value))
+
+
+	@staticmethod
+	def parse(value):
+		"""Sort key of a value given in a query string."""
 
-			def get_time():
+		try:
+			return (0, float(value))
+		except ValueError:
+			return (1, value)
 
 
-				try:
+	def query(self, filters=None, ranges=None, sort=None, descending=False, after=None, limit=None):
+		"""Returns the IDs of the servers matching every filter, in order,
+		after the server ID `after`, and whether there are any more."""
 
-					s = self.socket_0_8()
-					s.send(b"time")
+		# Each filter is a set of matching server IDs
+		sets = []
+		for field, values in (filters or {}).items():
+			matches = self.matches.get(field, {})
+			sets.append(set().union(*[matches.get(value, set()) for value in values]))
+		for field, (low, high) in (ranges or {}).items():
+			keys = self.keys.get(field, [])
+			start = 0 if low is None else bisect_left(keys, self.parse(low))
+			end = len(keys) if high is None else bisect_right(keys, self.parse(high))
+			sets.append(set(self.orders[(field, False)][start:end]))
 
-					return datetime.strptime(s.recv(SC4MP_BUFFER_SIZE).decode(), "%Y-%m-%d %H:%M:%S")
+		order_id = (sort, descending) if sort in self.fields else (None, False)
+		order = self.orders[order_id]
+		ranks = self.ranks[order_id]
 
-				except Exception as e:
+		start = 0
+		if after is not None:
+			if not isinstance(after, str):
+				raise ValueError("Invalid cursor.")
+			if after not in ranks:
+				raise ValueError("Cursor has expired.")
+			start = ranks[after] + 1
 
-					show_error(e)
+		if not sets:
+			server_ids = order[start:] if limit is None else order[start:start + limit + 1]
+		else:
+			sets.sort(key=len)
+			matches = [server_id for server_id in sets[0] if all(server_id in other for other in sets[1:])]
+			server_ids = sorted(
+				[server_id for server_id in matches if ranks[server_id] >= start], key=ranks.get
+			)
 
-					return datetime.now()
+		if limit is not None and len(server_ids) > limit:
+			return server_ids[:limit], True
+		else:
+			return server_ids, False
 
-			# Download files
-			stat_download, temp_dir = fetch_temp()
 
-			# Get server time
-			server_time = get_time()
+	def project(self, server_id, fields):
+		"""Returns only the given top level or flattened fields of a server."""
 
-			# Calculate region statistics
-			region_stats = self._calculate_region_stats(temp_dir, server_time)
+		server = self.servers[server_id]
 
-			# Build entry
-			entry = {
-				"stat_mayors": region_stats["stat_mayors"],
-				"stat_mayors_online": region_stats["stat_mayors_online"],
-				"stat_claimed": region_stats["stat_claimed"],
-				"stat_download": stat_download
-			}
+		projection = dict()
+		for field in fields:
+			if field in server:
+				projection[field] = server[field]
+			elif field in self.fields and server_id in self.fields[field]:
+				projection[field] = self.fields[field][server_id]
+		return projection
 
-			# Cleanup temp files
-			try:
-				shutil.rmtree(temp_dir)
-			except Exception as e:
-				pass
 
-			return entry
+class Frontier():
+	"""Queue of server addresses ordered by when they are next due.
 
+	Each address is queued at most once, however many servers list it.
+	Newly discovered addresses are due at once, in the order they were
+	found, and fetched addresses are queued again at their next-due time.
+	All operations are logarithmic time and thread-safe."""
 
-class Logger():
 
+	def __init__(self, servers=()):
 
-	def __init__(self):
+		self._heap = []
+		self._seen = set()
+		self._count = 0
+		self._lock = Lock()
 
+		self.extend(servers)
 
-		self.terminal = sys.stdout
-		self.log = "sc4mpapi.log"
 
-		try:
-			unlink(self.log)
-		except Exception:
-			pass
+	def __len__(self):
 
+		return len(self._heap)
 
-	def write(self, message):
 
+	def __contains__(self, server):
 
-		output = message
+		with self._lock:
+			return server in self._seen
 
-		if (message != "\n"):
 
-			# Timestamp
-			timestamp = datetime.now().strftime("[%H:%M:%S] ")
+	def append(self, server):
+		"""Queues a new address, returning False if it was already seen."""
 
-			# Label
-			label = "[SC4MP/" + current_thread().getName() + "] "
-			for item in stack()[1:]:
-				try:
-					label += "(" + item[0].f_locals["self"].__class__.__name__ + ") "
-					break
-				except Exception:
-					pass
-
-
-			# Type and color
-			type = "[INFO] "
-			color = '\033[90m '
-			TYPES_COLORS = [
-				("[INFO] ", '\033[90m '), #'\033[94m '
-				("[PROMPT]", '\033[01m '),
-				("[WARNING] ", '\033[93m '),
-				("[ERROR] ", '\033[91m '),
-				("[FATAL] ", '\033[91m ')
-			]
-			for index in range(len(TYPES_COLORS)):
-				current_type = TYPES_COLORS[index][0]
-				current_color = TYPES_COLORS[index][1]
-				if (message[:len(current_type)] == current_type):
-					message = message[len(current_type):]
-					type = current_type
-					color = current_color
-					break
-			if (current_thread().getName() == "Main" and type == "[INFO] "):
-				color = '\033[00m '
-
-			# Assemble
-			output = color + timestamp + label + type + message
-
-		# Print
-		self.terminal.write(output)
-		with open(self.log, "a") as log:
-			log.write(output)
-			log.close()
+		with self._lock:
+			if server in self._seen:
+				return False
+			self._seen.add(server)
+			self._push(server, 0)
+			return True
 
 
-	def flush(self):
+	def extend(self, servers):
+
+		count = 0
+		for server in servers:
+			if self.append(server):
+				count += 1
+		return count
+
+
+	def requeue(self, server, due):
+		"""Queues a known address again, once it has been fetched."""
+
+		with self._lock:
+			self._push(server, due)
+
+
+	def due(self):
+		"""Returns the next-due time of the earliest address, or None if empty."""
+
+		with self._lock:
+			return self._heap[0][0] if self._heap else None
+
+
+	def pop(self, now=None):
+		"""Pops the earliest address, or returns None if none is due by `now`."""
+
+		with self._lock:
+			if not self._heap or (now is not None and self._heap[0][0] > now):
+				return None
+			return heapq.heappop(self._heap)[2]
+
+
+	def addresses(self):
+		"""Returns every address seen, queued or being fetched."""
+
+		with self._lock:
+			return list(self._seen)
+
+
+	def _push(self, server, due):
+
+		# The count keeps addresses due at the same time in FIFO order
+		heapq.heappush(self._heap, (due, self._count, server))
+		self._count += 1
+
+
+class RegionFiles():
+	"""Holds the region files needed to calculate stats as they are received,
+	in place of a temporary Regions directory.
+
+	Files are parsed as they arrive: only the dimensions from the header of
+	each region's `config.bmp` and the contents of its `_Database/region.json`
+	are kept. Files whose checksum matches one in `cache` (the `files` of the
+	same server from a previous sweep) are reused instead of downloaded."""
+
+
+	BITMAP_HEADER_SIZE = 26
+
+
+	def __init__(self, cache=None):
+
+		self.cache = cache if cache is not None else dict()
+
+		self.received = False
+		self.bytes_received = 0
+		self.files = dict()
+		self.dimensions = dict()
+		self.databases = dict()
+
+
+	def open(self, checksum, relpath):
+		"""Returns a writable file-like object for a received file."""
+
+		return self.File(self, checksum, relpath)
+
+
+	def reuse(self, file_table):
+		"""Takes the unchanged files of a file table from the cache and returns
+		the entries that still need to be downloaded."""
+
+		ft = []
+		for entry in file_table:
+			checksum, filesize, relpath = entry
+			cached = self.cache.get(relpath)
+			if cached is not None and cached[0] == checksum:
+				self._store(relpath, checksum, cached[1])
+			else:
+				ft.append(entry)
+		return ft
+
+
+	def add(self, checksum, relpath, data):
+
+		parts = Path(relpath).parts
+
+		value = None
+		if len(parts) == 2 and parts[1] == "config.bmp":
+			try:
+				value = get_bitmap_dimensions(data)
+			except struct.error:
+				pass
+		elif len(parts) == 3 and parts[1:] == ("_Database", "region.json"):
+			try:
+				value = json.loads(data)
+				if value is None:
+					value = dict()
+			except ValueError:
+				pass
+
+		self._store(relpath, checksum, value)
+
+
+	def _store(self, relpath, checksum, value):
+
+		self.received = True
+		self.files[relpath] = (checksum, value)
+
+		parts = Path(relpath).parts
+
+		if len(parts) == 2 and parts[1] == "config.bmp":
+			if value is not None:
+				self.dimensions[parts[0]] = value
+		elif len(parts) == 3 and parts[1:] == ("_Database", "region.json"):
+			self.databases[parts[0]] = value
+
+
+	def database(self, region):
+		"""Returns the parsed `region.json` of a region as a dictionary."""
+
+		database = self.databases.get(region, dict())
+		if database is None:
+			raise ValueError(f"Invalid region database for {region!r}.")
+
+		return database
+
+
+	class File():
+
+
+		def __init__(self, parent, checksum, relpath):
+
+			self.parent = parent
+			self.checksum = checksum
+			self.relpath = relpath
+
+			if Path(relpath).name == "config.bmp":
+				self.limit = parent.BITMAP_HEADER_SIZE
+			else:
+				self.limit = None
+
+			self.data = bytearray()
+
+
+		def __enter__(self):
+
+			return self
+
+
+		def __exit__(self, exc_type, exc_value, traceback):
+
+			if exc_type is None:
+				self.parent.add(self.checksum, self.relpath, bytes(self.data))
+
+
+		def write(self, chunk):
+
+			self.parent.bytes_received += len(chunk)
+
+			if self.limit is None:
+				self.data += chunk
+			elif len(self.data) < self.limit:
+				self.data += chunk[:self.limit - len(self.data)]
+
+
+class RegionCache():
+	"""Parsed region files of each server from previous sweeps, keyed by
+	server ID, then by relative path, with the checksum of each file."""
+
+
+	def __init__(self):
+
+		self._servers = dict()
+		self._lock = Lock()
+
+
+	def get(self, server_id):
+
+		with self._lock:
+			return self._servers.get(server_id, dict())
+
+
+	def set(self, server_id, files):
+
+		with self._lock:
+			self._servers[server_id] = files
+
+
+	def retain(self, server_ids):
+		"""Drops the files of servers no longer on the network."""
+
+		server_ids = set(server_ids)
+
+		with self._lock:
+			for server_id in list(self._servers.keys()):
+				if server_id not in server_ids:
+					del self._servers[server_id]
+
+
+class Metric():
+	"""A metric family, with one value for each combination of label values."""
+
+
+	def __init__(self, name, description, type):
+
+		self.name = name
+		self.description = description
+		self.type = type
+
+		self._values = dict()
+		self._lock = Lock()
+
+
+	@staticmethod
+	def format_labels(labels, **extra):
+
+		labels = list(labels) + list(extra.items())
+		if not labels:
+			return ""
+		return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+	def retain(self, label, values):
+		"""Drops the series whose `label` is not one of `values`."""
+
+		values = set(values)
+
+		with self._lock:
+			for key in list(self._values.keys()):
+				value = dict(key).get(label)
+				if value is not None and value not in values:
+					del self._values[key]
+
+
+	def render(self):
+
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+		with self._lock:
+			for labels, value in sorted(self._values.items()):
+				lines.append(f"{self.name}{self.format_labels(labels)} {value}")
+		return lines
+
+
+class Counter(Metric):
+
+
+	def __init__(self, name, description):
+
+		super().__init__(name, description, "counter")
+
+
+	def inc(self, amount=1, **labels):
+
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+
+	def __init__(self, name, description):
+
+		super().__init__(name, description, "gauge")
+
+
+	def set(self, value, **labels):
+
+		with self._lock:
+			self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+	"""Counts observations into cumulative `buckets`, along with their sum."""
+
+
+	def __init__(self, name, description, buckets):
+
+		super().__init__(name, description, "histogram")
+
+		self.buckets = sorted(buckets)
+
+
+	def observe(self, value, **labels):
+
+		key = tuple(sorted(labels.items()))
+		with self._lock:
+			counts = self._values.get(key)
+			if counts is None:
+				counts = self._values[key] = [0] * (len(self.buckets) + 2)
+			counts[bisect_left(self.buckets, value)] += 1
+			counts[-1] += value
+
+
+	@contextmanager
+	def time(self, **labels):
+
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start, **labels)
+
+
+	def render(self):
+
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+		with self._lock:
+			for labels, counts in sorted(self._values.items()):
+				total = 0
+				for bound, count in zip(self.buckets + ["+Inf"], counts):
+					total += count
+					lines.append(f"{self.name}_bucket{self.format_labels(labels, le=bound)} {total}")
+				lines.append(f"{self.name}_sum{self.format_labels(labels)} {counts[-1]}")
+				lines.append(f"{self.name}_count{self.format_labels(labels)} {total}")
+		return lines
+
+
+class Metrics():
+	"""Scanner and API metrics, exported at /metrics in the Prometheus text format."""
+
+
+	def __init__(self):
+
+		self.families = []
+
+		# Scanner
+		self.sweep_duration = self.add(Histogram(
+			"sc4mp_sweep_duration_seconds", "Time from the first fetch after the scanner was idle until it is idle again.",
+			[1, 5, 10, 30, 60, 120, 300, 600, 1200]
+		))
+		self.fetchers_in_flight = self.add(Gauge("sc4mp_fetchers_in_flight", "Fetchers currently running."))
+		self.frontier_size = self.add(Gauge("sc4mp_frontier_size", "Server addresses queued for their next refresh."))
+		self.generation = self.add(Gauge("sc4mp_generation", "Number of the published generation."))
+		self.servers = self.add(Gauge("sc4mp_servers", "Servers in the published generation."))
+		self.fetch_duration = self.add(Histogram(
+			"sc4mp_fetch_duration_seconds", "Time taken by each phase of fetching a server.",
+			[.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60]
+		))
+		self.received_bytes = self.add(Counter("sc4mp_received_bytes_total", "Bytes of plugin and region files received."))
+		self.fetch_errors = self.add(Counter("sc4mp_fetch_errors_total", "Failed fetches by error."))
+
+		# API
+		self.request_duration = self.add(Histogram(
+			"sc4mp_http_request_duration_seconds", "Time taken to handle API requests.",
+			[.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5]
+		))
+		self.response_size = self.add(Histogram(
+			"sc4mp_http_response_size_bytes", "Size of API response bodies.",
+			[100, 1000, 10000, 100000, 1000000, 10000000]
+		))
+
+
+	def add(self, family):
+
+		self.families.append(family)
+		return family
+
+
+	def render(self):
+
+		lines = []
+		for family in self.families:
+			lines += family.render()
+		return "\n".join(lines) + "\n"
+
+
+class PhaseTimer():
+	"""Times the phases of fetching a server, one after another."""
+
+
+	def __init__(self, server):
+
+		self.server = f"{server[0]}:{server[1]}"
+
+		self.start = time.perf_counter()
+		self.last = self.start
+
+
+	def lap(self, phase):
+		"""Records the time since the previous phase ended."""
+
+		now = time.perf_counter()
+		sc4mp_metrics.fetch_duration.observe(now - self.last, server=self.server, phase=phase)
+		if sc4mp_tracer.enabled:
+			sc4mp_tracer.add(phase, self.last, now, server=self.server)
+		self.last = now
+
+
+	def finish(self):
+
+		now = time.perf_counter()
+		sc4mp_metrics.fetch_duration.observe(now - self.start, server=self.server, phase="total")
+		if sc4mp_tracer.enabled:
+			sc4mp_tracer.add("fetch", self.start, now, server=self.server)
+
+
+class Tracer():
+	"""Records spans into a bounded buffer, to be dumped as Chrome trace
+	event JSON (for chrome://tracing or Perfetto).
+
+	Disabled by default, when `span()` returns a shared no-op context
+	manager. Spans of asyncio tasks are kept on a track per task."""
+
+
+	NULL_SPAN = nullcontext()
+
+
+	def __init__(self, capacity=SC4MP_TRACE_BUFFER):
+
+		self.enabled = False
+		self.events = deque(maxlen=capacity)
+		self.pid = os.getpid()
+
+
+	def enable(self):
+
+		self.enabled = True
+		networking.tracer = self.span
+
+
+	def span(self, name, **args):
+
+		if not self.enabled:
+			return self.NULL_SPAN
+		return self._span(name, args)
+
+
+	@contextmanager
+	def _span(self, name, args):
+
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, start, time.perf_counter(), **args)
+
+
+	def add(self, name, start, end, **args):
+
+		try:
+			task = asyncio.current_task()
+		except RuntimeError:
+			task = None
+
+		self.events.append({
+			"name": name,
+			"ph": "X",
+			"ts": start * 1e6,
+			"dur": (end - start) * 1e6,
+			"pid": self.pid,
+			"tid": id(task) if task is not None else get_ident(),
+			"args": args,
+		})
+
+
+	def dump(self):
+
+		return encode_json({"traceEvents": list(self.events), "displayTimeUnit": "ms"})
+
+
+	def dump_file(self, *args):
+		"""Writes the trace to `SC4MP_TRACE_FILE`, usable as a signal handler."""
+
+		with open(SC4MP_TRACE_FILE, "wb") as file:
+			file.write(self.dump())
+
+
+def traced(name):
+	"""Decorates a function or coroutine function to be traced as `name`."""
+
+	def decorator(function):
+
+		if asyncio.iscoroutinefunction(function):
+
+			@wraps(function)
+			async def wrapper(*args, **kwargs):
+				with sc4mp_tracer.span(name):
+					return await function(*args, **kwargs)
+
+		else:
+
+			@wraps(function)
+			def wrapper(*args, **kwargs):
+				with sc4mp_tracer.span(name):
+					return function(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+	"""Serves /metrics, /trace and the history of each server when the
+	webserver is not running, as in the scanner role."""
+
+
+	def do_GET(self):
+
+		parts = self.path.split("/")
+
+		if self.path == "/metrics":
+			body = render_metrics().encode()
+			content_type = SC4MP_METRICS_CONTENT_TYPE
+		elif self.path == "/trace" and sc4mp_tracer.enabled:
+			body = sc4mp_tracer.dump()
+			content_type = "application/json"
+		elif len(parts) == 4 and parts[1] == "servers" and parts[3] == "history":
+			body = server_history(unquote(parts[2]))
+			content_type = "application/json"
+		else:
+			body = None
+
+		if body is None:
+			self.send_error(404)
+			return
+
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def log_message(self, format, *args):
+
+		pass
+
+
+class RingBuffer():
+	"""Fixed-size array of samples, one slot per `resolution` seconds.
+
+	Slot times are implicit in their position, so only the values are
+	stored. Samples falling in the same slot are averaged, and slots
+	without any samples are NaN."""
+
+
+	def __init__(self, resolution, capacity):
+
+		self.resolution = resolution
+		self.capacity = capacity
+
+		self.values = array("f", [math.nan]) * capacity
+
+		self.first = None
+		self.last = None
+
+		# Running mean of the newest slot
+		self.total = 0
+		self.count = 0
+
+
+	def add(self, t, value):
+
+		slot = int(t // self.resolution)
+
+		if self.last is None:
+			self.first = slot
+			self.last = slot
+		elif slot < self.last:
+			return
+		elif slot > self.last:
+			for skipped in range(self.last + 1, min(slot, self.last + 1 + self.capacity)):
+				self.values[skipped % self.capacity] = math.nan
+			self.last = slot
+			self.total = 0
+			self.count = 0
+
+		self.total += value
+		self.count += 1
+		self.values[slot % self.capacity] = self.total / self.count
+
+
+	def dump(self):
+		"""Returns the start time, resolution and values (None for gaps)
+		from the oldest slot to the newest."""
+
+		if self.last is None:
+			return {"start": None, "resolution": self.resolution, "values": []}
+
+		start = max(self.first, self.last - self.capacity + 1)
+
+		values = [self.values[slot % self.capacity] for slot in range(start, self.last + 1)]
+
+		return {
+			"start": start * self.resolution,
+			"resolution": self.resolution,
+			"values": [None if math.isnan(value) else value for value in values],
+		}
+
+
+class StatHistory():
+	"""Bounded history of the stats of each server.
+
+	Every metric of every server is kept in one `RingBuffer` per tier, by
+	default per minute for a day, per hour for 30 days and per day for a
+	year, so memory per server is fixed however long the scanner runs."""
+
+
+	def __init__(self, metrics=SC4MP_HISTORY_METRICS, tiers=SC4MP_HISTORY_TIERS):
+
+		self.metrics = metrics
+		self.tiers = tiers
+		self.clock = time.time
+
+		self._servers = dict()
+		self._lock = Lock()
+
+
+	def record(self, server_id, stats, t=None):
+
+		if t is None:
+			t = self.clock()
+
+		with self._lock:
+
+			buffers = self._servers.get(server_id)
+			if buffers is None:
+				buffers = self._servers[server_id] = {
+					metric: [RingBuffer(resolution, capacity) for resolution, capacity in self.tiers]
+					for metric in self.metrics
+				}
+
+			for metric in self.metrics:
+				value = stats.get(metric)
+				if value is not None:
+					for buffer in buffers[metric]:
+						buffer.add(t, value)
+
+
+	def get(self, server_id):
+		"""Returns the tiers of each metric of a server, or None if none were recorded."""
+
+		with self._lock:
+
+			buffers = self._servers.get(server_id)
+			if buffers is None:
+				return None
+
+			return {
+				"server_id": server_id,
+				"metrics": {metric: [buffer.dump() for buffer in tiers] for metric, tiers in buffers.items()},
+			}
+
+
+	def retain(self, server_ids):
+		"""Forgets the history of servers that are no longer listed."""
+
+		with self._lock:
+			for server_id in set(self._servers.keys()) - set(server_ids):
+				del self._servers[server_id]
+
+
+class AddressTable():
+	"""Entries keyed by server address that can be saved and restored."""
+
+
+	def __init__(self):
+
+		self._entries = dict()
+		self._lock = Lock()
+
+		# Replaced by simulations running on a virtual clock
+		self.clock = time.time
+
+
+	def dump(self):
+		"""Returns the entries as JSON-serializable `[host, port, entry]` lists."""
+
+		with self._lock:
+			return [[server[0], server[1], dict(entry)] for server, entry in self._entries.items()]
+
+
+	def load(self, entries):
+
+		with self._lock:
+			for host, port, entry in entries:
+				self._entries[(host, port)] = entry
+
+
+class ProtocolCache(AddressTable):
+	"""Remembers which protocol each server address speaks, so legacy servers
+	are not probed with the message protocol on every sweep.
+
+	Entries expire after roughly `ttl` seconds (with jitter, so they don't all
+	expire in the same sweep), after which the server is probed again and a
+	version upgrade is noticed."""
+
+
+	def __init__(self, ttl=SC4MP_PROTOCOL_TTL):
+
+		super().__init__()
+
+		self.ttl = ttl
+
+
+	def get(self, server):
+		"""Returns the cached entry for an address, or None if missing or expired."""
+
+		with self._lock:
+			entry = self._entries.get(server)
+			if entry is None:
+				return None
+			if entry["expires"] < self.clock():
+				del self._entries[server]
+				return None
+			return entry
+
+
+	def set(self, server, protocol, version):
+
+		with self._lock:
+			self._entries[server] = {
+				"protocol": protocol,
+				"version": version,
+				"expires": self.clock() + self.ttl * random.uniform(1, 1.5),
+			}
+
+
+	def forget(self, server):
+
+		with self._lock:
+			self._entries.pop(server, None)
+
+
+class RefreshSchedule(AddressTable):
+	"""Keeps a next-due time for each server address.
+
+	A server is refreshed every `minimum` seconds while its info or stats are
+	changing or mayors are online. Each refresh that finds nothing changed
+	doubles the interval up to `maximum` seconds, so idle servers are
+	refreshed rarely (failed servers are backed off by `HostHealth`)."""
+
+
+	def __init__(self, minimum=SC4MP_REFRESH_MIN, maximum=SC4MP_REFRESH_MAX):
+
+		super().__init__()
+
+		self.minimum = minimum
+		self.maximum = maximum
+
+
+	def due(self, server):
+		"""Returns when an address is next due, 0 if it was never fetched."""
+
+		with self._lock:
+			entry = self._entries.get(server)
+			return 0 if entry is None else entry["due"]
+
+
+	def update(self, server, entry):
+		"""Schedules the next refresh of an address after a successful fetch,
+		given the entry it produced."""
+
+		with self._lock:
+
+			e = self._entry(server)
+
+			fingerprint = hashlib.sha1(
+				json.dumps([entry.get("info"), entry.get("stats")], sort_keys=True, default=str).encode()
+			).hexdigest()
+			changed = fingerprint != e["fingerprint"]
+			e["fingerprint"] = fingerprint
+			busy = entry.get("stats", {}).get("stat_mayors_online", 0) > 0
+
+			if busy or changed:
+				e["interval"] = self.minimum
+			else:
+				e["interval"] = min(e["interval"] * 2, self.maximum)
+
+			e["due"] = self.clock() + e["interval"]
+
+
+	def _entry(self, server):
+
+		return self._entries.setdefault(server, {
+			"due": 0,
+			"interval": self.minimum,
+			"fingerprint": None,
+		})
+
+
+class HostHealth(AddressTable):
+	"""Failure state of each server address, acting as a circuit breaker.
+
+	Each consecutive failure doubles the time until the next retry, from
+	`base` up to `maximum` seconds, with jitter so failed servers don't retry
+	in lockstep. After `threshold` consecutive failures the circuit opens and
+	the server is only retried every `maximum` seconds (half-open), until a
+	fetch succeeds and closes it again."""
+
+
+	STATE_CLOSED = "closed"
+	STATE_OPEN = "open"
+	STATE_HALF_OPEN = "half-open"
+
+
+	def __init__(self, base=SC4MP_BACKOFF_BASE, maximum=SC4MP_BACKOFF_MAX, threshold=SC4MP_BREAKER_THRESHOLD):
+
+		super().__init__()
+
+		self.base = base
+		self.maximum = maximum
+		self.threshold = threshold
+
+
+	def retry(self, server):
+		"""Returns when an address may be fetched again, 0 if it hasn't failed."""
+
+		with self._lock:
+			entry = self._entries.get(server)
+			return 0 if entry is None else entry["retry"]
+
+
+	def success(self, server):
+
+		with self._lock:
+			self._entries.pop(server, None)
+
+
+	def failure(self, server, e):
+		"""Records a failed fetch and schedules the next retry."""
+
+		if isinstance(e, NetworkException) or isinstance(e, str):
+			error = str(e)
+		else:
+			error = interpret_socket_error(e)
+
+		with self._lock:
+
+			entry = self._entries.setdefault(server, {"failures": 0})
+
+			entry["failures"] += 1
+			entry["error"] = error
+
+			if entry["failures"] >= self.threshold:
+				delay = self.maximum
+			else:
+				delay = min(self.base * 2 ** (entry["failures"] - 1), self.maximum)
+
+			entry["retry"] = self.clock() + delay * random.uniform(.5, 1)
+
+
+	def status(self, server):
+		"""Returns the failure state of an address for the API output."""
+
+		with self._lock:
+
+			entry = self._entries.get(server)
+
+			if entry is None:
+				return {
+					"state": self.STATE_CLOSED,
+					"failures": 0,
+					"error": None,
+					"retry": None,
+				}
+
+			if entry["failures"] < self.threshold:
+				state = self.STATE_CLOSED
+			elif entry["retry"] > self.clock():
+				state = self.STATE_OPEN
+			else:
+				state = self.STATE_HALF_OPEN
+
+			return {
+				"state": state,
+				"failures": entry["failures"],
+				"error": entry["error"],
+				"retry": datetime.utcfromtimestamp(entry["retry"]).strftime("%Y-%m-%d %H:%M:%S"),
+			}
+
+
+class BaseFetcher():
+	"""The parts of fetching a server that don't depend on how it is
+	connected to, shared by `Scanner.Fetcher` and `AsyncScanner.Fetcher`,
+	which only add the calls to the server."""
+
+
+	def __init__(self, parent, server):
+
+		self.parent = parent
+		self.server = server
+
+		self.cached = None
+		self.entry = None
+		self.timer = None
+
+
+	def started(self):
+		"""Starts timing the fetch and the entry of the server, returning
+		whether the probe can be skipped because the server is known to only
+		speak the legacy protocol."""
+
+		print(f"Fetching server at {self.server[0]}:{self.server[1]}...")
+
+		self.timer = PhaseTimer(self.server)
+
+		self.entry = dict()
+		self.entry["host"] = self.server[0]
+		self.entry["port"] = self.server[1]
+		self.entry["url"] = f"sc4mp://{self.entry['host']}:{self.entry['port']}"
+
+		self.cached = self.parent.protocols.get(self.server)
+
+		return self.cached is not None and self.cached["protocol"] == SC4MP_PROTOCOL_LEGACY
+
+
+	def can_fall_back(self):
+		"""Returns whether to probe the legacy protocol after the message
+		protocol failed, only if the server is unknown: a server known to speak
+		the message protocol is just down."""
+
+		return self.cached is None
+
+
+	def legacy_failed(self):
+
+		# Probe again next time in case the server was upgraded
+		self.parent.protocols.forget(self.server)
+
+
+	def probed(self, use_legacy, server_id, server_version):
+		"""Records the result of the probe, returning False if the server has
+		no ID and is skipped."""
+
+		# Remember the protocol if it was just probed
+		if self.cached is None and server_id:
+			self.parent.protocols.set(
+				self.server,
+				SC4MP_PROTOCOL_LEGACY if use_legacy else SC4MP_PROTOCOL_MESSAGE,
+				server_version
+			)
+
+		self.timer.lap("probe")
+
+		self.entry["version"] = server_version
+		self.entry["updated"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+		# Only add server if we got a valid server_id
+		if not server_id:
+			print(f"[WARNING] Server at {self.server[0]}:{self.server[1]} failed to get server ID, skipping.")
+			self.parent.fetch_failed(self.server, "Failed to get server ID.")
+			return False
+
+		return True
+
+
+	def succeeded(self, server_id):
+
+		self.timer.finish()
+
+		# Schedule the next refresh
+		self.parent.fetch_succeeded(self.server, server_id, self.entry)
+
+
+	def failed(self, e):
+
+		if isinstance(e, TimeoutError):
+			print(f"[WARNING] Server at {self.server[0]}:{self.server[1]} timed out.")
+		else:
+			print(f"[WARNING] Failed to fetch server at {self.server[0]}:{self.server[1]}: {e}")
+
+		self.parent.fetch_failed(self.server, e)
+
+
+	def region_files(self, server_id):
+		"""Returns a `RegionFiles` reusing the region files of the last sweep."""
+
+		return RegionFiles(self.parent.region_cache.get(server_id))
+
+
+	def files_needed(self, file_table, destination):
+		"""Returns the total download size of a file table and its entries
+		that still need to be downloaded."""
+
+		# Get total download size
+		size = sum([entry[1] for entry in file_table])
+
+		# Prune file table as necessary
+		file_table = prune_file_table(file_table)
+
+		# Skip files that haven't changed since the last sweep
+		file_table = destination.reuse(file_table)
+
+		return size, file_table
+
+
+	def files_received(self, target, destination):
+
+		sc4mp_metrics.received_bytes.inc(destination.bytes_received, target=target)
+
+
+	def stats(self, server_id, region_files, stat_download, server_time):
+		"""Remembers the region files for the next sweep and returns the stats
+		entry of the server."""
+
+		# Remember the region files for the next sweep
+		self.parent.region_cache.set(server_id, region_files.files)
+
+		# Calculate region statistics
+		with sc4mp_tracer.span("calculate_region_stats"):
+			region_stats = calculate_region_stats(region_files, server_time)
+
+		# Build entry
+		entry = {
+			"stat_mayors": region_stats["stat_mayors"],
+			"stat_mayors_online": region_stats["stat_mayors_online"],
+			"stat_claimed": region_stats["stat_claimed"],
+			"stat_download": stat_download
+		}
+
+		return entry
+
+
+class Scanner(Thread):
+
+
+	def __init__(self, max_fetchers=50, publish_interval=SC4MP_PUBLISH_INTERVAL):
+
+		super().__init__(name="Scanner")
+		self.daemon = True
+
+		self.MAX_FETCHERS = max_fetchers
+		self.PUBLISH_INTERVAL = publish_interval
+		self.SWEEP_TIMEOUT = SC4MP_SWEEP_TIMEOUT
+		self.FETCH_TIMEOUT = SC4MP_FETCH_TIMEOUT
+
+		self.servers = dict()
+		self.latest = dict()
+		self.owners = dict()
+		self.owned = dict()
+		self.latest_lock = Lock()
+		self.changed = False
+		self.next_publish = 0
+		self.swept = False
+		self.snapshot = Snapshot()
+		self.stream = EventStream()
+		self.snapshot_writer = None
+		self.state = None
+		self.frontier = Frontier(SC4MP_SERVERS)
+		self.protocols = ProtocolCache()
+		self.region_cache = RegionCache()
+		self.schedule = RefreshSchedule()
+		self.health = HostHealth()
+		self.stat_history = StatHistory()
+		self.in_flight = 0
+		self.in_flight_condition = Condition()
+		self.sweep_started = None
+		self.end = False
+
+
+	def run(self):
+
+		try:
+
+			while not self.end:
+
+				try:
+
+					# Claim a slot for the next server that is due
+					with self.in_flight_condition:
+						server = None
+						if self.in_flight < self.MAX_FETCHERS:
+							server = self.next_server()
+							if server is not None:
+								self.in_flight += 1
+
+					if server is not None:
+
+						try:
+							fetcher = self.Fetcher(self, server)
+							fetcher.start()
+						except Exception:
+							self.fetcher_finished()
+							raise
+
+						continue
+
+					# Publish when nothing is in flight or due anymore, and on
+					# every tick in between, however long the slowest fetch takes
+					if self.sweep_started is not None and self.in_flight == 0:
+						self.sweep_finished()
+					elif self.should_publish():
+						self.publish()
+
+					# Wait for a fetcher to finish, new servers, the next due time
+					# or the next publish
+					with self.in_flight_condition:
+						if not self.end and (self.sweep_started is None or self.in_flight > 0):
+							self.in_flight_condition.wait(self.wait_time())
+
+				except Exception as e:
+
+					show_error(e)
+
+					time.sleep(10)
+
+		except KeyboardInterrupt:
+
+			pass
+
+
+	def stop(self):
+
+		self.end = True
+
+		self.notify()
+
+
+	def now(self):
+		"""Returns the time of the dispatch loop, for publishing and sweeps."""
+
+		return time.monotonic()
+
+
+	def load_state(self, state):
+		"""Restores the last generation and the address tables from `state`,
+		so the API serves data immediately and the scanner only refreshes."""
+
+		self.state = state
+
+		servers = state.get("servers")
+		if not servers:
+			return
+
+		print(f"Restoring {len(servers)} servers from generation {state.get('generation', 0)}...")
+
+		self.servers = servers
+		self.snapshot = Snapshot(servers, generation=state.get("generation", 0))
+
+		with self.latest_lock:
+			for server_id, entry in servers.items():
+				self.latest[server_id] = entry
+				self.owners[server_id] = (entry["host"], entry["port"])
+				self.owned[(entry["host"], entry["port"])] = server_id
+
+		self.protocols.load(state.get("protocols", []))
+		self.schedule.load(state.get("schedule", []))
+		self.health.load(state.get("health", []))
+
+		# Queue every known server instead of rediscovering them, each
+		# requeued at its saved due time when popped
+		self.frontier.extend(tuple(server) for server in state.get("frontier", []))
+
+		self.stream.publish(self.snapshot)
+		if self.snapshot_writer is not None:
+			self.snapshot_writer.write(self.snapshot)
+
+
+	def save_state(self):
+
+		self.state["generation"] = self.snapshot.generation
+		self.state["servers"] = self.servers
+		self.state["protocols"] = self.protocols.dump()
+		self.state["schedule"] = self.schedule.dump()
+		self.state["health"] = self.health.dump()
+		self.state["frontier"] = [list(server) for server in self.frontier.addresses()]
+
+		self.state.update_json()
+
+
+	def discover(self, servers):
+		"""Queues server addresses found in a server list."""
+
+		if self.frontier.extend((host, port) for host, port in servers) > 0:
+			self.notify()
+
+
+	def due(self, server):
+		"""Returns when an address is next due, after its refresh interval and
+		any backoff from failures."""
+
+		return max(self.schedule.due(server), self.health.retry(server))
+
+
+	def next_server(self):
+		"""Pops the next server that is due for a refresh from the frontier,
+		or returns None if none is due yet."""
+
+		now = self.schedule.clock()
+
+		while True:
+
+			server = self.frontier.pop(now)
+
+			if server is None:
+				return None
+
+			# Queued before it was fetched or failed elsewhere, e.g. restored
+			due = self.due(server)
+			if due > now:
+				self.frontier.requeue(server, due)
+				continue
+
+			if self.sweep_started is None:
+				self.sweep_started = self.now()
+
+			return server
+
+
+	def wait_time(self):
+		"""Returns the seconds until the next server is due or the next
+		publish, or None to wait until notified."""
+
+		waits = []
+
+		if self.in_flight < self.MAX_FETCHERS:
+			due = self.frontier.due()
+			if due is not None:
+				waits.append(due - self.schedule.clock())
+
+		if self.changed:
+			waits.append(self.next_publish - self.now())
+
+		if len(waits) == 0:
+			return None
+
+		return max(min(waits), 0)
+
+
+	def notify(self):
+		"""Wakes the dispatch loop."""
+
+		with self.in_flight_condition:
+			self.in_flight_condition.notify_all()
+
+
+	def fetcher_finished(self):
+		"""Frees the slot held by a fetcher."""
+
+		with self.in_flight_condition:
+			self.in_flight -= 1
+			self.in_flight_condition.notify_all()
+
+
+	def fetch_succeeded(self, server, server_id, entry):
+
+		self.schedule.update(server, entry)
+		self.health.success(server)
+
+		with self.latest_lock:
+
+			# Servers listed under several addresses are kept from the first
+			owner = self.owners.setdefault(server_id, server)
+
+			if owner == server:
+
+				self.owned[server] = server_id
+
+				# Keep the last stats if the server has none this time
+				previous = self.latest.get(server_id)
+				if "stats" not in entry and previous is not None and "stats" in previous:
+					entry["stats"] = previous["stats"]
+
+				self.latest[server_id] = entry
+				self.changed = True
+
+		if owner == server and "stats" in entry:
+			self.stat_history.record(server_id, entry["stats"])
+
+		self.frontier.requeue(server, self.due(server))
+
+
+	def fetch_failed(self, server, e):
+
+		self.health.failure(server, e)
+
+		sc4mp_metrics.fetch_errors.inc(category=error_category(e))
+
+		with self.latest_lock:
+
+			# Publish the failure, and let another address of the server take over
+			server_id = self.owned.pop(server, None)
+			if server_id is not None:
+				del self.owners[server_id]
+				self.changed = True
+
+		self.frontier.requeue(server, self.due(server))
+
+
+	def should_publish(self):
+		"""Returns whether refreshes are waiting and the publish interval has
+		passed since the last publish."""
+
+		return self.changed and self.now() >= self.next_publish
+
+
+	def sweep_finished(self):
+		"""Called when no server is in flight or due anymore. Publishes right
+		away after the first sweep, so a cold start serves every server it
+		found without waiting for the next publish."""
+
+		sc4mp_metrics.sweep_duration.observe(self.now() - self.sweep_started)
+		self.sweep_started = None
+
+		first = not self.swept
+		self.swept = True
+
+		if first or self.should_publish():
+			self.publish()
+
+
+	def publish(self):
+		"""Publishes the latest entry of each server as a new generation,
+		including the servers refreshed since the last publish."""
+
+		self.next_publish = self.now() + self.PUBLISH_INTERVAL
+
+		with self.latest_lock:
+			self.changed = False
+			latest = list(self.latest.items())
+
+		# Report the failure state of each server
+		self.servers = {
+			server_id: {**entry, "health": self.health.status((entry["host"], entry["port"]))}
+			for server_id, entry in latest
+		}
+
+		# Encode the generation once for every request until the next publish
+		self.snapshot = Snapshot(self.servers, self.snapshot)
+		self.stream.publish(self.snapshot)
+
+		# Hand the generation to the API workers
+		if self.snapshot_writer is not None:
+			try:
+				self.snapshot_writer.write(self.snapshot)
+			except Exception as e:
+				show_error(e)
+
+		if self.state is not None:
+			try:
+				self.save_state()
+			except Exception as e:
+				show_error(e)
+
+		self.region_cache.retain(self.servers.keys())
+		self.stat_history.retain(self.servers.keys())
+		sc4mp_metrics.fetch_duration.retain(
+			"server", (f"{entry['host']}:{entry['port']}" for entry in self.servers.values())
+		)
+
+
+	class Fetcher(BaseFetcher, Thread):
+
+
+		def __init__(self, parent, server):
+
+			Thread.__init__(self, name="Fetcher")
+			BaseFetcher.__init__(self, parent, server)
+
+			# One connection for every command, if the server keeps it alive
+			self.session = ClientSession(self.server, timeout=self.parent.FETCH_TIMEOUT)
+
+
+		def run(self):
+
+			try:
+
+				try:
+
+					# Determine which protocol to use, skipping the probe if the
+					# server is known to only speak the legacy protocol
+					use_legacy = self.started()
+					if not use_legacy:
+						try:
+							server_id, server_version = self.fetch()
+						except (NetworkException, ConnectionClosedException):
+							if not self.can_fall_back():
+								raise
+							use_legacy = True
+
+					# Use legacy protocol if needed
+					if use_legacy:
+						try:
+							server_id = self.get("server_id")
+							server_version = self.get("server_version")
+						except Exception:
+							self.legacy_failed()
+							raise
+
+					if not self.probed(use_legacy, server_id, server_version):
+						return
+
+					# Fetch server data using appropriate protocol
+					if use_legacy:
+						self.server_list_0_8()
+						self.timer.lap("server_list")
+						self.entry["info"] = self.server_info_0_8()
+						self.timer.lap("server_info")
+						if not self.entry["info"]["private"]:
+							self.entry["stats"] = self.server_stats_0_8(server_id)
+							self.timer.lap("server_stats")
+					else:
+						self.server_list()
+						self.timer.lap("server_list")
+						self.entry["info"] = self.server_info()
+						self.timer.lap("server_info")
+						if not self.entry["info"]["private"]:
+							self.entry["stats"] = self.server_stats(server_id)
+							self.timer.lap("server_stats")
+
+					self.succeeded(server_id)
+
+				except Exception as e:
+
+					self.failed(e)
+
+			except KeyboardInterrupt:
+
+				pass
+
+			finally:
+
+				self.session.close()
+
+				self.parent.fetcher_finished()
+
+
+		def client_socket(self):
+			"""Get a ClientSocket from the session"""
+			return self.session.socket()
+
+
+		def connection(self):
+			"""Create a ClientSocket separate from the session"""
+			return ClientSocket(address=self.server, timeout=self.parent.FETCH_TIMEOUT)
+
+
+		def socket_0_8(self):
+			"""Create a regular socket for v0.8/v0.4 protocol"""
+			s = Socket()
+			s.settimeout(self.parent.FETCH_TIMEOUT)
+			with sc4mp_tracer.span("connect"):
+				s.connect(self.server)
+			return s
+
+
+		def get(self, request):
+			"""Simple request/response for v0.8/v0.4 protocol"""
+			s = self.socket_0_8()
+
+			s.send(request.encode())
+
+			return s.recv(SC4MP_BUFFER_SIZE).decode()
+
+
+		# ===== PROTOCOL METHODS =====
+
+		def fetch(self):
+			"""Fetch server ID and version"""
+			s = self.client_socket()
+			info = s.info()
+			return info.get("server_id"), info.get("server_version")
+
+
+		def server_list(self):
+			"""Fetch server list"""
+			s = self.client_socket()
+
+			servers = s.server_list()
+
+			# Append the servers in the list to the unfetched servers
+			self.parent.discover(servers)
+
+
+		def server_info(self):
+			"""Fetch server info"""
+			s = self.client_socket()
+
+			return s.info()
+
+
+		def server_stats(self, server_id):
+			"""Calculate server stats"""
+
+			def fetch_files(s, target, destination):
+
+				with sc4mp_tracer.span(target):
+
+					# Request file table
+					file_table = s.file_table(target)
+
+					# Prune the file table, skipping files that haven't changed
+					size, file_table = self.files_needed(file_table, destination)
+
+					# Download files
+					for checksum, filesize, relpath, file_data in s.file_table_data(target, file_table):
+
+						# Receive the file
+						with destination.open(checksum, relpath) as dest:
+							for chunk in file_data:
+								dest.write(chunk)
+
+					self.files_received(target, destination)
+
+					return size
+
+
+			def fetch_plugins():
+
+				# Plugins are received and discarded, only their size is needed
+				with self.connection() as s:
+					return fetch_files(s, "plugins", RegionFiles())
+
+
+			@traced("time")
+			def get_time():
+
+				try:
+
+					with self.connection() as s:
+						return s.time()
+
+				except Exception as e:
+
+					show_error(e)
+
+					return datetime.now()
+
+			# Keep region files in memory
+			region_files = self.region_files(server_id)
+
+			# Download the plugins and get the server time on their own
+			# connections while the regions are downloaded over the session
+			with ThreadPoolExecutor(max_workers=2, thread_name_prefix="Fetcher") as executor:
+
+				plugins_size = executor.submit(fetch_plugins)
+				server_time = executor.submit(get_time)
+
+				regions_size = fetch_files(self.client_socket(), "regions", region_files)
+
+				stat_download = plugins_size.result() + regions_size
+				server_time = server_time.result()
+
+			return self.stats(server_id, region_files, stat_download, server_time)
+
+
+		# ===== V0.8/V0.4 PROTOCOL METHODS (LEGACY) =====
+
+		def server_list_0_8(self):
+			"""Fetch server list using v0.8/v0.4 protocol"""
+			# Create socket
+			s = self.socket_0_8()
+
+			# Request server list
+			s.send(b"server_list")
+
+			# Receive server list
+			servers = recv_json(s)
+
+			# Append the servers in the list to the unfetched servers
+			self.parent.discover(servers)
+
+
+		def server_info_0_8(self):
+			"""Fetch server info using v0.8/v0.4 protocol"""
+			s = self.socket_0_8()
+
+			s.send(b"info")
+
+			return recv_json(s)
+
+
+		def server_stats_0_8(self, server_id):
+			"""Calculate server stats using v0.8/v0.4 protocol"""
+
+			def fetch_files(request, destination):
+
+				with sc4mp_tracer.span(request):
+
+					# Create the socket
+					s = self.socket_0_8()
+
+					# Request the type of data
+					s.send(request.encode())
+
+					# Receive file table
+					file_table = recv_json(s)
+
+					# Prune the file table, skipping files that haven't changed
+					size, file_table = self.files_needed(file_table, destination)
+
+					# Send pruned file table
+					send_json(s, file_table)
+
+					# Receive files, checking each one against its checksum so a
+					# truncated or corrupted file is never cached
+					for checksum, filesize, relpath, file_data in s.recv_files(file_table):
+
+						# Receive the file
+						with destination.open(checksum, relpath) as dest:
+							for chunk in file_data:
+								dest.write(chunk)
+
+					self.files_received(request, destination)
+
+					return size
+
+
+			@traced("time")
+			def get_time():
+
+
+				try:
+
+					s = self.socket_0_8()
+					s.send(b"time")
+
+					return datetime.strptime(s.recv(SC4MP_BUFFER_SIZE).decode(), "%Y-%m-%d %H:%M:%S")
+
+				except Exception as e:
+
+					show_error(e)
+
+					return datetime.now()
+
+			# Keep region files in memory (plugins are received and discarded)
+			region_files = self.region_files(server_id)
+
+			# Download the plugins and regions and get the server time at once
+			with ThreadPoolExecutor(max_workers=2, thread_name_prefix="Fetcher") as executor:
+
+				plugins_size = executor.submit(fetch_files, "plugins", RegionFiles())
+				server_time = executor.submit(get_time)
+
+				regions_size = fetch_files("regions", region_files)
+
+				stat_download = plugins_size.result() + regions_size
+				server_time = server_time.result()
+
+			return self.stats(server_id, region_files, stat_download, server_time)
+
+
+class AsyncScanner(Scanner):
+	"""Runs the same dispatch as `Scanner` on a single asyncio event loop, so the
+	number of servers in flight is bounded by `max_fetchers` instead of by the
+	number of OS threads."""
+
+
+	def __init__(self, max_fetchers=1000, publish_interval=SC4MP_PUBLISH_INTERVAL):
+
+		super().__init__(max_fetchers, publish_interval)
+
+		# Created on the event loop in `run_async`
+		self.loop = None
+		self.wakeup = None
+
+
+	def run(self):
+
+		try:
+
+			asyncio.run(self.run_async())
+
+		except KeyboardInterrupt:
+
+			pass
+
+
+	def now(self):
+
+		return self.loop.time()
+
+
+	def notify(self):
+
+		# May be called from other threads (e.g. `stop`), also after the
+		# event loop has closed
+		if self.wakeup is not None:
+			try:
+				self.loop.call_soon_threadsafe(self.wakeup.set)
+			except RuntimeError:
+				pass
+
+
+	async def run_async(self):
+
+		self.loop = asyncio.get_running_loop()
+		self.wakeup = asyncio.Event()
+
+		fetchers = set()
+
+		while not self.end:
+
+			try:
+
+				# Start every server that is due, up to `MAX_FETCHERS`
+				while len(fetchers) < self.MAX_FETCHERS:
+
+					server = self.next_server()
+
+					if server is None:
+						break
+
+					fetcher = asyncio.create_task(self.Fetcher(self, server).run())
+					fetcher.add_done_callback(fetchers.discard)
+					fetcher.add_done_callback(lambda fetcher: self.wakeup.set())
+					fetchers.add(fetcher)
+
+				self.in_flight = len(fetchers)
+
+				# Publish when nothing is in flight or due anymore, and on every
+				# tick in between, however long the slowest fetch takes
+				if self.sweep_started is not None and len(fetchers) == 0:
+					self.sweep_finished()
+					continue
+				elif self.should_publish():
+					self.publish()
+
+				# Wait until a fetcher finishes, new servers are discovered, the
+				# next server is due, the next publish or the scanner is stopped
+				self.wakeup.clear()
+				wakeup = asyncio.create_task(self.wakeup.wait())
+				await asyncio.wait([wakeup], timeout=self.wait_time())
+				wakeup.cancel()
+
+			except Exception as e:
+
+				show_error(e)
+
+				await asyncio.sleep(10)
+
+		self.in_flight = 0
+
+
+	class Fetcher(BaseFetcher):
+
+
+		def __init__(self, parent, server):
+
+			super().__init__(parent, server)
+
+			# One connection for every command, if the server keeps it alive
+			self.session = AsyncClientSession(self.server, timeout=self.parent.FETCH_TIMEOUT)
+
+
+		async def run(self):
+
+			sc4mp_log_label.set("Fetcher")
+
+			# Give up on servers that trickle data and would hold a slot forever
+			try:
+				await asyncio.wait_for(self._run(), self.parent.SWEEP_TIMEOUT)
+			except asyncio.TimeoutError:
+				self.failed(TimeoutError("Sweep timed out."))
+
+
+		async def _run(self):
+
+			try:
+
+				# Determine which protocol to use, skipping the probe if the
+				# server is known to only speak the legacy protocol
+				use_legacy = self.started()
+				if not use_legacy:
+					try:
+						server_id, server_version = await self.fetch()
+					except (NetworkException, ConnectionClosedException):
+						if not self.can_fall_back():
+							raise
+						use_legacy = True
+
+				# Use legacy protocol if needed
+				if use_legacy:
+					try:
+						server_id = await self.get("server_id")
+						server_version = await self.get("server_version")
+					except Exception:
+						self.legacy_failed()
+						raise
+
+				if not self.probed(use_legacy, server_id, server_version):
+					return
+
+				# Fetch server data using appropriate protocol
+				if use_legacy:
+					await self.server_list_0_8()
+					self.timer.lap("server_list")
+					self.entry["info"] = await self.server_info_0_8()
+					self.timer.lap("server_info")
+					if not self.entry["info"]["private"]:
+						self.entry["stats"] = await self.server_stats_0_8(server_id)
+						self.timer.lap("server_stats")
+				else:
+					await self.server_list()
+					self.timer.lap("server_list")
+					self.entry["info"] = await self.server_info()
+					self.timer.lap("server_info")
+					if not self.entry["info"]["private"]:
+						self.entry["stats"] = await self.server_stats(server_id)
+						self.timer.lap("server_stats")
+
+				self.succeeded(server_id)
+
+			except Exception as e:
+
+				self.failed(e)
+
+			finally:
+
+				await self.session.close()
+
+
+		async def client_socket(self):
+			"""Get an AsyncClientSocket from the session"""
+			return await self.session.socket()
+
+
+		async def connection(self):
+			"""Create an AsyncClientSocket separate from the session"""
+			return await AsyncClientSocket.connect(self.server, timeout=self.parent.FETCH_TIMEOUT)
+
+
+		async def socket_0_8(self):
+			"""Create a plain connection for v0.8/v0.4 protocol"""
+			return await AsyncClientSocket.open(self.server, timeout=self.parent.FETCH_TIMEOUT)
+
+
+		async def get(self, request):
+			"""Simple request/response for v0.8/v0.4 protocol"""
+			async with await self.socket_0_8() as s:
+
+				await s.send(request.encode())
+
+				return (await s.recv(SC4MP_BUFFER_SIZE)).decode()
+
+
+		# ===== PROTOCOL METHODS =====
+
+		async def fetch(self):
+			"""Fetch server ID and version"""
+			s = await self.client_socket()
+			info = await s.info()
+			return info.get("server_id"), info.get("server_version")
+
+
+		async def server_list(self):
+			"""Fetch server list"""
+			s = await self.client_socket()
+
+			servers = await s.server_list()
+
+			# Append the servers in the list to the unfetched servers
+			self.parent.discover(servers)
+
+
+		async def server_info(self):
+			"""Fetch server info"""
+			s = await self.client_socket()
+
+			return await s.info()
+
+
+		async def server_stats(self, server_id):
+			"""Calculate server stats"""
+
+			async def fetch_files(s, target, destination):
+
+				with sc4mp_tracer.span(target):
+
+					# Request file table
+					file_table = await s.file_table(target)
+
+					# Prune the file table, skipping files that haven't changed
+					size, file_table = self.files_needed(file_table, destination)
+
+					# Download files
+					async for checksum, filesize, relpath, file_data in s.file_table_data(target, file_table):
+
+						# Receive the file
+						with destination.open(checksum, relpath) as dest:
+							async for chunk in file_data:
+								dest.write(chunk)
+
+					self.files_received(target, destination)
+
+					return size
+
+
+			async def fetch_plugins():
+
+				# Plugins are received and discarded, only their size is needed
+				async with await self.connection() as s:
+					return await fetch_files(s, "plugins", RegionFiles())
+
+
+			async def fetch_regions():
+
+				return await fetch_files(await self.client_socket(), "regions", region_files)
+
+
+			@traced("time")
+			async def get_time():
+
+				try:
+
+					async with await self.connection() as s:
+						return await s.time()
+
+				except Exception as e:
+
+					show_error(e)
+
+					return datetime.now()
+
+			# Keep region files in memory
+			region_files = self.region_files(server_id)
+
+			# Download the plugins and get the server time on their own
+			# connections while the regions are downloaded over the session
+			plugins_size, regions_size, server_time = await gather_or_cancel(
+				fetch_plugins(), fetch_regions(), get_time()
+			)
+
+			stat_download = plugins_size + regions_size
+
+			return self.stats(server_id, region_files, stat_download, server_time)
+
+
+		# ===== V0.8/V0.4 PROTOCOL METHODS (LEGACY) =====
+
+		async def server_list_0_8(self):
+			"""Fetch server list using v0.8/v0.4 protocol"""
+			async with await self.socket_0_8() as s:
+
+				# Request server list
+				await s.send(b"server_list")
+
+				# Receive server list
+				servers = await s.recv_json()
+
+			# Append the servers in the list to the unfetched servers
+			self.parent.discover(servers)
+
+
+		async def server_info_0_8(self):
+			"""Fetch server info using v0.8/v0.4 protocol"""
+			async with await self.socket_0_8() as s:
+
+				await s.send(b"info")
+
+				return await s.recv_json()
+
+
+		async def server_stats_0_8(self, server_id):
+			"""Calculate server stats using v0.8/v0.4 protocol"""
+
+			async def fetch_files(request, destination):
+
+				with sc4mp_tracer.span(request):
+
+					async with await self.socket_0_8() as s:
+
+						# Request the type of data
+						await s.send(request.encode())
+
+						# Receive file table
+						file_table = await s.recv_json()
+
+						# Prune the file table, skipping files that haven't changed
+						size, file_table = self.files_needed(file_table, destination)
+
+						# Send pruned file table
+						await s.send_json(file_table)
+
+						# Receive files, checking each one against its checksum so a
+						# truncated or corrupted file is never cached
+						async for checksum, filesize, relpath, file_data in s.recv_files(file_table):
+
+							# Receive the file
+							with destination.open(checksum, relpath) as dest:
+								async for chunk in file_data:
+									dest.write(chunk)
+
+					self.files_received(request, destination)
+
+					return size
+
+
+			@traced("time")
+			async def get_time():
+
+				try:
+
+					async with await self.socket_0_8() as s:
+						await s.send(b"time")
+
+						return datetime.strptime((await s.recv(SC4MP_BUFFER_SIZE)).decode(), "%Y-%m-%d %H:%M:%S")
+
+				except Exception as e:
+
+					show_error(e)
+
+					return datetime.now()
+
+			# Keep region files in memory (plugins are received and discarded)
+			region_files = self.region_files(server_id)
+
+			# Download the plugins and regions and get the server time at once
+			plugins_size, regions_size, server_time = await gather_or_cancel(
+				fetch_files("plugins", RegionFiles()),
+				fetch_files("regions", region_files),
+				get_time()
+			)
+
+			stat_download = plugins_size + regions_size
+
+			return self.stats(server_id, region_files, stat_download, server_time)
+
+
+class Logger():
+	"""Replaces `sys.stdout`, labelling and coloring each line and handing it
+	to a background thread that writes the terminal and the log file.
+
+	Lines are labelled with the thread name, or with `sc4mp_log_label` in
+	asyncio tasks. The log file stays open and is rotated once it grows
+	past `max_size` bytes, keeping `backups` old files."""
+
+
+	TYPES_COLORS = [
+		("[INFO] ", '\033[90m '), #'\033[94m '
+		("[PROMPT]", '\033[01m '),
+		("[WARNING] ", '\033[93m '),
+		("[ERROR] ", '\033[91m '),
+		("[FATAL] ", '\033[91m ')
+	]
+
+
+	def __init__(self, log=SC4MP_LOG_FILE, max_size=SC4MP_LOG_MAX_SIZE, backups=SC4MP_LOG_BACKUPS):
+
+		self.terminal = sys.stdout
+		self.log = Path(log)
+		self.max_size = max_size
+		self.backups = backups
+
+		self.file = open(self.log, "w", encoding="utf-8")
+		self.size = 0
+
+		# Text written by each thread since its last newline
+		self.pending = dict()
+
+		self.queue = queue.Queue()
+		self.writer = Thread(target=self.run, name="Logger", daemon=True)
+		self.writer.start()
+
+
+	def write(self, message):
+
+		# `print` writes the text and the newline separately, so buffer
+		# until the end of the line to keep lines from interleaving
+		thread = current_thread()
+		message = self.pending.pop(thread.ident, "") + message
+		end = message.rfind("\n") + 1
+		if end < len(message):
+			self.pending[thread.ident] = message[end:]
+		if end == 0:
+			return
+
+		self.queue.put(self.format(message[:end], sc4mp_log_label.get() or thread.name))
+
+
+	def format(self, message, label):
+
+		# Timestamp
+		timestamp = datetime.now().strftime("[%H:%M:%S] ")
+
+		# Label
+		label = "[SC4MP/" + label + "] "
+
+		# Type and color
+		type = "[INFO] "
+		color = '\033[90m '
+		for current_type, current_color in self.TYPES_COLORS:
+			if message.startswith(current_type):
+				message = message[len(current_type):]
+				type = current_type
+				color = current_color
+				break
+		if label == "[SC4MP/Main] " and type == "[INFO] ":
+			color = '\033[00m '
+
+		# Assemble
+		return color + timestamp + label + type + message
+
+
+	def run(self):
+
+		while True:
+
+			output = self.queue.get()
+
+			# Write everything queued meanwhile in one go
+			outputs = [output]
+			try:
+				while True:
+					outputs.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			output = "".join(outputs)
+
+			try:
+				self.terminal.write(output)
+				self.terminal.flush()
+				self.file.write(output)
+				self.file.flush()
+				self.size += len(output)
+				if self.size > self.max_size:
+					self.rotate()
+			except Exception:
+				pass
+
+			for _ in outputs:
+				self.queue.task_done()
+
+
+	def rotate(self):
+
+		self.file.close()
+
+		for index in range(self.backups - 1, 0, -1):
+			backup = self.log.with_name(f"{self.log.name}.{index}")
+			if backup.exists():
+				os.replace(backup, self.log.with_name(f"{self.log.name}.{index + 1}"))
+		if self.backups > 0:
+			os.replace(self.log, self.log.with_name(f"{self.log.name}.1"))
+
+		self.file = open(self.log, "w", encoding="utf-8")
+		self.size = 0
+
+
+	def flush(self):
+
+		# Wait for the writer, unless this is the writer
+		if current_thread() is not self.writer:
+			self.queue.join()
 
-		self.terminal.flush()
 
+sc4mp_metrics = Metrics()
+sc4mp_tracer = Tracer()
 
 init()
 
@@ -0,0 +1,36 @@
+import contextlib
+import os
+import sys
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def api(tmp_path_factory):
+	"""Imports sc4mpapi as an API worker, so it starts no scanner of its own,
+	keeping its log and snapshot files out of the working directory."""
+
+	directory = tmp_path_factory.mktemp("sc4mpapi")
+
+	argv = sys.argv
+	sys.argv = [
+		"sc4mpapi.py", "--role", "api", "--state-file", "",
+		"--snapshot-file", str(directory / "snapshot.bin")
+	]
+
+	stdout = sys.stdout
+	cwd = os.getcwd()
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	os.chdir(directory)
+	try:
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			import sc4mpapi
+			sys.stdout.flush()
+	finally:
+		os.chdir(cwd)
+		sys.stdout = stdout
+		sys.argv = argv
+
+	yield sc4mpapi
+
+	sc4mpapi.sc4mp_source.stop()
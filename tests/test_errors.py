@@ -0,0 +1,32 @@
+import json
+import socket
+
+import pytest
+
+from core.networking import NetworkException, ConnectionClosedException
+
+
+def wrapped(e):
+	"""Returns `e` wrapped the way sockets raise it."""
+
+	try:
+		raise NetworkException(e) from e
+	except NetworkException as network_exception:
+		return network_exception
+
+
+@pytest.mark.parametrize("error, category", [
+	(ConnectionClosedException(), "Connection closed"),
+	(NetworkException("Expected 'SC4MP', but received 'HTTP/'."), "Protocol error"),
+	(NetworkException("Expected command 'Info' but received 'Time'."), "Protocol error"),
+	(NetworkException("Checksum mismatch for 'a.sc4': expected 'x', got 'y'."), "Checksum mismatch"),
+	(NetworkException("No data received."), "No data received"),
+	(NetworkException("Server is full, try again later."), "Server error"),
+	(wrapped(socket.timeout("timed out")), "Connection timed out."),
+	(ConnectionRefusedError(), "Connection refused by remote host."),
+	(json.JSONDecodeError("Expecting value", "", 0), "Unknown error (JSONDecodeError)"),
+	("Failed to get server ID.", "Failed to get server ID.")
+])
+def test_error_category(api, error, category):
+
+	assert api.error_category(error) == category
@@ -0,0 +1,232 @@
+import asyncio
+import random
+import threading
+from collections import Counter
+
+import pytest
+
+
+NODES = 10000
+DEGREE = 8
+
+
+@pytest.fixture(scope="module")
+def graph():
+	"""Returns a synthetic discovery graph of `NODES` server addresses, each
+	listing `DEGREE` random others plus the next one, so every address is
+	reachable from the first and most are listed many times."""
+
+	rng = random.Random(0)
+
+	addresses = [(f"10.0.{index // 256}.{index % 256}", 7240) for index in range(NODES)]
+
+	return {
+		address: [addresses[(index + 1) % NODES]] + rng.sample(addresses, DEGREE)
+		for index, address in enumerate(addresses)
+	}
+
+
+def entry(server):
+
+	return {"host": server[0], "port": server[1], "info": {}}
+
+
+def scanner(api, engine, graph):
+	"""Returns a scanner whose fetchers only count their visits and discover
+	the listed servers from `graph`, stopping after its first sweep."""
+
+	class ThreadFetcher(threading.Thread):
+
+		def __init__(self, parent, server):
+
+			super().__init__(name="Fetcher")
+
+			self.parent = parent
+			self.server = server
+
+		def run(self):
+
+			try:
+				self.parent.visited(self.server)
+			finally:
+				self.parent.fetcher_finished()
+
+	class AsyncFetcher():
+
+		def __init__(self, parent, server):
+
+			self.parent = parent
+			self.server = server
+
+		async def run(self):
+
+			await asyncio.sleep(0)
+
+			self.parent.visited(self.server)
+
+	base = api.Scanner if engine == "threads" else api.AsyncScanner
+
+	class GraphScanner(base):
+
+		Fetcher = ThreadFetcher if engine == "threads" else AsyncFetcher
+
+		def __init__(self):
+
+			super().__init__(max_fetchers=50)
+
+			self.fetched = Counter()
+			self.fetched_lock = threading.Lock()
+			self.finished = threading.Event()
+			self.in_flight_finished = None
+
+			self.frontier = api.Frontier([next(iter(graph))])
+
+		def visited(self, server):
+
+			with self.fetched_lock:
+				self.fetched[server] += 1
+
+			self.discover(graph[server])
+			self.fetch_succeeded(server, f"{server[0]}:{server[1]}", entry(server))
+
+		def sweep_finished(self):
+
+			self.in_flight_finished = self.in_flight
+			self.end = True
+			self.finished.set()
+
+	return GraphScanner()
+
+
+def test_frontier_queues_each_address_once(api, graph):
+
+	frontier = api.Frontier([next(iter(graph))])
+
+	popped = []
+	queued = 1
+	while len(frontier) > 0:
+		server = frontier.pop()
+		popped.append(server)
+		queued += frontier.extend(graph[server])
+
+	assert len(popped) == NODES
+	assert set(popped) == set(graph)
+	assert queued == NODES
+
+	# Addresses already seen are not queued again
+	assert frontier.extend(graph) == 0
+	assert len(frontier) == 0
+	assert all(server in frontier for server in graph)
+
+
+def test_frontier_pops_addresses_when_due(api):
+
+	frontier = api.Frontier()
+
+	frontier.append(("b", 7240))
+	frontier.requeue(("c", 7240), 20)
+	frontier.requeue(("a", 7240), 10)
+
+	assert frontier.due() == 0
+	assert frontier.pop(5) == ("b", 7240)
+	assert frontier.pop(5) is None
+	assert frontier.due() == 10
+	assert frontier.pop(30) == ("a", 7240)
+	assert frontier.pop() == ("c", 7240)
+	assert frontier.due() is None
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_scanner_fetches_each_address_once(api, graph, engine):
+
+	s = scanner(api, engine, graph)
+
+	s.start()
+	try:
+		assert s.finished.wait(60)
+	finally:
+		s.stop()
+		s.join(10)
+
+	assert len(s.fetched) == NODES
+	assert set(s.fetched.values()) == {1}
+	assert s.in_flight_finished == 0
+	assert s.in_flight == 0
+
+	# Each address is queued again for its next refresh
+	assert len(s.frontier) == NODES
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_scanner_publishes_without_waiting_for_stragglers(api, engine):
+
+	servers = [(f"10.1.0.{index}", 7240) for index in range(10)]
+	straggler = servers[0]
+	release = threading.Event()
+
+	def fetched(parent, server):
+
+		parent.fetch_succeeded(server, f"{server[0]}:{server[1]}", entry(server))
+
+	class ThreadFetcher(threading.Thread):
+
+		def __init__(self, parent, server):
+
+			super().__init__(name="Fetcher", daemon=True)
+
+			self.parent = parent
+			self.server = server
+
+		def run(self):
+
+			try:
+				if self.server == straggler:
+					release.wait(60)
+				fetched(self.parent, self.server)
+			finally:
+				self.parent.fetcher_finished()
+
+	class AsyncFetcher():
+
+		def __init__(self, parent, server):
+
+			self.parent = parent
+			self.server = server
+
+		async def run(self):
+
+			while self.server == straggler and not release.is_set():
+				await asyncio.sleep(.01)
+
+			fetched(self.parent, self.server)
+
+	base = api.Scanner if engine == "threads" else api.AsyncScanner
+
+	class StragglerScanner(base):
+
+		Fetcher = ThreadFetcher if engine == "threads" else AsyncFetcher
+
+		def __init__(self):
+
+			super().__init__(publish_interval=.05)
+
+			self.refreshed = threading.Event()
+			self.frontier = api.Frontier(servers)
+
+		def publish(self):
+
+			super().publish()
+
+			if len(self.servers) == len(servers) - 1:
+				self.refreshed.set()
+
+	s = StragglerScanner()
+
+	s.start()
+	try:
+		assert s.refreshed.wait(10)
+		assert s.in_flight == 1
+	finally:
+		release.set()
+		s.stop()
+		s.join(10)
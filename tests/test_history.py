@@ -0,0 +1,73 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+from urllib.request import urlopen
+
+import pytest
+
+
+@pytest.fixture
+def serve():
+	"""Serves a request handler class on localhost, returning its URL."""
+
+	servers = []
+
+	def serve(handler):
+		server = HTTPServer(("127.0.0.1", 0), handler)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		servers.append(server)
+		return f"http://127.0.0.1:{server.server_address[1]}"
+
+	yield serve
+
+	for server in servers:
+		server.shutdown()
+		server.server_close()
+
+
+def test_scanner_serves_history(api, serve, monkeypatch):
+
+	history = api.StatHistory()
+	history.record("server/1", {"stat_mayors": 3}, t=0)
+	monkeypatch.setattr(api, "sc4mp_scanner", SimpleNamespace(stat_history=history))
+
+	url = serve(api.MetricsRequestHandler)
+
+	with urlopen(f"{url}/servers/server%2F1/history") as response:
+		assert json.loads(response.read())["server_id"] == "server/1"
+
+	with pytest.raises(Exception, match="404"):
+		urlopen(f"{url}/servers/unknown/history")
+
+
+def test_api_workers_ask_the_scanner_for_history(api, serve, monkeypatch):
+
+	requested = []
+
+	class Scanner(BaseHTTPRequestHandler):
+
+		def do_GET(self):
+			requested.append(self.path)
+			if self.path == "/servers/server%2F1/history":
+				body = b'{"server_id":"server/1"}'
+				self.send_response(200)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			else:
+				self.send_error(404)
+
+		def log_message(self, format, *args):
+			pass
+
+	assert api.sc4mp_scanner is None
+	monkeypatch.setattr(api.sc4mp_args, "scanner_url", serve(Scanner) + "/")
+
+	assert api.server_history("server/1") == b'{"server_id":"server/1"}'
+	assert api.server_history("unknown") is None
+	assert requested == ["/servers/server%2F1/history", "/servers/unknown/history"]
+
+	monkeypatch.setattr(api.sc4mp_args, "scanner_url", None)
+
+	assert api.server_history("server/1") is None
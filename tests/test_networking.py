@@ -0,0 +1,78 @@
+import asyncio
+import socket
+
+import pytest
+
+from core.networking import AsyncClientSocket
+
+
+async def serve(handler):
+	"""Returns a local server answering each connection with `handler`."""
+
+	async def handle(reader, writer):
+		try:
+			await handler(reader, writer)
+		finally:
+			writer.close()
+
+	return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+def run(handler, client):
+
+	async def main():
+		server = await serve(handler)
+		try:
+			s = await AsyncClientSocket.open(server.sockets[0].getsockname()[:2], timeout=.2)
+			try:
+				return await client(s)
+			finally:
+				await s.close()
+		finally:
+			server.close()
+			await server.wait_closed()
+
+	return asyncio.run(main())
+
+
+def test_read_times_out():
+
+	async def silent(reader, writer):
+		await asyncio.sleep(1)
+
+	async def client(s):
+		with pytest.raises(socket.timeout):
+			await s.recv_exact(1)
+		return asyncio.current_task().cancelling() if hasattr(asyncio.Task, "cancelling") else 0
+
+	assert run(silent, client) == 0
+
+
+def test_timeout_applies_to_each_read():
+
+	async def slow(reader, writer):
+		for _ in range(5):
+			await asyncio.sleep(.1)
+			writer.write(b"x")
+			await writer.drain()
+
+	async def client(s):
+		return [await s.recv_exact(1) for _ in range(5)]
+
+	# Half a second in all, but never more than the timeout between bytes
+	assert run(slow, client) == [b"x"] * 5
+
+
+def test_cancelling_a_read_is_not_a_timeout():
+
+	async def silent(reader, writer):
+		await asyncio.sleep(1)
+
+	async def client(s):
+		read = asyncio.ensure_future(s.recv_exact(1))
+		await asyncio.sleep(.05)
+		read.cancel()
+		with pytest.raises(asyncio.CancelledError):
+			await read
+
+	run(silent, client)
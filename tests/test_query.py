@@ -0,0 +1,42 @@
+import base64
+import json
+
+import pytest
+
+
+class Args(dict):
+	"""Query string arguments, like Flask's `request.args`."""
+
+	def getlist(self, name):
+
+		return [self[name]]
+
+
+def cursor(value):
+
+	return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+@pytest.fixture
+def index(api):
+
+	return api.ServerIndex({
+		f"server{number}": {"host": "127.0.0.1", "port": 7240 + number, "info": {"private": False}}
+		for number in range(5)
+	})
+
+
+def test_pages_follow_the_cursor(api, index):
+
+	servers, next_cursor = api.query_servers(index, Args(limit="2", sort="port"))
+	assert [server["port"] for server in servers] == [7240, 7241]
+
+	servers, next_cursor = api.query_servers(index, Args(limit="2", sort="port", cursor=next_cursor))
+	assert [server["port"] for server in servers] == [7242, 7243]
+
+
+@pytest.mark.parametrize("value", [[None, [1]], [None, {"a": 1}], [None, None], [1, "server0"], "server0", [None]])
+def test_malformed_cursor_is_invalid(api, index, value):
+
+	with pytest.raises(ValueError, match="Invalid cursor."):
+		api.query_servers(index, Args(cursor=cursor(value)))
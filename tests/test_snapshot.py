@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+
+def server(number, mayors=0):
+
+	return {"host": "127.0.0.1", "port": 7240 + number, "stats": {"stat_mayors": mayors}}
+
+
+@pytest.fixture
+def snapshots(api):
+	"""Returns four generations: two servers, one changed, one added, one removed."""
+
+	first = api.Snapshot({"a": server(0), "b": server(1)})
+	second = api.Snapshot({"a": server(0, 1), "b": server(1)}, first)
+	third = api.Snapshot({"a": server(0, 1), "b": server(1), "c": server(2)}, second)
+	fourth = api.Snapshot({"a": server(0, 1), "c": server(2)}, third)
+
+	return first, second, third, fourth
+
+
+def test_reset_and_latest_delta_are_compressed_when_built(api, snapshots):
+
+	first, second, third, fourth = snapshots
+
+	assert set(fourth.deltas.keys()) == {None, third.generation}
+
+	reset = json.loads(fourth.delta(None)["identity"][0])
+	assert reset == {
+		"generation": fourth.generation, "reset": True,
+		"added": list(fourth.servers.values()), "changed": [], "removed": []
+	}
+	assert fourth.delta(None)["identity"][0] == api.encode_json(reset)
+
+	assert json.loads(fourth.delta(third.generation)["identity"][0]) == {
+		"generation": fourth.generation, "reset": False, "added": [], "changed": [], "removed": ["b"]
+	}
+
+
+def test_older_deltas_are_encoded_on_demand(api, snapshots):
+
+	first, second, third, fourth = snapshots
+
+	variants = fourth.delta(first.generation)
+
+	assert list(variants.keys()) == ["identity"]
+	assert json.loads(variants["identity"][0]) == {
+		"generation": fourth.generation, "reset": False,
+		"added": [server(2)], "changed": [server(0, 1)], "removed": ["b"]
+	}
+
+
+def test_dump_keeps_the_encoded_deltas(api, snapshots):
+
+	fourth = snapshots[-1]
+
+	loaded = api.Snapshot.load(fourth.dump())
+
+	assert loaded.generation == fourth.generation
+	assert loaded.deltas == fourth.deltas
+
+
+def test_reader_loads_each_written_generation(api, snapshots, tmp_path):
+
+	writer = api.SnapshotWriter(tmp_path / "snapshot.bin", size=4096)
+	reader = api.SnapshotReader(tmp_path / "snapshot.bin")
+
+	try:
+
+		assert reader.read() is None
+
+		for snapshot in snapshots:
+			writer.write(snapshot)
+			assert reader.read().generation == snapshot.generation
+			assert reader.read() is None
+
+	finally:
+
+		writer.close()
+
+
+def test_reader_retries_a_snapshot_that_failed_to_load(api, snapshots, tmp_path):
+
+	writer = api.SnapshotWriter(tmp_path / "snapshot.bin", size=4096)
+	reader = api.SnapshotReader(tmp_path / "snapshot.bin")
+
+	try:
+
+		# A complete sequence seen next to the length of the previous snapshot
+		writer.write(snapshots[1])
+		length = api.struct.unpack_from("<Q", writer.map, 24)[0]
+		api.struct.pack_into("<Q", writer.map, 24, 0)
+		with pytest.raises(Exception):
+			reader.read()
+
+		api.struct.pack_into("<Q", writer.map, 24, length)
+		assert reader.read().generation == snapshots[1].generation
+
+	finally:
+
+		writer.close()
+
+
+def test_unchanged_servers_keep_their_encoding(api):
+
+	previous = api.Snapshot({"a": server(0), "b": server(1)})
+	snapshot = api.Snapshot({"a": server(0), "b": server(1, 1)}, previous)
+
+	assert snapshot.entries["a"] is previous.entries["a"]
+	assert snapshot.entries["b"] is not previous.entries["b"]
+	assert snapshot.history[-1][1:] == (set(), {"b"}, set())